@@ -1,46 +1,196 @@
 from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from aiogram import Bot, Dispatcher, types
 from aiogram.client.session.aiohttp import AiohttpSession
+from aiogram.client.telegram import TelegramAPIServer
+from aiogram.fsm.storage.base import BaseStorage, DefaultKeyBuilder, StateType, StorageKey
 from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.fsm.state import State, StatesGroup
 from aiogram.fsm.context import FSMContext
-from aiogram.filters import Command
-from aiogram.types import FSInputFile, ContentType, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
-from contextlib import asynccontextmanager, suppress
-from datetime import datetime, timedelta
-from supabase import create_client, Client
+from aiogram.exceptions import (TelegramBadRequest, TelegramNetworkError,
+                                TelegramRetryAfter, TelegramServerError)
+from aiogram.filters import Command, CommandObject
+from aiogram.types import BufferedInputFile, ContentType, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager, contextmanager, suppress
+from datetime import date, datetime, timedelta
+from collections import OrderedDict, deque
+from collections.abc import Mapping, MutableMapping
+from typing import Any, NamedTuple
 import asyncio
+import atexit
+import contextvars
+import csv
+import heapq
+import hmac
+import itertools
+import logging
+import logging.handlers
+import multiprocessing
 import os
+import queue
+import random
+import sys
+import time
 import fitz
+import httpx
 import pytz
 from PIL import Image
-from io import BytesIO
+from io import BytesIO, StringIO
 import json
 import re
+import sqlite3
+import threading
 import qrcode
 
+# ------------ LOGS ------------
+# Quien loguea solo encola el registro (QueueHandler); un hilo aparte
+# (QueueListener) formatea y escribe a stdout, así un pipe lento del host no
+# frena el loop ni a quien tenga _folio_lock. Los mensajes usan argumentos
+# %s: con el nivel apagado (p. ej. DEBUG, el detalle del render) no se
+# formatea nada. Los registros llevan folio / user_id del contexto
+# (campos_log) y la traza en curso. WARNING o más, repetidos desde la misma
+# línea, se limitan a LOG_REPETIDOS_MAX por ventana; el siguiente que pasa
+# informa cuántos se suprimieron.
+
+LOG_NIVEL            = os.getenv("LOG_NIVEL", "INFO").upper()
+LOG_FORMATO          = os.getenv("LOG_FORMATO", "texto")   # texto | json
+LOG_REPETIDOS_MAX    = int(os.getenv("LOG_REPETIDOS_MAX", "5"))
+LOG_REPETIDOS_VENTANA = float(os.getenv("LOG_REPETIDOS_VENTANA", "60"))   # segundos; 0 = sin límite
+
+log = logging.getLogger("jalisco")
+_log_campos: contextvars.ContextVar[dict] = contextvars.ContextVar("log_campos", default={})
+
+@contextmanager
+def campos_log(**campos):
+    """Agrega campos (folio, user_id, ...) a todo lo que se loguee dentro."""
+    token = _log_campos.set({**_log_campos.get(), **campos})
+    try:
+        yield
+    finally:
+        _log_campos.reset(token)
+
+class _ContextoLog(logging.Filter):
+    """Copia los campos de contexto al registro; corre en el hilo que loguea."""
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        for clave, valor in _log_campos.get().items():
+            if not hasattr(record, clave):
+                setattr(record, clave, valor)
+        s = _span_actual.get()
+        if s is not None and not hasattr(record, "traza"):
+            record.traza = s.traza
+        return True
+
+class _LimiteRepetidos(logging.Filter):
+    def __init__(self, maximo: int, ventana: float):
+        super().__init__()
+        self.maximo  = maximo
+        self.ventana = ventana
+        self._estado: dict[tuple, list] = {}   # (archivo, línea) → [inicio, emitidos, suprimidos]
+        self._lock   = threading.Lock()
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        if record.levelno < logging.WARNING or self.ventana <= 0:
+            return True
+        clave = (record.pathname, record.lineno)
+        ahora = time.monotonic()
+        with self._lock:
+            estado = self._estado.get(clave)
+            if estado is None or ahora - estado[0] >= self.ventana:
+                if estado is not None and estado[2]:
+                    record.suprimidos = estado[2]
+                self._estado[clave] = [ahora, 1, 0]
+                return True
+            if estado[1] < self.maximo:
+                estado[1] += 1
+                return True
+            estado[2] += 1
+            return False
+
+_CAMPOS_LOG = ("folio", "user_id", "traza", "suprimidos")
+
+class _FormatoTexto(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)-7s %(message)s")
+
+    def format(self, record: logging.LogRecord) -> str:
+        linea = super().format(record)
+        extra = " ".join(f"{c}={getattr(record, c)}" for c in _CAMPOS_LOG if hasattr(record, c))
+        return f"{linea}  {extra}" if extra else linea
+
+class _FormatoJSON(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        salida = {
+            "ts":     datetime.fromtimestamp(record.created).isoformat(timespec="milliseconds"),
+            "nivel":  record.levelname,
+            "msg":    record.getMessage(),
+            "origen": f"{record.module}:{record.lineno}",
+            "pid":    record.process,
+        }
+        for campo in _CAMPOS_LOG:
+            if hasattr(record, campo):
+                salida[campo] = getattr(record, campo)
+        if record.exc_text:
+            salida["exc"] = record.exc_text
+        return json.dumps(salida, ensure_ascii=False, default=str)
+
+class _QueueHandlerLog(logging.handlers.QueueHandler):
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # Se encola tal cual (msg + args ya son seguros de compartir entre
+        # hilos); el formato completo se hace en el listener.
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+def _configurar_logs() -> logging.handlers.QueueListener:
+    salida = logging.StreamHandler(sys.stdout)
+    salida.setFormatter(_FormatoJSON() if LOG_FORMATO == "json" else _FormatoTexto())
+    cola = queue.SimpleQueue()
+    encolador = _QueueHandlerLog(cola)
+    encolador.addFilter(_LimiteRepetidos(LOG_REPETIDOS_MAX, LOG_REPETIDOS_VENTANA))
+    encolador.addFilter(_ContextoLog())
+    log.handlers[:] = [encolador]
+    log.setLevel(LOG_NIVEL)
+    log.propagate = False
+    oyente = logging.handlers.QueueListener(cola, salida, respect_handler_level=True)
+    oyente.start()
+    atexit.register(oyente.stop)
+    return oyente
+
+_log_oyente = _configurar_logs()
+
 # PDF417 — usando pdf417gen (el que está en requirements.txt)
+# (la disponibilidad se informa en el log de arranque)
 try:
     import pdf417gen
     PDF417_DISPONIBLE = True
-    print("[PDF417] pdf417gen disponible ✅")
 except ImportError:
     PDF417_DISPONIBLE = False
-    print("[PDF417] pdf417gen NO disponible, usando QR fallback")
 
 # ------------ CONFIG ------------
 BOT_TOKEN    = os.getenv("BOT_TOKEN", "")
 SUPABASE_URL = os.getenv("SUPABASE_URL", "")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY", "")
 BASE_URL     = os.getenv("BASE_URL", "").rstrip("/")
+# Servidor de Bot API alterno (Bot API local o stub de pruebas de carga);
+# vacío = api.telegram.org
+TELEGRAM_API_URL = os.getenv("TELEGRAM_API_URL", "").rstrip("/")
+ADMIN_IDS    = {int(x) for x in os.getenv("ADMIN_IDS", "").replace(" ", "").split(",") if x}
+# Bearer para los endpoints de administración (/admin/...); vacío = deshabilitados
+ADMIN_TOKEN  = os.getenv("ADMIN_TOKEN", "")
 OUTPUT_DIR   = "documentos"
+# Copia en disco opcional de cada PDF entregado, con tope de tamaño
+GUARDAR_PDFS      = os.getenv("GUARDAR_PDFS", "0") == "1"
+DOCUMENTOS_MAX_MB = float(os.getenv("DOCUMENTOS_MAX_MB", "200"))
 PLANTILLA_PDF   = "jalisco1.pdf"
 PLANTILLA_BUENO = "jalisco.pdf"
 
 PRECIO_PERMISO      = 250
 PRECIO_FIJO_PAGINA2 = 1080
 
-os.makedirs(OUTPUT_DIR, exist_ok=True)
 os.makedirs("static/pdfs", exist_ok=True)
 
 URL_CONSULTA_BASE = "https://serviciodigital-jaliscogobmx.onrender.com"
@@ -52,27 +202,1029 @@ RECT_PDF417        = fitz.Rect(932.65, 807, 1141.395, 852.127)
 PDF417_W = 840
 PDF417_H = 120
 
+# Barras (< 50% de luminosidad) a negro, fondo a gris claro
+_LUT_PDF417 = [0 if v < 128 else 220 for v in range(256)]
+
+# ------------ MÉTRICAS ------------
+# Registro en proceso con exposición en formato de texto de Prometheus
+# (GET /metrics). Los histogramas se actualizan en el punto de medición;
+# los gauges se calculan al momento del scrape. Con varios workers de
+# uvicorn cada proceso expone lo suyo.
+
+BUCKETS_SEGUNDOS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+BUCKETS_FASES    = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.02, 0.05, 0.1, 0.25, 0.5, 1)
+
+_metricas: list = []
+
+def _escapar_etiqueta(valor) -> str:
+    return str(valor).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+def _etiquetas(nombres: tuple, valores: tuple) -> str:
+    pares = ",".join(f'{n}="{_escapar_etiqueta(v)}"' for n, v in zip(nombres, valores))
+    return "{" + pares + "}" if pares else ""
+
+class Histograma:
+    def __init__(self, nombre: str, ayuda: str, etiquetas: tuple = (),
+                 buckets: tuple = BUCKETS_SEGUNDOS):
+        self.nombre, self.ayuda, self.etiquetas = nombre, ayuda, etiquetas
+        self.buckets = tuple(sorted(buckets))
+        self._series: dict[tuple, list] = {}   # valores → [conteos por bucket..., suma, total]
+        _metricas.append(self)
+
+    def observar(self, valor: float, *valores):
+        serie = self._series.get(valores)
+        if serie is None:
+            serie = self._series[valores] = [0] * len(self.buckets) + [0.0, 0]
+        for i, limite in enumerate(self.buckets):
+            if valor <= limite:
+                serie[i] += 1
+                break
+        serie[-2] += valor
+        serie[-1] += 1
+
+    def exportar(self) -> list[str]:
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} histogram"]
+        nombres_le = self.etiquetas + ("le",)
+        for valores, serie in sorted(self._series.items()):
+            acumulado = 0
+            for limite, n in zip(self.buckets, serie):
+                acumulado += n
+                lineas.append(f"{self.nombre}_bucket{_etiquetas(nombres_le, valores + (limite,))} {acumulado}")
+            lineas.append(f"{self.nombre}_bucket{_etiquetas(nombres_le, valores + ('+Inf',))} {serie[-1]}")
+            lineas.append(f"{self.nombre}_sum{_etiquetas(self.etiquetas, valores)} {serie[-2]}")
+            lineas.append(f"{self.nombre}_count{_etiquetas(self.etiquetas, valores)} {serie[-1]}")
+        return lineas
+
+class Contador:
+    def __init__(self, nombre: str, ayuda: str, etiquetas: tuple = ()):
+        self.nombre, self.ayuda, self.etiquetas = nombre, ayuda, etiquetas
+        self._series: dict[tuple, float] = {}
+        _metricas.append(self)
+
+    def incrementar(self, *valores, n: float = 1):
+        self._series[valores] = self._series.get(valores, 0) + n
+
+    def exportar(self) -> list[str]:
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} counter"]
+        for valores, v in sorted(self._series.items()):
+            lineas.append(f"{self.nombre}{_etiquetas(self.etiquetas, valores)} {v}")
+        return lineas
+
+class Medidor:
+    """Gauge calculado al exportar; la función devuelve {valores: número} o un número."""
+
+    def __init__(self, nombre: str, ayuda: str, funcion, etiquetas: tuple = ()):
+        self.nombre, self.ayuda, self.etiquetas = nombre, ayuda, etiquetas
+        self._funcion = funcion
+        _metricas.append(self)
+
+    def exportar(self) -> list[str]:
+        lineas = [f"# HELP {self.nombre} {self.ayuda}", f"# TYPE {self.nombre} gauge"]
+        try:
+            valor = self._funcion()
+        except Exception as e:
+            log.warning("[METRICAS] %s: %s", self.nombre, e)
+            return lineas
+        series = valor if isinstance(valor, dict) else {(): valor}
+        for valores, v in sorted(series.items()):
+            lineas.append(f"{self.nombre}{_etiquetas(self.etiquetas, valores)} {v}")
+        return lineas
+
+def exportar_metricas() -> str:
+    return "\n".join(linea for m in _metricas for linea in m.exportar()) + "\n"
+
+M_RENDER_FASE = Histograma(
+    "jalisco_render_fase_segundos",
+    "Duración de cada fase del render (plantilla, fusion, texto, qr, pdf417, guardado)",
+    ("tipo", "fase"), BUCKETS_FASES)
+M_RENDER = Histograma(
+    "jalisco_render_segundos", "Render de punta a punta, incluida la espera de cupo", ("tipo",))
+M_SUPABASE = Histograma(
+    "jalisco_supabase_segundos", "Peticiones a PostgREST", ("tabla", "operacion", "resultado"))
+M_TELEGRAM = Histograma(
+    "jalisco_telegram_segundos", "Llamadas a la Bot API", ("metodo", "resultado"))
+M_ENVIO_ESPERA = Histograma(
+    "jalisco_envio_espera_segundos", "Espera de turno en el limitador de envíos a Telegram",
+    ("prioridad",))
+M_ENVIO_REINTENTOS = Contador(
+    "jalisco_envio_reintentos_total", "Envíos a Telegram reintentados (429 o error de red)",
+    ("motivo",))
+M_BARRIDO = Histograma(
+    "jalisco_barrido_segundos", "Barrido de folios expirados (local o con consulta a la BD)",
+    ("origen",))
+M_FOLIO_LOCK = Histograma(
+    "jalisco_folio_lock_espera_segundos", "Espera por _folio_lock al asignar folio",
+    ("prefijo",), BUCKETS_FASES)
+
+# ── fases del render ──
+# El render corre en otro proceso (o hilo): las fases se acumulan en un
+# dict del hilo que lo ejecuta y viajan de vuelta junto con los bytes.
+
+_medicion = threading.local()
+
+@contextmanager
+def _fase(nombre: str):
+    """Cronometra una fase; el tiempo de fases anidadas no se cuenta dos veces."""
+    fases = getattr(_medicion, "fases", None)
+    if fases is None:
+        yield
+        return
+    pila = _medicion.pila
+    pila.append(0.0)
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        total = time.perf_counter() - t0
+        hijas = pila.pop()
+        fases[nombre] = fases.get(nombre, 0.0) + total - hijas
+        if pila:
+            pila[-1] += total
+
+def _render_medido(fn, payload: dict) -> tuple[bytes, dict]:
+    """Ejecuta fn(payload) y devuelve (pdf, {fase: segundos})."""
+    _medicion.fases, _medicion.pila = {}, []
+    try:
+        return fn(payload), _medicion.fases
+    finally:
+        _medicion.fases = None
+
+# ------------ TRAZAS ------------
+# Un árbol de spans por folio, de get_nombre al envío en background, con
+# folio y usuario como atributos. El span actual vive en un ContextVar, así
+# que create_task hereda el padre. El muestreo se decide en la raíz: una
+# traza no elegida no crea ningún span (solo una lectura del ContextVar por
+# punto instrumentado). Los spans terminados se exportan en lote:
+#   TRAZAS_DESTINO=http(s)://.../v1/traces → OTLP/HTTP JSON (collector)
+#   cualquier otra cosa                    → archivo JSONL, un span por línea
+
+TRAZAS_MUESTREO   = float(os.getenv("TRAZAS_MUESTREO", "0"))   # 0 = apagado, 1 = todas
+TRAZAS_DESTINO    = os.getenv("TRAZAS_DESTINO", "trazas.jsonl")
+TRAZAS_SERVICIO   = os.getenv("TRAZAS_SERVICIO", "bot-jalisco")
+TRAZAS_LOTE       = 256
+TRAZAS_INTERVALO  = 5        # segundos entre exportaciones
+TRAZAS_BUFFER_MAX = 10_000   # si el destino no responde se descartan los más viejos
+
+class Span:
+    __slots__ = ("nombre", "traza", "id", "padre", "inicio", "fin", "atributos", "error")
+
+    def __init__(self, nombre: str, traza: str, padre: str | None, atributos: dict):
+        self.nombre    = nombre
+        self.traza     = traza
+        self.id        = os.urandom(8).hex()
+        self.padre     = padre
+        self.inicio    = time.time_ns()
+        self.fin       = 0
+        self.atributos = atributos
+        self.error     = None
+
+_span_actual: contextvars.ContextVar[Span | None] = contextvars.ContextVar("span_actual", default=None)
+_spans_listos: list[Span] = []
+_trazas_despertar = asyncio.Event()
+_trazas_task      = None
+_trazas_http: httpx.AsyncClient | None = None
+
+@contextmanager
+def _abrir_span(nombre: str, traza_id: str, padre_id: str | None, atributos: dict):
+    s = Span(nombre, traza_id, padre_id, atributos)
+    token = _span_actual.set(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.error = f"{type(e).__name__}: {e}"
+        raise
+    finally:
+        s.fin = time.time_ns()
+        _span_actual.reset(token)
+        _spans_listos.append(s)
+        if len(_spans_listos) > TRAZAS_BUFFER_MAX:
+            del _spans_listos[:len(_spans_listos) - TRAZAS_BUFFER_MAX]
+        if len(_spans_listos) >= TRAZAS_LOTE:
+            _trazas_despertar.set()
+
+@contextmanager
+def traza(nombre: str, **atributos):
+    """Raíz de una traza nueva, sujeta a TRAZAS_MUESTREO. Produce el Span o None."""
+    if TRAZAS_MUESTREO <= 0 or random.random() >= TRAZAS_MUESTREO:
+        token = _span_actual.set(None)
+        try:
+            yield None
+        finally:
+            _span_actual.reset(token)
+        return
+    with _abrir_span(nombre, os.urandom(16).hex(), None, atributos) as s:
+        yield s
+
+@contextmanager
+def span(nombre: str, **atributos):
+    """Span hijo del actual; sin traza en curso no hace nada."""
+    padre = _span_actual.get()
+    if padre is None:
+        yield None
+        return
+    with _abrir_span(nombre, padre.traza, padre.id, atributos) as s:
+        yield s
+
+def etiquetar(**atributos):
+    """Agrega atributos al span en curso, si lo hay."""
+    s = _span_actual.get()
+    if s is not None:
+        s.atributos.update(atributos)
+
+def marcar_error(e: BaseException):
+    """Marca el span en curso como fallido por una excepción ya atrapada."""
+    s = _span_actual.get()
+    if s is not None:
+        s.error = f"{type(e).__name__}: {e}"
+
+def _valor_otlp(v) -> dict:
+    if isinstance(v, bool):
+        return {"boolValue": v}
+    if isinstance(v, int):
+        return {"intValue": str(v)}
+    if isinstance(v, float):
+        return {"doubleValue": v}
+    return {"stringValue": str(v)}
+
+def _cuerpo_otlp(spans: list[Span]) -> dict:
+    return {"resourceSpans": [{
+        "resource": {"attributes": [
+            {"key": "service.name", "value": {"stringValue": TRAZAS_SERVICIO}},
+        ]},
+        "scopeSpans": [{
+            "scope": {"name": "app"},
+            "spans": [{
+                "traceId":           s.traza,
+                "spanId":            s.id,
+                **({"parentSpanId": s.padre} if s.padre else {}),
+                "name":              s.nombre,
+                "kind":              1,
+                "startTimeUnixNano": str(s.inicio),
+                "endTimeUnixNano":   str(s.fin),
+                "attributes":        [{"key": k, "value": _valor_otlp(v)}
+                                      for k, v in s.atributos.items() if v is not None],
+                "status":            {"code": 2, "message": s.error} if s.error else {"code": 1},
+            } for s in spans],
+        }],
+    }]}
+
+def _anexar_spans_jsonl(spans: list[Span]):
+    with open(TRAZAS_DESTINO, "a") as f:
+        for s in spans:
+            f.write(json.dumps({
+                "traza":       s.traza,
+                "span":        s.id,
+                "padre":       s.padre,
+                "nombre":      s.nombre,
+                "inicio":      s.inicio / 1e9,
+                "duracion_ms": (s.fin - s.inicio) / 1e6,
+                "atributos":   s.atributos,
+                "error":       s.error,
+            }, ensure_ascii=False, default=str) + "\n")
+
+async def vaciar_trazas():
+    """Exporta los spans terminados; si falla, vuelven al buffer."""
+    global _trazas_http
+    if not _spans_listos:
+        return
+    lote = _spans_listos[:]
+    del _spans_listos[:len(lote)]
+    try:
+        if TRAZAS_DESTINO.startswith(("http://", "https://")):
+            if _trazas_http is None:
+                _trazas_http = httpx.AsyncClient(timeout=5)
+            r = await _trazas_http.post(TRAZAS_DESTINO, json=_cuerpo_otlp(lote))
+            r.raise_for_status()
+        else:
+            await asyncio.to_thread(_anexar_spans_jsonl, lote)
+    except Exception as e:
+        log.warning("[TRAZAS] No se pudieron exportar %s spans: %s", len(lote), e)
+        _spans_listos[:0] = lote
+        if len(_spans_listos) > TRAZAS_BUFFER_MAX:
+            del _spans_listos[:len(_spans_listos) - TRAZAS_BUFFER_MAX]
+
+async def _exportador_trazas():
+    while True:
+        with suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(_trazas_despertar.wait(), TRAZAS_INTERVALO)
+        _trazas_despertar.clear()
+        await vaciar_trazas()
+
+def iniciar_exportador_trazas():
+    global _trazas_task
+    if TRAZAS_MUESTREO > 0 and (_trazas_task is None or _trazas_task.done()):
+        _trazas_task = asyncio.create_task(_exportador_trazas())
+        log.info("[TRAZAS] Muestreo %.0f%% → %s", TRAZAS_MUESTREO * 100, TRAZAS_DESTINO)
+
+async def detener_exportador_trazas():
+    global _trazas_http
+    if _trazas_task:
+        _trazas_task.cancel()
+        with suppress(asyncio.CancelledError):
+            await _trazas_task
+    await vaciar_trazas()
+    if _trazas_http is not None:
+        await _trazas_http.aclose()
+        _trazas_http = None
+
 # ------------ PLANTILLAS EN MEMORIA ------------
-_plantilla1_bytes: bytes | None = None
-_plantilla2_bytes: bytes | None = None
+# jalisco1.pdf + jalisco.pdf se parsean y fusionan UNA vez al arrancar en un
+# documento base de 2 páginas; cada render lo clona desde estos bytes.
+_plantilla_base_bytes: bytes | None = None
 
 def _cargar_plantillas():
-    global _plantilla1_bytes, _plantilla2_bytes
-    with open(PLANTILLA_PDF, "rb") as f:
-        _plantilla1_bytes = f.read()
-    with open(PLANTILLA_BUENO, "rb") as f:
-        _plantilla2_bytes = f.read()
-    print("[PLANTILLAS] Cargadas en memoria ✅")
+    global _plantilla_base_bytes
+    base = fitz.open()
+    for ruta in (PLANTILLA_PDF, PLANTILLA_BUENO):
+        with fitz.open(ruta) as doc:
+            base.insert_pdf(doc)
+    _plantilla_base_bytes = base.tobytes(garbage=3, deflate=True)
+    base.close()
+    log.info("[PLANTILLAS] Base 2 páginas en memoria (%s bytes) ✅", len(_plantilla_base_bytes))
+
+@_fase("plantilla")
+def _abrir_plantilla_base() -> fitz.Document:
+    """Copia de trabajo del documento base (página 0 = permiso, 1 = pago)."""
+    if _plantilla_base_bytes is None:
+        _cargar_plantillas()
+    return fitz.open(stream=_plantilla_base_bytes, filetype="pdf")
 
 # ------------ SUPABASE ------------
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+# Cliente PostgREST asíncrono sobre un pool httpx keep-alive. Misma forma
+# fluida que supabase-py (table().select().eq()...), pero execute() es
+# awaitable y no ocupa un hilo del executor durante el round trip.
+
+SB_POOL_MAX       = int(os.getenv("SB_POOL_MAX", "20"))
+SB_POOL_KEEPALIVE = int(os.getenv("SB_POOL_KEEPALIVE", "10"))
+SB_TIMEOUT        = float(os.getenv("SB_TIMEOUT", "10"))
+# Valores por filtro in.(...) en una sola petición: la lista va en la URL y
+# proxies / PostgREST cortan líneas de ~8 KB
+SB_IN_MAX         = int(os.getenv("SB_IN_MAX", "150"))
+
+def _trozos(valores: list, n: int) -> list[list]:
+    return [valores[i:i + n] for i in range(0, len(valores), max(1, n))]
+
+class SupabaseError(Exception):
+    """Error devuelto por PostgREST; el mensaje incluye código y detalle."""
+
+    def __init__(self, status: int, cuerpo):
+        self.status = status
+        self.cuerpo = cuerpo
+        if isinstance(cuerpo, dict):
+            detalle = f"{cuerpo.get('code', '')} {cuerpo.get('message', '')} {cuerpo.get('details') or ''}"
+        else:
+            detalle = str(cuerpo)
+        super().__init__(f"PostgREST {status}: {detalle.strip()}")
+
+class RespuestaSB(NamedTuple):
+    data:  list
+    count: int | None = None
+
+class _ConsultaSB:
+    """Una petición PostgREST en construcción."""
+
+    def __init__(self, cliente: "SupabaseAsync", tabla: str):
+        self._cliente = cliente
+        self._tabla   = tabla
+        self._metodo  = "GET"
+        self._params: list[tuple[str, str]] = []
+        self._cuerpo  = None
+        self._prefer: list[str] = []
+        self._operacion = "select"
+
+    # ── operaciones ──
+    def select(self, columnas: str = "*", count: str | None = None):
+        self._params.append(("select", columnas))
+        if count:
+            self._prefer.append(f"count={count}")
+        return self
+
+    def insert(self, filas):
+        self._metodo, self._cuerpo, self._operacion = "POST", filas, "insert"
+        self._prefer.append("return=representation")
+        return self
+
+    def upsert(self, filas, on_conflict: str | None = None):
+        self._metodo, self._cuerpo, self._operacion = "POST", filas, "upsert"
+        self._prefer += ["resolution=merge-duplicates", "return=representation"]
+        if on_conflict:
+            self._params.append(("on_conflict", on_conflict))
+        return self
+
+    def update(self, valores: dict):
+        self._metodo, self._cuerpo, self._operacion = "PATCH", valores, "update"
+        self._prefer.append("return=representation")
+        return self
+
+    def delete(self):
+        self._metodo, self._operacion = "DELETE", "delete"
+        self._prefer.append("return=representation")
+        return self
+
+    # ── filtros ──
+    def _filtro(self, columna: str, op: str, valor):
+        self._params.append((columna, f"{op}.{valor}"))
+        return self
+
+    def eq(self, columna, valor):  return self._filtro(columna, "eq", valor)
+    def neq(self, columna, valor): return self._filtro(columna, "neq", valor)
+    def gt(self, columna, valor):  return self._filtro(columna, "gt", valor)
+    def gte(self, columna, valor): return self._filtro(columna, "gte", valor)
+    def lt(self, columna, valor):  return self._filtro(columna, "lt", valor)
+    def lte(self, columna, valor): return self._filtro(columna, "lte", valor)
+
+    def in_(self, columna, valores):
+        return self._filtro(columna, "in", "(" + ",".join(f'"{v}"' for v in valores) + ")")
+
+    def order(self, columna: str, desc: bool = False):
+        self._params.append(("order", f"{columna}.{'desc' if desc else 'asc'}"))
+        return self
+
+    def limit(self, n: int):
+        self._params.append(("limit", str(n)))
+        return self
+
+    async def execute(self, timeout: float | None = None) -> RespuestaSB:
+        return await self._cliente._peticion(
+            self._metodo, f"/rest/v1/{self._tabla}", self._params,
+            self._cuerpo, self._prefer, timeout, (self._tabla, self._operacion)
+        )
+
+class SupabaseAsync:
+    def __init__(self, url: str, key: str):
+        self._url = url.rstrip("/")
+        self._headers = {
+            "apikey":        key,
+            "Authorization": f"Bearer {key}",
+            "Content-Type":  "application/json",
+        }
+        self._http: httpx.AsyncClient | None = None
+
+    def _cliente_http(self) -> httpx.AsyncClient:
+        if self._http is None or self._http.is_closed:
+            self._http = httpx.AsyncClient(
+                base_url=self._url,
+                headers=self._headers,
+                timeout=SB_TIMEOUT,
+                limits=httpx.Limits(
+                    max_connections=SB_POOL_MAX,
+                    max_keepalive_connections=SB_POOL_KEEPALIVE,
+                ),
+            )
+        return self._http
+
+    def table(self, tabla: str) -> _ConsultaSB:
+        return _ConsultaSB(self, tabla)
+
+    async def rpc(self, funcion: str, params: dict | None = None,
+                  timeout: float | None = None) -> RespuestaSB:
+        return await self._peticion("POST", f"/rest/v1/rpc/{funcion}", [], params or {}, [],
+                                    timeout, (funcion, "rpc"))
+
+    async def _peticion(self, metodo, ruta, params, cuerpo, prefer, timeout,
+                        metrica: tuple[str, str]) -> RespuestaSB:
+        headers = {"Prefer": ",".join(prefer)} if prefer else None
+        t0 = time.perf_counter()
+        with span(f"supabase {metrica[1]} {metrica[0]}", tabla=metrica[0], operacion=metrica[1]):
+            try:
+                r = await self._cliente_http().request(
+                    metodo, ruta, params=params, json=cuerpo, headers=headers,
+                    timeout=SB_TIMEOUT if timeout is None else timeout,
+                )
+            except Exception:
+                M_SUPABASE.observar(time.perf_counter() - t0, *metrica, "red")
+                raise
+            etiquetar(status=r.status_code)
+        M_SUPABASE.observar(time.perf_counter() - t0, *metrica,
+                            "ok" if r.status_code < 400 else str(r.status_code))
+        try:
+            datos = r.json() if r.content else []
+        except ValueError:
+            datos = r.text
+        if r.status_code >= 400:
+            raise SupabaseError(r.status_code, datos)
+        total = None
+        rango = r.headers.get("content-range", "")
+        if "/" in rango and not rango.endswith("*"):
+            total = int(rango.rsplit("/", 1)[1])
+        if not isinstance(datos, list):
+            datos = [datos]
+        return RespuestaSB(datos, total)
+
+    async def cerrar(self):
+        if self._http is not None:
+            await self._http.aclose()
+            self._http = None
+
+supabase = SupabaseAsync(SUPABASE_URL, SUPABASE_KEY)
+
+# ------------ ALMACÉN COMPARTIDO ------------
+# Estado FSM + índices de usuario (timers_activos, folios por usuario,
+# pending_comprobantes). Por defecto en memoria: un solo proceso. Con
+# ALMACEN_URL=sqlite:///ruta.db todos los workers de uvicorn comparten un
+# SQLite en modo WAL. Las lecturas van directo en el loop (en WAL no esperan
+# a los escritores; busy timeout corto por si coinciden con un checkpoint).
+# Las escrituras compiten por el lock entre procesos, así que van a un hilo
+# único con su propia conexión: el loop espera con await, no bloqueado. Las
+# escrituras de timers y pendientes desde el loop usan asignar()/sacar().
+
+ALMACEN_URL            = os.getenv("ALMACEN_URL", "")
+ALMACEN_ESPERA_LECTURA = float(os.getenv("ALMACEN_ESPERA_LECTURA", "0.05"))   # segundos
+
+class TimerFolio(NamedTuple):
+    user_id:    int
+    start_time: datetime
+    seq:        int
+
+def _abrir_sqlite(ruta: str, espera: float = 5) -> sqlite3.Connection:
+    con = sqlite3.connect(ruta, isolation_level=None, check_same_thread=False, timeout=espera)
+    con.execute("PRAGMA journal_mode=WAL")
+    con.execute("PRAGMA synchronous=NORMAL")
+    return con
+
+class _EscritorSQLite:
+    """Hilo único y su conexión para todas las escrituras del almacén."""
+
+    def __init__(self, ruta: str):
+        self.con   = _abrir_sqlite(ruta)   # solo se usa dentro del hilo (y al crear tablas)
+        self._hilo = ThreadPoolExecutor(max_workers=1, thread_name_prefix="almacen")
+
+    async def __call__(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._hilo, fn, *args)
+
+    async def ejecutar(self, sql: str, params: tuple = ()):
+        await self(self.con.execute, sql, params)
+
+    @contextmanager
+    def transaccion(self):
+        """
+        BEGIN IMMEDIATE … COMMIT explícitos (solo dentro del hilo): con
+        isolation_level=None `with con:` no abre ninguna transacción.
+        """
+        self.con.execute("BEGIN IMMEDIATE")
+        try:
+            yield self.con
+        except BaseException:
+            self.con.execute("ROLLBACK")
+            raise
+        self.con.execute("COMMIT")
+
+class SQLiteStorage(BaseStorage):
+    """Storage FSM de aiogram sobre SQLite WAL, compartido entre procesos."""
+
+    def __init__(self, con: sqlite3.Connection, escritor: _EscritorSQLite):
+        self._con      = con
+        self._escritor = escritor
+        self._claves   = DefaultKeyBuilder(with_bot_id=True, with_destiny=True)
+        escritor.con.execute(
+            "CREATE TABLE IF NOT EXISTS fsm ("
+            " clave TEXT PRIMARY KEY, estado TEXT, datos TEXT NOT NULL DEFAULT '{}')"
+        )
+
+    async def set_state(self, key: StorageKey, state: StateType = None) -> None:
+        estado = state.state if isinstance(state, State) else state
+        await self._escribir(
+            "INSERT INTO fsm (clave, estado) VALUES (?, ?) "
+            "ON CONFLICT(clave) DO UPDATE SET estado = excluded.estado",
+            self._claves.build(key), estado, vacio=estado is None
+        )
+
+    async def get_state(self, key: StorageKey) -> str | None:
+        fila = self._con.execute(
+            "SELECT estado FROM fsm WHERE clave = ?", (self._claves.build(key),)
+        ).fetchone()
+        return fila[0] if fila else None
+
+    async def set_data(self, key: StorageKey, data: Mapping[str, Any]) -> None:
+        await self._escribir(
+            "INSERT INTO fsm (clave, datos) VALUES (?, ?) "
+            "ON CONFLICT(clave) DO UPDATE SET datos = excluded.datos",
+            self._claves.build(key), json.dumps(dict(data)), vacio=not data
+        )
+
+    async def _escribir(self, sql: str, clave: str, valor, vacio: bool):
+        if not vacio:
+            await self._escritor.ejecutar(sql, (clave, valor))
+        else:
+            await self._escritor(self._escribir_y_purgar, sql, clave, valor)
+
+    def _escribir_y_purgar(self, sql: str, clave: str, valor):
+        # state.clear() deja estado NULL y datos vacíos: la fila se borra
+        # para que la tabla no crezca con cada chat que pasó por el bot
+        with self._escritor.transaccion() as con:
+            con.execute(sql, (clave, valor))
+            con.execute("DELETE FROM fsm WHERE clave = ? AND estado IS NULL AND datos = '{}'", (clave,))
+
+    async def get_data(self, key: StorageKey) -> dict[str, Any]:
+        fila = self._con.execute(
+            "SELECT datos FROM fsm WHERE clave = ?", (self._claves.build(key),)
+        ).fetchone()
+        return json.loads(fila[0]) if fila else {}
+
+    async def update_data(self, key: StorageKey, data: Mapping[str, Any]) -> dict[str, Any]:
+        return await self._escritor(self._update_data, self._claves.build(key), dict(data))
+
+    def _update_data(self, clave: str, data: dict) -> dict[str, Any]:
+        # Leer-modificar-escribir atómico aunque otro worker toque la misma clave
+        with self._escritor.transaccion() as con:
+            fila  = con.execute("SELECT datos FROM fsm WHERE clave = ?", (clave,)).fetchone()
+            datos = json.loads(fila[0]) if fila else {}
+            datos.update(data)
+            con.execute(
+                "INSERT INTO fsm (clave, datos) VALUES (?, ?) "
+                "ON CONFLICT(clave) DO UPDATE SET datos = excluded.datos",
+                (clave, json.dumps(datos))
+            )
+        return datos
+
+    async def close(self) -> None:
+        pass
+
+    def sesiones_activas(self) -> int:
+        return self._con.execute("SELECT COUNT(*) FROM fsm WHERE estado IS NOT NULL").fetchone()[0]
+
+class _TimersSQLite(MutableMapping):
+    """
+    folio → TimerFolio sobre la tabla timers. Las escrituras síncronas del
+    mapping usan la conexión del escritor y corren en su hilo; desde el
+    loop se llaman con asignar()/sacar().
+    """
+
+    def __init__(self, con: sqlite3.Connection, escritor: _EscritorSQLite):
+        self._con      = con
+        self._escritor = escritor
+        escritor.con.execute(
+            "CREATE TABLE IF NOT EXISTS timers ("
+            " folio TEXT PRIMARY KEY, user_id INTEGER NOT NULL,"
+            " start_time REAL NOT NULL, seq INTEGER NOT NULL)"
+        )
+        escritor.con.execute("CREATE INDEX IF NOT EXISTS timers_user ON timers (user_id, start_time)")
+
+    async def asignar(self, folio, timer: TimerFolio):
+        await self._escritor(self.__setitem__, folio, timer)
+
+    async def sacar(self, folio) -> TimerFolio | None:
+        return await self._escritor(self.pop, folio, None)
+
+    async def sacar_varios(self, folios) -> dict:
+        return await self._escritor(self._sacar_varios, list(folios))
+
+    async def vigentes(self, folios) -> dict:
+        """folio → seq de los que siguen activos; en el hilo, un SELECT por trozo."""
+        return await self._escritor(self._vigentes, list(folios))
+
+    def _vigentes(self, folios: list) -> dict:
+        vigentes = {}
+        for trozo in _trozos(folios, 500):
+            vigentes.update(self._escritor.con.execute(
+                f"SELECT folio, seq FROM timers WHERE folio IN ({','.join('?' * len(trozo))})", trozo
+            ).fetchall())
+        return vigentes
+
+    def _sacar_varios(self, folios: list) -> dict:
+        with self._escritor.transaccion():   # atómico frente a los otros workers
+            return {f: t for f in folios if (t := self.pop(f, None)) is not None}
+
+    @staticmethod
+    def _timer(fila) -> TimerFolio:
+        return TimerFolio(fila[0], datetime.fromtimestamp(fila[1]), fila[2])
+
+    def __getitem__(self, folio):
+        fila = self._con.execute(
+            "SELECT user_id, start_time, seq FROM timers WHERE folio = ?", (folio,)
+        ).fetchone()
+        if fila is None:
+            raise KeyError(folio)
+        return self._timer(fila)
+
+    def __setitem__(self, folio, timer: TimerFolio):
+        self._escritor.con.execute(
+            "INSERT OR REPLACE INTO timers (folio, user_id, start_time, seq) VALUES (?, ?, ?, ?)",
+            (folio, timer.user_id, timer.start_time.timestamp(), timer.seq)
+        )
+
+    def __delitem__(self, folio):
+        if self._escritor.con.execute("DELETE FROM timers WHERE folio = ?", (folio,)).rowcount == 0:
+            raise KeyError(folio)
+
+    def pop(self, folio, *default):
+        # DELETE ... RETURNING: solo un proceso "gana" el folio
+        fila = self._escritor.con.execute(
+            "DELETE FROM timers WHERE folio = ? RETURNING user_id, start_time, seq", (folio,)
+        ).fetchone()
+        if fila is None:
+            if default:
+                return default[0]
+            raise KeyError(folio)
+        return self._timer(fila)
+
+    def __contains__(self, folio):
+        return self._con.execute("SELECT 1 FROM timers WHERE folio = ?", (folio,)).fetchone() is not None
+
+    def __iter__(self):
+        return iter([f for (f,) in self._con.execute("SELECT folio FROM timers ORDER BY start_time")])
+
+    def __len__(self):
+        return self._con.execute("SELECT COUNT(*) FROM timers").fetchone()[0]
+
+    def de_usuario(self, user_id: int) -> list:
+        return [f for (f,) in self._con.execute(
+            "SELECT folio FROM timers WHERE user_id = ? ORDER BY start_time", (user_id,)
+        )]
+
+class _PendientesSQLite(MutableMapping):
+    """user_id → estado de comprobante pendiente; escrituras como en _TimersSQLite."""
+
+    def __init__(self, con: sqlite3.Connection, escritor: _EscritorSQLite):
+        self._con      = con
+        self._escritor = escritor
+        escritor.con.execute(
+            "CREATE TABLE IF NOT EXISTS pendientes (user_id INTEGER PRIMARY KEY, estado TEXT)")
+
+    async def asignar(self, user_id, estado):
+        await self._escritor(self.__setitem__, user_id, estado)
+
+    async def sacar(self, user_id):
+        return await self._escritor(self.pop, user_id, None)
+
+    def __getitem__(self, user_id):
+        fila = self._con.execute("SELECT estado FROM pendientes WHERE user_id = ?", (user_id,)).fetchone()
+        if fila is None:
+            raise KeyError(user_id)
+        return fila[0]
+
+    def __setitem__(self, user_id, estado):
+        self._escritor.con.execute("INSERT OR REPLACE INTO pendientes (user_id, estado) VALUES (?, ?)",
+                                   (user_id, estado))
+
+    def __delitem__(self, user_id):
+        if self._escritor.con.execute("DELETE FROM pendientes WHERE user_id = ?", (user_id,)).rowcount == 0:
+            raise KeyError(user_id)
+
+    def __iter__(self):
+        return iter([u for (u,) in self._con.execute("SELECT user_id FROM pendientes")])
+
+    def __len__(self):
+        return self._con.execute("SELECT COUNT(*) FROM pendientes").fetchone()[0]
+
+class _TimersMemoria(dict):
+    """folio → TimerFolio con índice por usuario, en proceso."""
+
+    def __init__(self):
+        super().__init__()
+        self._por_usuario: dict[int, list] = {}
+
+    def __setitem__(self, folio, timer: TimerFolio):
+        if folio in self:
+            self.pop(folio)
+        super().__setitem__(folio, timer)
+        self._por_usuario.setdefault(timer.user_id, []).append(folio)
+
+    def pop(self, folio, *default):
+        timer = super().pop(folio, None)
+        if timer is None:
+            if default:
+                return default[0]
+            raise KeyError(folio)
+        folios = self._por_usuario.get(timer.user_id, [])
+        if folio in folios:
+            folios.remove(folio)
+            if not folios:
+                del self._por_usuario[timer.user_id]
+        return timer
+
+    def __delitem__(self, folio):
+        self.pop(folio)
+
+    def de_usuario(self, user_id: int) -> list:
+        return list(self._por_usuario.get(user_id, []))
+
+    async def asignar(self, folio, timer: TimerFolio):
+        self[folio] = timer
+
+    async def sacar(self, folio) -> TimerFolio | None:
+        return self.pop(folio, None)
+
+    async def sacar_varios(self, folios) -> dict:
+        return {f: t for f in folios if (t := self.pop(f, None)) is not None}
+
+    async def vigentes(self, folios) -> dict:
+        return {f: t.seq for f in folios if (t := self.get(f)) is not None}
+
+class _PendientesMemoria(dict):
+    async def asignar(self, user_id, estado):
+        self[user_id] = estado
+
+    async def sacar(self, user_id):
+        return self.pop(user_id, None)
+
+def _crear_almacen():
+    if ALMACEN_URL.startswith("sqlite:///"):
+        ruta     = ALMACEN_URL[len("sqlite:///"):]
+        escritor = _EscritorSQLite(ruta)
+        lector   = _abrir_sqlite(ruta, ALMACEN_ESPERA_LECTURA)
+        log.info("[ALMACÉN] SQLite WAL compartido: %s", ALMACEN_URL)
+        return (SQLiteStorage(lector, escritor), _TimersSQLite(lector, escritor),
+                _PendientesSQLite(lector, escritor))
+    if ALMACEN_URL:
+        log.warning("ALMACEN_URL no soportado (%s), usando memoria", ALMACEN_URL)
+    return MemoryStorage(), _TimersMemoria(), _PendientesMemoria()
 
 # ------------ BOT ------------
-session_bot = AiohttpSession(timeout=300)
+session_bot = (AiohttpSession(api=TelegramAPIServer.from_base(TELEGRAM_API_URL), timeout=300)
+               if TELEGRAM_API_URL else AiohttpSession(timeout=300))
 bot         = Bot(token=BOT_TOKEN, session=session_bot)
-storage     = MemoryStorage()
+storage, timers_activos, pending_comprobantes = _crear_almacen()
 dp          = Dispatcher(storage=storage)
 
+# ── limitador de envíos ──
+# Todo lo que sale hacia un chat pasa por dos cubetas de tokens: una global
+# (~30/s, el límite de la Bot API por bot) y una por chat (~1/s con ráfaga
+# corta). Los envíos esperan turno por prioridad: documentos, luego
+# respuestas, luego recordatorios y avisos (prioridad_envio). Dentro de
+# una prioridad se respeta el orden de llegada, salvo que el chat del
+# primero no tenga token. Un 429 pausa la cubeta del chat lo que pida
+# retry_after; los errores de red se reintentan con backoff y jitter.
+# 0 en ENVIOS_POR_SEGUNDO / ENVIOS_POR_CHAT = sin límite.
+
+ENVIOS_POR_SEGUNDO = float(os.getenv("ENVIOS_POR_SEGUNDO", "30"))
+ENVIOS_POR_CHAT    = float(os.getenv("ENVIOS_POR_CHAT", "1"))
+ENVIOS_RAFAGA_CHAT = int(os.getenv("ENVIOS_RAFAGA_CHAT", "3"))
+ENVIOS_REINTENTOS  = int(os.getenv("ENVIOS_REINTENTOS", "4"))
+
+PRIORIDAD_DOCUMENTO, PRIORIDAD_NORMAL, PRIORIDAD_BAJA = 0, 1, 2
+NOMBRES_PRIORIDAD = ("documento", "normal", "baja")
+
+_METODOS_LIMITADOS = {
+    "sendMessage", "sendDocument", "sendPhoto", "sendMediaGroup", "sendVideo",
+    "sendAudio", "sendVoice", "sendAnimation", "sendSticker", "copyMessage", "forwardMessage",
+}
+
+_prioridad_envio: contextvars.ContextVar[int | None] = contextvars.ContextVar("prioridad_envio", default=None)
+
+@contextmanager
+def prioridad_envio(prioridad: int):
+    """Prioridad de los envíos hechos dentro del bloque (por defecto según el método)."""
+    token = _prioridad_envio.set(prioridad)
+    try:
+        yield
+    finally:
+        _prioridad_envio.reset(token)
+
+class _Cubeta:
+    __slots__ = ("tasa", "capacidad", "tokens", "t", "pausa")
+
+    def __init__(self, tasa: float, capacidad: int):
+        self.tasa, self.capacidad = tasa, max(1, capacidad)
+        self.tokens, self.t, self.pausa = float(self.capacidad), time.monotonic(), 0.0
+
+    def espera(self, ahora: float) -> float:
+        """Segundos hasta tener un token; 0 = disponible ya."""
+        if ahora < self.pausa:
+            return self.pausa - ahora
+        if self.tasa <= 0:
+            return 0.0
+        self.tokens = min(self.capacidad, self.tokens + (ahora - self.t) * self.tasa)
+        self.t = ahora
+        return 0.0 if self.tokens >= 1 else (1 - self.tokens) / self.tasa
+
+    def llena(self, ahora: float) -> bool:
+        return self.espera(ahora) == 0 and (self.tasa <= 0 or self.tokens >= self.capacidad)
+
+class PlanificadorEnvios:
+    CHATS_MAX = 10_000   # cubetas por chat antes de podar las que están llenas
+
+    def __init__(self, por_segundo: float, por_chat: float, rafaga_chat: int):
+        self._global   = _Cubeta(por_segundo, int(por_segundo))
+        self._por_chat = por_chat
+        self._rafaga   = rafaga_chat
+        self._chats: dict = {}   # chat_id → _Cubeta
+        self._colas = tuple(deque() for _ in NOMBRES_PRIORIDAD)   # (chat_id, futuro)
+        self._despertar = asyncio.Event()
+        self._tarea = None
+
+    def _cubeta(self, chat_id) -> _Cubeta:
+        cubeta = self._chats.get(chat_id)
+        if cubeta is None:
+            if len(self._chats) >= self.CHATS_MAX:
+                ahora = time.monotonic()
+                self._chats = {c: b for c, b in self._chats.items() if not b.llena(ahora)}
+            cubeta = self._chats[chat_id] = _Cubeta(self._por_chat, self._rafaga)
+        return cubeta
+
+    def en_cola(self) -> dict:
+        return {(nombre,): sum(1 for _, f in cola if not f.done())
+                for nombre, cola in zip(NOMBRES_PRIORIDAD, self._colas)}
+
+    async def turno(self, chat_id, prioridad: int):
+        futuro = asyncio.get_running_loop().create_future()
+        self._colas[prioridad].append((chat_id, futuro))
+        self._despertar.set()
+        if self._tarea is None or self._tarea.done():
+            self._tarea = asyncio.create_task(self._despachar())
+        await futuro
+
+    def pausar(self, chat_id, segundos: float):
+        cubeta = self._global if chat_id is None else self._cubeta(chat_id)
+        cubeta.pausa = max(cubeta.pausa, time.monotonic() + segundos)
+        self._despertar.set()
+
+    def _siguiente(self, ahora: float):
+        """(chat_id, futuro) listo en orden de prioridad, o (None, segundos hasta el próximo)."""
+        minimo = None
+        for cola in self._colas:
+            while cola and cola[0][1].done():   # cancelados
+                cola.popleft()
+            for i, (chat_id, futuro) in enumerate(cola):
+                if futuro.done():
+                    continue
+                espera = self._cubeta(chat_id).espera(ahora) if chat_id is not None else 0.0
+                if espera == 0:
+                    del cola[i]
+                    return chat_id, futuro
+                minimo = espera if minimo is None else min(minimo, espera)
+        return None, minimo
+
+    async def _despachar(self):
+        while True:
+            self._despertar.clear()
+            ahora  = time.monotonic()
+            espera = self._global.espera(ahora)
+            if espera == 0:
+                chat_id, listo = self._siguiente(ahora)
+                if isinstance(listo, asyncio.Future):
+                    self._global.tokens -= 1
+                    if chat_id is not None:
+                        self._cubeta(chat_id).tokens -= 1
+                    listo.set_result(None)
+                    continue
+                espera = listo
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(self._despertar.wait(), espera)
+
+    async def cerrar(self):
+        if self._tarea:
+            self._tarea.cancel()
+            with suppress(asyncio.CancelledError):
+                await self._tarea
+
+planificador_envios = PlanificadorEnvios(ENVIOS_POR_SEGUNDO, ENVIOS_POR_CHAT, ENVIOS_RAFAGA_CHAT)
+
+@session_bot.middleware
+async def _limitar_envios(make_request, bot, method):
+    # Registrado antes que _medir_bot_api: la espera de turno y los
+    # reintentos quedan fuera de la latencia medida de cada llamada
+    api = method.__api_method__
+    if api not in _METODOS_LIMITADOS:
+        return await make_request(bot, method)
+    chat_id   = getattr(method, "chat_id", None)
+    prioridad = _prioridad_envio.get()
+    if prioridad is None:
+        prioridad = PRIORIDAD_DOCUMENTO if api == "sendDocument" else PRIORIDAD_NORMAL
+    for intento in range(ENVIOS_REINTENTOS + 1):
+        t0 = time.perf_counter()
+        await planificador_envios.turno(chat_id, prioridad)
+        M_ENVIO_ESPERA.observar(time.perf_counter() - t0, NOMBRES_PRIORIDAD[prioridad])
+        try:
+            return await make_request(bot, method)
+        except TelegramRetryAfter as e:
+            if intento == ENVIOS_REINTENTOS:
+                raise
+            M_ENVIO_REINTENTOS.incrementar("429")
+            espera = e.retry_after + random.uniform(0, 1)
+            planificador_envios.pausar(chat_id, espera)
+            log.warning("[ENVIOS] 429 en %s a %s, reintento en %.1fs", api, chat_id, espera)
+        except (TelegramNetworkError, TelegramServerError) as e:
+            if intento == ENVIOS_REINTENTOS:
+                raise
+            M_ENVIO_REINTENTOS.incrementar("red")
+            espera = min(30, 2 ** intento) * random.uniform(0.5, 1.5)
+            log.warning("[ENVIOS] %s en %s a %s, reintento en %.1fs", e, api, chat_id, espera)
+            await asyncio.sleep(espera)
+
+_bot_api_en_vuelo = 0
+
+@session_bot.middleware
+async def _medir_bot_api(make_request, bot, method):
+    global _bot_api_en_vuelo
+    _bot_api_en_vuelo += 1
+    t0 = time.perf_counter()
+    resultado = "error"
+    try:
+        with span(f"telegram {method.__api_method__}"):
+            respuesta = await make_request(bot, method)
+        resultado = "ok"
+        return respuesta
+    finally:
+        _bot_api_en_vuelo -= 1
+        M_TELEGRAM.observar(time.perf_counter() - t0, method.__api_method__, resultado)
+
+def sesiones_fsm_activas() -> int:
+    """Chats con un paso del formulario en curso."""
+    if isinstance(storage, SQLiteStorage):
+        return storage.sesiones_activas()
+    return sum(1 for r in storage.storage.values() if r.state is not None)
+
 # ============ FOLIOS — WATERMARK EN SUPABASE =================================
 FOLIO_PREFIJO_JAL = "JAL"
 
@@ -84,31 +1236,68 @@ PREFIJOS_VALIDOS = {
 _folio_cursors = {}
 _folio_lock    = asyncio.Lock()
 
+# Lease de folios: se reserva un bloque de N por prefijo con una sola
+# escritura de watermark y se reparte desde memoria. 0 = modo clásico
+# (una escritura por folio dentro del lock).
+FOLIO_LEASE_SIZE     = int(os.getenv("FOLIO_LEASE_SIZE", "50"))
+FOLIO_LEASE_RENOVAR  = max(1, FOLIO_LEASE_SIZE // 4)   # renovar cuando queden ≤ N/4
+_folio_lease_fin     = {}   # prefijo → último folio cubierto por el watermark
+_folio_bloques       = {}   # prefijo → [[siguiente, fin], ...] reservados sin repartir
+_folio_renovaciones  = {}   # prefijo → asyncio.Task de renovación en curso
+
+# Reserva atómica en BD (sql/reservar_folios.sql): el bloque lo asigna
+# Postgres con la fila del watermark bloqueada, así varios workers o
+# instancias nunca reparten el mismo folio. Sin esto, el lease solo es
+# seguro con un único proceso; por eso con ALMACEN_URL (varios workers) es
+# el modo por defecto, y desactivarlo ahí se reporta como error al arrancar.
+FOLIO_RESERVA_RPC = os.getenv("FOLIO_RESERVA_RPC", "1" if ALMACEN_URL else "0") == "1"
+
 # ── watermark persistido ──────────────────────────────────────────────────────
 
-def _sb_leer_watermark_jal(prefijo_num: str) -> int | None:
-    """Síncrono."""
+async def _sb_leer_watermark_jal(prefijo_num: str) -> int | None:
     clave = f"{FOLIO_PREFIJO_JAL}_{prefijo_num}"
     try:
-        r = supabase.table("folio_watermark").select("ultimo_asignado").eq("prefijo", clave).execute()
+        r = await supabase.table("folio_watermark").select("ultimo_asignado").eq("prefijo", clave).execute()
         if r.data:
             return r.data[0]["ultimo_asignado"]
         return None
     except Exception as e:
-        print(f"[ERROR] leer_watermark JAL {prefijo_num}: {e}")
+        log.error("leer_watermark JAL %s: %s", prefijo_num, e)
         return None
 
-def _sb_guardar_watermark_jal(prefijo_num: str, numero: int):
-    """Solo avanza, nunca retrocede. Síncrono."""
+async def _sb_guardar_watermark_jal(prefijo_num: str, numero: int) -> bool:
+    """Solo avanza, nunca retrocede."""
     clave = f"{FOLIO_PREFIJO_JAL}_{prefijo_num}"
     try:
-        supabase.table("folio_watermark").upsert({
+        await supabase.table("folio_watermark").upsert({
             "prefijo":         clave,
             "ultimo_asignado": numero
         }).execute()
-        print(f"[WATERMARK JAL] Guardado {clave}: {numero}")
+        log.debug("[WATERMARK JAL] Guardado %s: %s", clave, numero)
+        return True
+    except Exception as e:
+        log.error("guardar_watermark JAL %s: %s", prefijo_num, e)
+        return False
+
+async def _sb_reservar_bloque_jal(prefijo_num: str, cantidad: int,
+                                  desde: int) -> tuple[int, int] | None:
+    """
+    Reserva atómica de `cantidad` folios consecutivos. `desde` solo se usa
+    si el watermark aún no existe (primer arranque). Devuelve (inicio, fin).
+    """
+    base = PREFIJOS_VALIDOS[prefijo_num]
+    try:
+        r = await supabase.rpc("reservar_folios", {
+            "p_prefijo":  f"{FOLIO_PREFIJO_JAL}_{prefijo_num}",
+            "p_cantidad": cantidad,
+            "p_desde":    desde,
+            "p_base":     base,
+            "p_limite":   base + 100000000,
+        })
+        return int(r.data[0]["inicio"]), int(r.data[0]["fin"])
     except Exception as e:
-        print(f"[ERROR] guardar_watermark JAL {prefijo_num}: {e}")
+        log.error("reservar_folios JAL %s: %s", prefijo_num, e)
+        return None
 
 # ── cursors locales ───────────────────────────────────────────────────────────
 
@@ -124,15 +1313,15 @@ def _guardar_cursors_local(cursors: dict):
         with open("folio_cursors.json", "w") as f:
             json.dump(cursors, f)
     except Exception as e:
-        print(f"[WARN] No se pudo persistir cursors: {e}")
+        log.warning("No se pudo persistir cursors: %s", e)
 
 # ── inicialización ────────────────────────────────────────────────────────────
 
-def _leer_ultimo_folio_por_prefijo_db(prefijo_num: str) -> int:
-    """Fallback primera vez — busca máximo en DB activa. Síncrono."""
+async def _leer_ultimo_folio_por_prefijo_db(prefijo_num: str) -> int:
+    """Fallback primera vez — busca máximo en DB activa."""
     try:
         base = PREFIJOS_VALIDOS[prefijo_num]
-        resp = (
+        resp = await (
             supabase.table("folios_registrados")
             .select("folio")
             .gte("folio", str(base))
@@ -143,11 +1332,11 @@ def _leer_ultimo_folio_por_prefijo_db(prefijo_num: str) -> int:
         )
         if resp.data:
             ultimo = int(resp.data[0]["folio"])
-            print(f"[FOLIO][DB fallback] Último prefijo {prefijo_num}: {ultimo}")
+            log.info("[FOLIO][DB fallback] Último prefijo %s: %s", prefijo_num, ultimo)
             return ultimo
         return base - 1
     except Exception as e:
-        print(f"[ERROR] Consultando folios prefijo {prefijo_num}: {e}")
+        log.error("Consultando folios prefijo %s: %s", prefijo_num, e)
         return PREFIJOS_VALIDOS[prefijo_num] - 1
 
 async def inicializar_folio_cursors():
@@ -157,29 +1346,109 @@ async def inicializar_folio_cursors():
     2) Si no existe, fallback a DB activa y crea el watermark.
     3) Toma el mayor entre watermark y cursor local.
     El contador NUNCA baja aunque se borren folios expirados.
+    Con FOLIO_RESERVA_RPC el watermark es la única fuente: el cursor local
+    no se compara ni se escribe, y el watermark lo crea la propia RPC.
     """
     global _folio_cursors
-    cursors_local = _leer_cursors_local()
+    if ALMACEN_URL and not FOLIO_RESERVA_RPC:
+        log.error("[FOLIO JAL] ALMACEN_URL con FOLIO_RESERVA_RPC=0: cada worker reparte "
+                  "su propio lease y pueden emitir el mismo folio")
+    cursors_local = {} if FOLIO_RESERVA_RPC else _leer_cursors_local()
 
     for prefijo_num, base in PREFIJOS_VALIDOS.items():
-        watermark = await asyncio.to_thread(_sb_leer_watermark_jal, prefijo_num)
+        watermark = await _sb_leer_watermark_jal(prefijo_num)
 
         if watermark is not None:
             desde = watermark
-            print(f"[FOLIO JAL] Prefijo {prefijo_num} desde watermark: {watermark}")
+            log.info("[FOLIO JAL] Prefijo %s desde watermark: %s", prefijo_num, watermark)
         else:
-            desde = await asyncio.to_thread(_leer_ultimo_folio_por_prefijo_db, prefijo_num)
-            await asyncio.to_thread(_sb_guardar_watermark_jal, prefijo_num, desde)
-            print(f"[FOLIO JAL] Prefijo {prefijo_num} watermark creado desde DB: {desde}")
+            desde = await _leer_ultimo_folio_por_prefijo_db(prefijo_num)
+            if not FOLIO_RESERVA_RPC:
+                await _sb_guardar_watermark_jal(prefijo_num, desde)
+            log.info("[FOLIO JAL] Prefijo %s watermark creado desde DB: %s", prefijo_num, desde)
 
         local = cursors_local.get(prefijo_num)
         if local is not None and local > desde:
             desde = local
-            print(f"[FOLIO JAL] Prefijo {prefijo_num} cursor local más alto: {local}")
+            log.info("[FOLIO JAL] Prefijo %s cursor local más alto: %s", prefijo_num, local)
 
         _folio_cursors[prefijo_num] = desde
+        _folio_lease_fin[prefijo_num] = desde
+        _folio_bloques[prefijo_num] = []
+
+    if not FOLIO_RESERVA_RPC:
+        _guardar_cursors_local(_folio_cursors)
+
+    if FOLIO_LEASE_SIZE > 0 or FOLIO_RESERVA_RPC:
+        await asyncio.gather(*(_renovar_lease(p) for p in PREFIJOS_VALIDOS))
+
+# ── lease de bloques ──────────────────────────────────────────────────────────
+
+def _siguiente_folio(prefijo_num: str, actual: int) -> int:
+    base = PREFIJOS_VALIDOS[prefijo_num]
+    siguiente = actual + 1
+    return base if siguiente >= base + 100000000 else siguiente
+
+async def _renovar_lease(prefijo_num: str):
+    """
+    Reserva el siguiente bloque de FOLIO_LEASE_SIZE folios para el prefijo.
+    Se persiste el FIN del bloque (watermark + cursor local) antes de
+    repartirlo, así tras un reinicio se arranca después del bloque y el
+    folio nunca retrocede; los folios no usados del bloque se saltan.
+    En modo RPC el bloque lo decide la BD y puede no ser contiguo al
+    anterior (otro proceso reservó en medio).
+    """
+    cantidad = max(1, FOLIO_LEASE_SIZE)
+
+    if FOLIO_RESERVA_RPC:
+        for intento in range(3):
+            bloque = await _sb_reservar_bloque_jal(prefijo_num, cantidad,
+                                                   _folio_lease_fin[prefijo_num])
+            if bloque is not None:
+                break
+            await asyncio.sleep(0.2 * (intento + 1))
+        else:
+            # Sin BD no hay folio seguro que repartir: que falle la petición
+            # en vez de arriesgar duplicados con otro proceso.
+            raise RuntimeError(f"No se pudo reservar bloque de folios JAL {prefijo_num}")
+        inicio, fin = bloque
+    else:
+        base   = PREFIJOS_VALIDOS[prefijo_num]
+        inicio = _siguiente_folio(prefijo_num, _folio_lease_fin[prefijo_num])
+        fin    = min(inicio + cantidad - 1, base + 100000000 - 1)
+
+        for intento in range(3):
+            if await _sb_guardar_watermark_jal(prefijo_num, fin):
+                break
+            await asyncio.sleep(0.2 * (intento + 1))
+        else:
+            log.warning("Lease JAL %s sin watermark remoto, solo cursor local", prefijo_num)
+
+        cursors = dict(_folio_lease_fin)
+        cursors[prefijo_num] = fin
+        await asyncio.to_thread(_guardar_cursors_local, cursors)
 
-    _guardar_cursors_local(_folio_cursors)
+    async with _folio_lock:
+        _folio_bloques[prefijo_num].append([inicio, fin])
+        _folio_lease_fin[prefijo_num] = fin
+    log.info("[FOLIO JAL] Lease prefijo %s: %s–%s", prefijo_num, inicio, fin)
+
+def _programar_renovacion(prefijo_num: str) -> asyncio.Task:
+    """Una sola renovación en vuelo por prefijo. Llamar con _folio_lock tomado."""
+    tarea = _folio_renovaciones.get(prefijo_num)
+    if tarea is None or tarea.done():
+        tarea = asyncio.create_task(_renovar_lease(prefijo_num))
+        # Las renovaciones anticipadas nadie las espera: marcar el error
+        # como recogido; quien se quede sin bloque lo recibe al esperar.
+        tarea.add_done_callback(lambda t: t.cancelled() or t.exception())
+        _folio_renovaciones[prefijo_num] = tarea
+    return tarea
+
+async def esperar_renovaciones():
+    """Deja terminar las renovaciones en vuelo antes de cerrar el cliente de Supabase."""
+    pendientes = [t for t in _folio_renovaciones.values() if not t.done()]
+    if pendientes:
+        await asyncio.gather(*pendientes, return_exceptions=True)
 
 # ── generación de folio ───────────────────────────────────────────────────────
 
@@ -187,23 +1456,55 @@ async def generar_folio_con_prefijo(prefijo_num: str) -> str:
     global _folio_cursors
     if prefijo_num not in PREFIJOS_VALIDOS:
         prefijo_num = "1"
+    if FOLIO_LEASE_SIZE > 0 or FOLIO_RESERVA_RPC:
+        return await _generar_folio_lease(prefijo_num)
+    t0 = time.perf_counter()
     async with _folio_lock:
+        M_FOLIO_LOCK.observar(time.perf_counter() - t0, prefijo_num)
         base   = PREFIJOS_VALIDOS[prefijo_num]
         limite = base + 100000000
         _folio_cursors[prefijo_num] += 1
         if _folio_cursors[prefijo_num] >= limite:
             _folio_cursors[prefijo_num] = base
         numero = _folio_cursors[prefijo_num]
-        await asyncio.to_thread(_sb_guardar_watermark_jal, prefijo_num, numero)
+        await _sb_guardar_watermark_jal(prefijo_num, numero)
         _guardar_cursors_local(_folio_cursors)
         folio = f"{numero:09d}"
-        print(f"[FOLIO JAL] Generado prefijo {prefijo_num}: {folio}")
+        log.debug("[FOLIO JAL] Generado prefijo %s: %s", prefijo_num, folio)
         return folio
 
+async def _generar_folio_lease(prefijo_num: str) -> str:
+    """
+    Reparte desde los bloques en memoria. El lock solo cubre aritmética;
+    la reserva del siguiente bloque corre en la renovación en segundo
+    plano, que se dispara cuando quedan FOLIO_LEASE_RENOVAR folios o menos.
+    """
+    while True:
+        t0 = time.perf_counter()
+        async with _folio_lock:
+            M_FOLIO_LOCK.observar(time.perf_counter() - t0, prefijo_num)
+            bloques = _folio_bloques[prefijo_num]
+            if bloques:
+                bloque = bloques[0]
+                numero = bloque[0]
+                if numero >= bloque[1]:
+                    bloques.pop(0)
+                else:
+                    bloque[0] = numero + 1
+                _folio_cursors[prefijo_num] = numero
+                if sum(f - i + 1 for i, f in bloques) <= FOLIO_LEASE_RENOVAR:
+                    _programar_renovacion(prefijo_num)
+                folio = f"{numero:09d}"
+                log.debug("[FOLIO JAL] Generado prefijo %s: %s", prefijo_num, folio)
+                return folio
+            renovacion = _programar_renovacion(prefijo_num)
+        # Sin bloque: esperar la renovación fuera del lock
+        await asyncio.shield(renovacion)
+
 # ============ INSERT SUPABASE =================================================
 
-def _sb_insertar_folio(datos: dict, user_id: int, username: str):
-    supabase.table("folios_registrados").insert({
+async def _sb_insertar_folio(datos: dict, user_id: int, username: str):
+    await supabase.table("folios_registrados").insert({
         "folio":             datos["folio"],
         "marca":             datos["marca"],
         "linea":             datos["linea"],
@@ -220,8 +1521,8 @@ def _sb_insertar_folio(datos: dict, user_id: int, username: str):
         "username": username or "Sin username",
     }).execute()
 
-def _sb_insertar_borrador(datos: dict, user_id: int):
-    supabase.table("borradores_registros").insert({
+async def _sb_insertar_borrador(datos: dict, user_id: int):
+    await supabase.table("borradores_registros").insert({
         "folio":             datos["folio"],
         "entidad":           "Jalisco",
         "numero_serie":      datos["serie"],
@@ -238,25 +1539,102 @@ def _sb_insertar_borrador(datos: dict, user_id: int):
     }).execute()
 
 async def guardar_folio_con_reintento(datos: dict, user_id: int, username: str, prefijo="1") -> bool:
-    for intento in range(100_000_000):
-        if "folio" not in datos or not re.fullmatch(r"\d{9}", str(datos.get("folio", ""))):
-            datos["folio"] = await generar_folio_con_prefijo(prefijo)
-        try:
-            await asyncio.to_thread(_sb_insertar_folio, datos, user_id, username)
-            print(f"[ÉXITO] ✅ Folio {datos['folio']} guardado (intento {intento+1})")
-            return True
-        except Exception as e:
-            em = str(e).lower()
-            if "duplicate" in em or "unique constraint" in em or "23505" in em:
-                print(f"[DUPLICADO] {datos['folio']} existe, reintentando ({intento+1})")
-                datos["folio"] = None
-                await asyncio.sleep(0.1)
-                continue
-            print(f"[ERROR BD] {e}")
-            return False
-    return False
+    with span("guardar_folio", prefijo=prefijo):
+        for intento in range(100_000_000):
+            etiquetar(intentos=intento + 1)
+            if "folio" not in datos or not re.fullmatch(r"\d{9}", str(datos.get("folio", ""))):
+                with span("generar_folio"):
+                    try:
+                        datos["folio"] = await generar_folio_con_prefijo(prefijo)
+                    except Exception as e:
+                        # RPC de reserva caída: sin folio seguro, el usuario reintenta
+                        marcar_error(e)
+                        log.error("[ERROR FOLIO] %s", e)
+                        return False
+            try:
+                await _sb_insertar_folio(datos, user_id, username)
+                log.info("[ÉXITO] ✅ Folio %s guardado (intento %s)", datos['folio'], intento+1)
+                etiquetar(folio=datos["folio"])
+                return True
+            except Exception as e:
+                em = str(e).lower()
+                if "duplicate" in em or "unique constraint" in em or "23505" in em:
+                    log.warning("[DUPLICADO] %s existe, reintentando (%s)", datos['folio'], intento+1)
+                    datos["folio"] = None
+                    datos.pop("pdf_parcial", None)   # estampado con el folio viejo
+                    await asyncio.sleep(0.1)
+                    continue
+                log.error("[ERROR BD] %s", e)
+                return False
+        return False
+
+# ============ TRANSICIONES DE ESTADO ==========================================
+# folios_registrados y borradores_registros cambian siempre juntos. Con
+# SB_RPC_FOLIOS=1 se usa una sola llamada RPC (sql/transiciones_folios.sql);
+# si no, las dos peticiones salen concurrentes por el pool.
+
+SB_RPC_FOLIOS = os.getenv("SB_RPC_FOLIOS", "0") == "1"
+
+class TransicionFolio(NamedTuple):
+    folios:     list   # filas afectadas en folios_registrados
+    borradores: list   # filas afectadas en borradores_registros
+
+async def transicionar_folios(folios: list[str], estado: str) -> TransicionFolio:
+    """Cambia estado (+ fecha_comprobante) de los folios en ambas tablas."""
+    now = datetime.now().isoformat()
+    if SB_RPC_FOLIOS:
+        r = await supabase.rpc("transicionar_folios", {
+            "p_folios": folios, "p_estado": estado, "p_fecha": now,
+        })
+        res = r.data[0] if r.data else {}
+        return TransicionFolio(res.get("folios") or [], res.get("borradores") or [])
+    cambios = {"estado": estado, "fecha_comprobante": now}
+    r1, r2 = await asyncio.gather(
+        supabase.table("folios_registrados").update(cambios).in_("folio", folios).execute(),
+        supabase.table("borradores_registros").update(cambios).in_("folio", folios).execute(),
+    )
+    return TransicionFolio(r1.data, r2.data)
+
+async def transicionar_folio(folio: str, estado: str) -> TransicionFolio:
+    return await transicionar_folios([folio], estado)
 
-# ============ FOLIOS PÁGINA 2 =================================================
+async def eliminar_folios_db(folios: list[str], estado: str | None = None) -> TransicionFolio:
+    """
+    Borra los folios de ambas tablas en un solo round trip. Con `estado`
+    solo se borran los que siguen en ese estado en folios_registrados (y
+    sus borradores): un folio pagado entre la consulta y el borrado se
+    respeta.
+    """
+    if SB_RPC_FOLIOS:
+        r = await supabase.rpc("eliminar_folios", {"p_folios": folios, "p_estado": estado})
+        res = r.data[0] if r.data else {}
+        return TransicionFolio(res.get("folios") or [], res.get("borradores") or [])
+    if estado is None:
+        r1, r2 = await asyncio.gather(
+            supabase.table("folios_registrados").delete().in_("folio", folios).execute(),
+            supabase.table("borradores_registros").delete().in_("folio", folios).execute(),
+        )
+        return TransicionFolio(r1.data, r2.data)
+    r1 = await supabase.table("folios_registrados").delete().in_("folio", folios).eq("estado", estado).execute()
+    borrados = [f["folio"] for f in r1.data]
+    if not borrados:
+        return TransicionFolio([], [])
+    r2 = await supabase.table("borradores_registros").delete().in_("folio", borrados).execute()
+    return TransicionFolio(r1.data, r2.data)
+
+# ============ CONTADORES DE DOCUMENTO ========================================
+# Folio DVM (página 1) y folios de página 2 en un solo SQLite WAL compartido
+# por todos los procesos (CONTADORES_PATH). Cada reserva es un único
+# UPDATE … RETURNING sobre todas las filas: atómico entre hilos y workers.
+# La escritura corre en un _EscritorSQLite propio (igual que el almacén
+# compartido), así un worker con el lock no congela el loop de los demás.
+# Con CONTADORES_BLOQUE > 1 cada proceso reserva bloques y reparte desde
+# memoria sin salir del loop. La primera vez se siembra desde
+# folios_pagina2.json / folio_representativo.txt.
+
+CONTADORES_PATH    = os.getenv("CONTADORES_PATH", "contadores.db")
+CONTADORES_BLOQUE  = max(1, int(os.getenv("CONTADORES_BLOQUE", "1")))
+CONTADORES_PAGINA2 = ("referencia_pago", "num_autorizacion", "folio_seguimiento", "linea_captura")
 
 def _leer_folios_pagina2():
     try:
@@ -270,1301 +1648,533 @@ def _leer_folios_pagina2():
             "linea_captura":     41340816,
         }
 
-def _guardar_folios_pagina2(folios: dict):
-    try:
-        with open("folios_pagina2.json", "w") as f:
-            json.dump(folios, f)
-    except Exception as e:
-        print(f"[WARN] No se pudo persistir folios página 2: {e}")
-
-def _incrementar_sufijo_alfabetico(sufijo: str) -> str:
-    chars = list(sufijo)
-    for i in range(len(chars)-1, -1, -1):
-        if chars[i] == 'z':
-            chars[i] = 'a'
-        else:
-            chars[i] = chr(ord(chars[i]) + 1)
-            break
-    return ''.join(chars)
-
-def _incrementar_alfanumerico(codigo: str) -> str:
-    match = re.match(r'(\D*)(\d+)([a-z]+)(\d+)$', codigo)
-    if match:
-        prefijo = match.group(1)
-        numero  = match.group(2)
-        letras  = match.group(3)
-        digito  = int(match.group(4)) + 1
-        if digito > 9:
-            digito = 0
-            letras = _incrementar_sufijo_alfabetico(letras)
-        return f"{prefijo}{numero}{letras}{digito}"
-    return codigo[:-1] + str((int(codigo[-1]) + 1) % 10)
-
-def generar_folios_pagina2() -> dict:
-    folios = _leer_folios_pagina2()
-    folios["referencia_pago"]   += 1
-    folios["num_autorizacion"]  += 1
-    folios["folio_seguimiento"]  = _incrementar_alfanumerico(folios["folio_seguimiento"])
-    folios["linea_captura"]     += 1
-    _guardar_folios_pagina2(folios)
-    return folios
-
-# ============ FOLIO REPRESENTATIVO ===========================================
-
-def obtener_folio_representativo():
+def _leer_folio_representativo() -> int:
     try:
         with open("folio_representativo.txt") as f:
             return int(f.read().strip())
-    except FileNotFoundError:
-        folio_inicial = 21385
-        with open("folio_representativo.txt", "w") as f:
-            f.write(str(folio_inicial))
-        return folio_inicial
-    except Exception as e:
-        print(f"[ERROR] Leyendo folio representativo: {e}")
+    except Exception:
         return 21385
 
-def incrementar_folio_representativo(folio_actual):
-    try:
-        nuevo = folio_actual + 1
-        with open("folio_representativo.txt", "w") as f:
-            f.write(str(nuevo))
-        return nuevo
-    except Exception as e:
-        print(f"[ERROR] Incrementando folio representativo: {e}")
-        return folio_actual + 1
+def _semillas_contadores() -> dict:
+    """nombre → (último valor emitido, código base si es alfanumérico)."""
+    fp2 = _leer_folios_pagina2()
+    semillas = {n: (int(fp2[n]), None)
+                for n in ("referencia_pago", "num_autorizacion", "linea_captura")}
+    # folio_seguimiento guarda pasos desde el código base, no el código
+    semillas["folio_seguimiento"] = (0, fp2["folio_seguimiento"])
+    # El .txt guardaba el PRÓXIMO folio DVM; aquí se guarda el último emitido
+    semillas["folio_dvm"] = (_leer_folio_representativo() - 1, None)
+    return semillas
+
+def _avanzar_alfanumerico(codigo: str, pasos: int) -> str:
+    """
+    Avanza un código tipo GZUdr61oqv2 `pasos` veces: el dígito final de
+    0 a 9 y al pasar de 9 acarrea en las letras (a–z, con vuelta).
+    """
+    match = re.match(r'(\D*)(\d+)([a-z]+)(\d)$', codigo)
+    if match:
+        prefijo, numero, letras, digito = match.groups()
+        valor = 0
+        for c in letras:
+            valor = valor * 26 + ord(c) - ord('a')
+        valor = (valor * 10 + int(digito) + pasos) % (26 ** len(letras) * 10)
+        valor, digito = divmod(valor, 10)
+        chars = []
+        for _ in letras:
+            valor, r = divmod(valor, 26)
+            chars.append(chr(ord('a') + r))
+        return f"{prefijo}{numero}{''.join(reversed(chars))}{digito}"
+    return codigo[:-1] + str((int(codigo[-1]) + pasos) % 10)
+
+class ContadoresDocumento:
+    """Contadores atómicos con reserva por lotes sobre SQLite WAL."""
+
+    def __init__(self, ruta: str, bloque: int = 1):
+        self._ruta     = ruta
+        self._bloque   = bloque
+        self._escritor = None
+        self._listo    = False
+        self._lock     = threading.Lock()
+        self._codigos  = {}   # nombre → código base de los alfanuméricos
+        self._locales  = {}   # nombre → [siguiente, fin] del bloque en memoria
+
+    def _hilo(self) -> _EscritorSQLite:
+        # Perezoso: los procesos del pool de render importan app y no lo usan
+        if self._escritor is None:
+            self._escritor = _EscritorSQLite(self._ruta)
+        return self._escritor
+
+    def _preparar(self, con: sqlite3.Connection):
+        con.execute(
+            "CREATE TABLE IF NOT EXISTS contadores ("
+            " nombre TEXT PRIMARY KEY, valor INTEGER NOT NULL, codigo TEXT)"
+        )
+        con.executemany(
+            "INSERT OR IGNORE INTO contadores (nombre, valor, codigo) VALUES (?, ?, ?)",
+            [(n, v, c) for n, (v, c) in _semillas_contadores().items()]
+        )
+        self._codigos = dict(con.execute(
+            "SELECT nombre, codigo FROM contadores WHERE codigo IS NOT NULL"
+        ).fetchall())
+        self._listo = True
+        log.info("[CONTADORES] SQLite WAL: %s (bloque %s)", self._ruta, self._bloque)
+
+    def _tomar(self, nombres) -> dict | None:
+        """Valores desde los bloques en memoria; None si alguno está agotado."""
+        with self._lock:
+            if not self._listo or any(
+                n not in self._locales or self._locales[n][0] > self._locales[n][1]
+                for n in nombres
+            ):
+                return None
+            valores = {}
+            for n in nombres:
+                valores[n] = self._locales[n][0]
+                self._locales[n][0] += 1
+            return valores
+
+    def _reservar(self, nombres) -> dict:
+        """Corre en el hilo escritor: un solo UPDATE … RETURNING para lo que falte."""
+        con = self._escritor.con
+        with self._lock:
+            if not self._listo:
+                self._preparar(con)
+            faltan = [n for n in nombres
+                      if n not in self._locales or self._locales[n][0] > self._locales[n][1]]
+            if faltan:
+                filas = con.execute(
+                    f"UPDATE contadores SET valor = valor + ? "
+                    f"WHERE nombre IN ({','.join('?' * len(faltan))}) RETURNING nombre, valor",
+                    (self._bloque, *faltan)
+                ).fetchall()
+                for nombre, fin in filas:
+                    self._locales[nombre] = [fin - self._bloque + 1, fin]
+            valores = {}
+            for n in nombres:
+                bloque = self._locales[n]
+                valores[n] = bloque[0]
+                bloque[0] += 1
+            return valores
+
+    async def reservar(self, nombres) -> dict:
+        """
+        Siguiente valor de cada contador en `nombres`. Si el bloque en memoria
+        alcanza no hay E/S; si no, la escritura va al hilo escritor (como el
+        almacén compartido) y el loop no espera el lock de SQLite.
+        """
+        valores = self._tomar(nombres)
+        if valores is None:
+            valores = await self._hilo()(self._reservar, nombres)
+        for n, codigo in self._codigos.items():
+            if n in valores:
+                valores[n] = _avanzar_alfanumerico(codigo, valores[n])
+        return valores
+
+contadores_documento = ContadoresDocumento(CONTADORES_PATH, CONTADORES_BLOQUE)
+
+async def generar_folios_pagina2() -> dict:
+    return await contadores_documento.reservar(CONTADORES_PAGINA2)
+
+async def reservar_contadores_render() -> tuple[int, dict]:
+    """Folio DVM y folios de página 2 de un permiso, en una sola reserva."""
+    valores = await contadores_documento.reservar(("folio_dvm",) + CONTADORES_PAGINA2)
+    return valores.pop("folio_dvm"), valores
 
 # ============ TIMERS 36H =====================================================
+# Un solo scheduler para todos los folios: cada folio tiene UNA entrada en un
+# heap de deadlines absolutos (su próxima etapa). Cancelar es O(1): se borra
+# de timers_activos y la entrada del heap queda obsoleta (se descarta al salir
+# o en la compactación). timers_activos vive en el almacén compartido; cada
+# proceso solo agenda los folios que creó, y la expiración se "reclama" con
+# un pop atómico para que nunca se ejecute dos veces.
+
+# (segundos desde el inicio, minutos restantes) — 0 = eliminación
+ETAPAS_TIMER = (
+    (34.5 * 3600,         90),
+    (35.0 * 3600,         60),
+    (35.5 * 3600,         30),
+    (35.0 * 3600 + 50*60, 10),
+    (36.0 * 3600,          0),
+)
+
+_timer_heap      = []       # (deadline epoch, seq, folio, etapa)
+_timer_seq       = itertools.count()
+_timer_compactando = False
+_timer_despertar = asyncio.Event()
+_timer_task      = None
+_timer_envios    = set()
 
-timers_activos       = {}
-user_folios          = {}
-pending_comprobantes = {}
-
-async def eliminar_folio_automatico(folio: str):
+async def enviar_recordatorio(folio: str, minutos_restantes: int):
     try:
-        user_id = timers_activos.get(folio, {}).get("user_id")
-        await asyncio.to_thread(lambda: (
-            supabase.table("folios_registrados").delete().eq("folio", folio).execute(),
-            supabase.table("borradores_registros").delete().eq("folio", folio).execute(),
-        ))
-        if user_id:
+        if folio not in timers_activos:
+            return
+        user_id = timers_activos[folio].user_id
+        with prioridad_envio(PRIORIDAD_BAJA):
             await bot.send_message(
                 user_id,
-                f"⏰ TIEMPO AGOTADO - ESTADO DE JALISCO\n\n"
-                f"El folio {folio} ha sido eliminado por no completar el pago en 36 horas.\n\n"
+                f"⚡ RECORDATORIO DE PAGO - JALISCO\n\n"
+                f"Folio: {folio}\n"
+                f"Tiempo restante: {minutos_restantes} minutos\n"
+                f"Monto: ${PRECIO_PERMISO}\n\n"
+                f"📸 Envíe su comprobante de pago (imagen).\n\n"
                 f"📋 Para generar otro permiso use /chuleta"
             )
-        limpiar_timer_folio(folio)
     except Exception as e:
-        print(f"Error eliminando folio {folio}: {e}")
+        log.error("Error enviando recordatorio para folio %s: %s", folio, e)
 
-async def enviar_recordatorio(folio: str, minutos_restantes: int):
+def _programar_etapa(folio: str, timer: TimerFolio, etapa: int):
+    """
+    Empuja la próxima etapa del folio. Si ya pasaron varias (arranque tardío),
+    salta los recordatorios vencidos y deja solo la última etapa alcanzada.
+    """
+    inicio = timer.start_time.timestamp()
+    ahora  = time.time()
+    while etapa < len(ETAPAS_TIMER) - 1 and inicio + ETAPAS_TIMER[etapa + 1][0] <= ahora:
+        etapa += 1
+    deadline = inicio + ETAPAS_TIMER[etapa][0]
+    if not _timer_heap or deadline < _timer_heap[0][0]:
+        _timer_despertar.set()
+    heapq.heappush(_timer_heap, (deadline, timer.seq, folio, etapa))
+
+async def _compactar_timers():
+    """
+    Descarta entradas de folios cancelados cuando superan a las vigentes.
+    Los seq vigentes se consultan en lote (con SQLite, en el hilo escritor);
+    lo agendado mientras tanto se conserva.
+    """
+    global _timer_heap, _timer_compactando
+    if _timer_compactando or len(_timer_heap) <= 2 * len(timers_activos) + 64:
+        return
+    _timer_compactando = True
     try:
-        if folio not in timers_activos:
-            return
-        user_id = timers_activos[folio]["user_id"]
-        await bot.send_message(
-            user_id,
-            f"⚡ RECORDATORIO DE PAGO - JALISCO\n\n"
-            f"Folio: {folio}\n"
-            f"Tiempo restante: {minutos_restantes} minutos\n"
-            f"Monto: ${PRECIO_PERMISO}\n\n"
-            f"📸 Envíe su comprobante de pago (imagen).\n\n"
-            f"📋 Para generar otro permiso use /chuleta"
-        )
-    except Exception as e:
-        print(f"Error enviando recordatorio para folio {folio}: {e}")
+        revisadas = {(e[2], e[1]) for e in _timer_heap}
+        vigentes  = await timers_activos.vigentes({f for f, _ in revisadas})
+        _timer_heap = [e for e in _timer_heap
+                       if (e[2], e[1]) not in revisadas or vigentes.get(e[2]) == e[1]]
+        heapq.heapify(_timer_heap)
+    finally:
+        _timer_compactando = False
 
-async def iniciar_timer_eliminacion(user_id: int, folio: str):
-    async def timer_task():
-        print(f"[TIMER] Iniciado folio {folio}, usuario {user_id} (36h)")
-        await asyncio.sleep(34.5 * 3600)
-        if folio not in timers_activos: return
-        await enviar_recordatorio(folio, 90)
-        await asyncio.sleep(30 * 60)
-        if folio not in timers_activos: return
-        await enviar_recordatorio(folio, 60)
-        await asyncio.sleep(30 * 60)
-        if folio not in timers_activos: return
-        await enviar_recordatorio(folio, 30)
-        await asyncio.sleep(20 * 60)
-        if folio not in timers_activos: return
-        await enviar_recordatorio(folio, 10)
-        await asyncio.sleep(10 * 60)
-        if folio in timers_activos:
-            print(f"[TIMER] Expirado folio {folio} - eliminando")
-            await eliminar_folio_automatico(folio)
+def _disparar(coro):
+    tarea = asyncio.create_task(coro)
+    _timer_envios.add(tarea)
+    tarea.add_done_callback(_timer_envios.discard)
 
-    task = asyncio.create_task(timer_task())
-    timers_activos[folio] = {"task": task, "user_id": user_id, "start_time": datetime.now()}
-    user_folios.setdefault(user_id, []).append(folio)
-    print(f"[SISTEMA] Timer 36h iniciado folio {folio}, total: {len(timers_activos)}")
+async def _scheduler_timers():
+    log.info("[TIMER] Scheduler iniciado")
+    while True:
+        _timer_despertar.clear()
+        ahora = time.time()
+        while _timer_heap and _timer_heap[0][0] <= ahora:
+            _, seq, folio, etapa = heapq.heappop(_timer_heap)
+            timer = timers_activos.get(folio)
+            if timer is None or timer.seq != seq:
+                continue
+            minutos = ETAPAS_TIMER[etapa][1]
+            with campos_log(folio=folio, user_id=timer.user_id):
+                if minutos:
+                    _disparar(enviar_recordatorio(folio, minutos))
+                    _programar_etapa(folio, timer, etapa + 1)
+                elif await timers_activos.sacar(folio) is not None:
+                    # Reclamado (pop atómico); el borrado va en lote en el barrido
+                    log.info("[TIMER] Expirado folio %s - al barrido", folio)
+                    _expirados_locales[folio] = timer.user_id
+                    _barrido_despertar.set()
+        espera = _timer_heap[0][0] - time.time() if _timer_heap else None
+        with suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(_timer_despertar.wait(), espera)
+
+def _asegurar_scheduler():
+    global _timer_task
+    if _timer_task is None or _timer_task.done():
+        _timer_task = asyncio.create_task(_scheduler_timers())
+
+def _nuevo_timer(user_id: int, inicio: datetime) -> TimerFolio:
+    # seq único entre procesos: el último que escribe el folio es su dueño
+    return TimerFolio(user_id, inicio, (os.getpid() << 32) | next(_timer_seq))
 
-def cancelar_timer_folio(folio: str):
-    if folio in timers_activos:
-        timers_activos[folio]["task"].cancel()
-        user_id = timers_activos[folio]["user_id"]
-        del timers_activos[folio]
-        if user_id in user_folios and folio in user_folios[user_id]:
-            user_folios[user_id].remove(folio)
-            if not user_folios[user_id]:
-                del user_folios[user_id]
-        print(f"[SISTEMA] Timer cancelado folio {folio}")
-
-def limpiar_timer_folio(folio: str):
-    if folio in timers_activos:
-        user_id = timers_activos[folio]["user_id"]
-        del timers_activos[folio]
-        if user_id in user_folios and folio in user_folios[user_id]:
-            user_folios[user_id].remove(folio)
-            if not user_folios[user_id]:
-                del user_folios[user_id]
+async def iniciar_timer_eliminacion(user_id: int, folio: str):
+    _asegurar_scheduler()
+    timer = _nuevo_timer(user_id, datetime.now())
+    await timers_activos.asignar(folio, timer)
+    _programar_etapa(folio, timer, 0)
+    log.info("[SISTEMA] Timer 36h iniciado folio %s, total: %s", folio, len(timers_activos))
+
+async def cancelar_timer_folio(folio: str):
+    if await timers_activos.sacar(folio) is not None:
+        await _compactar_timers()
+        log.info("[SISTEMA] Timer cancelado folio %s", folio)
+
+async def cancelar_timers(folios) -> dict[str, int]:
+    """Cancela varios timers en una pasada; devuelve folio → user_id de los que estaban activos."""
+    cancelados = {f: t.user_id for f, t in (await timers_activos.sacar_varios(folios)).items()}
+    if cancelados:
+        await _compactar_timers()
+        log.info("[SISTEMA] %s timers cancelados", len(cancelados))
+    return cancelados
 
 def obtener_folios_usuario(user_id: int) -> list:
-    return user_folios.get(user_id, [])
-
-# ============ COORDENADAS PDF =================================================
-
-coords_jalisco = {
-    "marca":     (340, 332, 14, (0,0,0)),
-    "serie":     (920, 332, 14, (0,0,0)),
-    "linea":     (340, 360, 14, (0,0,0)),
-    "anio":      (340, 389, 14, (0,0,0)),
-    "color":     (340, 418, 14, (0,0,0)),
-    "nombre":    (340, 304, 14, (0,0,0)),
-    "fecha_ven": (285, 570, 90, (0,0,0)),
-}
-
-coords_pagina2 = {
-    "referencia_pago":   (380, 123, 10, (0,0,0)),
-    "num_autorizacion":  (380, 147, 10, (0,0,0)),
-    "total_pagado":      (380, 170, 10, (0,0,0)),
-    "folio_seguimiento": (380, 243, 10, (0,0,0)),
-    "linea_captura":     (380, 265, 10, (0,0,0)),
-}
-
-# ============ QR PRINCIPAL ====================================================
-
-def _generar_qr_jalisco(folio: str):
+    return timers_activos.de_usuario(user_id)
+
+# ── recarga al arrancar ───────────────────────────────────────────────────────
+# Tras un deploy o caída los timers en memoria se pierden. Se recorren los
+# folios PENDIENTE de folios_registrados por páginas (keyset sobre folio,
+# sin OFFSET) en una tarea de fondo: el webhook atiende desde el primer
+# momento y cada página queda agendada en cuanto llega. El inicio exacto
+# sale de borradores_registros (timestamp completo); si no hay borrador se
+# usa el fin del día de fecha_expedicion, así nunca se expira antes de
+# tiempo. Los folios cuyo plazo ya venció se eliminan al pasar por el
+# scheduler.
+
+RECARGA_TIMERS = os.getenv("RECARGA_TIMERS", "1") == "1"
+RECARGA_PAGINA = int(os.getenv("RECARGA_PAGINA", "1000"))
+
+_recarga_task  = None
+_recarga_stats = {"estado": "pendiente", "folios": 0, "paginas": 0, "vencidos": 0, "segundos": 0.0}
+
+def _fecha_local(valor) -> datetime | None:
+    """ISO de Supabase → datetime local sin zona (como datetime.now())."""
+    if not valor:
+        return None
     try:
-        url = f"{URL_CONSULTA_BASE}/consulta/{folio}"
-        qr  = qrcode.QRCode(version=2, error_correction=qrcode.constants.ERROR_CORRECT_M,
-                            box_size=4, border=1)
-        qr.add_data(url)
-        qr.make(fit=True)
-        img = qr.make_image(fill_color="black", back_color=(220,220,220)).convert("RGB")
-        print(f"[QR] Generado para folio {folio}")
-        return img
-    except Exception as e:
-        print(f"[ERROR QR] {e}")
+        fecha = datetime.fromisoformat(str(valor).replace("Z", "+00:00"))
+    except ValueError:
         return None
-
-# ============ PDF417 TAMAÑO FIJO =============================================
-
-def _generar_pdf417(datos: dict) -> Image.Image | None:
-    """
-    PDF417 con pdf417gen.
-    Contenido: CAMPO  valor  CAMPO  valor  ...  URL
-    Tamaño final SIEMPRE PDF417_W x PDF417_H via resize().
-    keep_proportion=False en PyMuPDF garantiza que llene el rect exacto.
-    Síncrono — usar con asyncio.to_thread.
-    """
-    url_consulta = f"{URL_CONSULTA_BASE}/consulta/{datos['folio']}"
-
-    texto = (
-        f"MARCA  {datos['marca']}  "
-        f"LINEA  {datos['linea']}  "
-        f"ANO  {datos['anio']}  "
-        f"SERIE  {datos['serie']}  "
-        f"MOTOR  {datos['motor']}  "
-        f"COLOR  {datos['color']}  "
-        f"TITULAR  {datos['nombre']}  "
-        f"FOLIO  {datos['folio']}  "
-        f"{url_consulta}"
+    return fecha.astimezone().replace(tzinfo=None) if fecha.tzinfo else fecha
+
+async def _pagina_pendientes(despues_de: str | None) -> list[dict]:
+    consulta = (
+        supabase.table("folios_registrados")
+        .select("folio,user_id,fecha_expedicion")
+        .eq("entidad", "Jalisco")
+        .eq("estado", "PENDIENTE")
     )
-
-    if PDF417_DISPONIBLE:
+    if despues_de is not None:
+        consulta = consulta.gt("folio", despues_de)
+    # El builder acumula parámetros: order/limit una sola vez, fuera de los reintentos
+    consulta = consulta.order("folio").limit(RECARGA_PAGINA)
+    for intento in range(3):
         try:
-            codes = pdf417gen.encode(texto, columns=10, security_level=2)
-            img   = pdf417gen.render_image(codes, scale=2, ratio=3)
-            img   = img.convert("RGB")
-
-            # Fondo gris claro, barras negras
-            px  = img.load()
-            out = Image.new("RGB", img.size, (220, 220, 220))
-            ox  = out.load()
-            for y in range(img.height):
-                for x in range(img.width):
-                    p = px[x, y]
-                    if (sum(p[:3]) if isinstance(p, tuple) else p) < 384:
-                        ox[x, y] = (0, 0, 0)
-
-            # Resize fijo — siempre mismo tamaño sin importar el contenido
-            img_final = out.resize((PDF417_W, PDF417_H), Image.LANCZOS)
-            print(f"[PDF417] Generado {PDF417_W}x{PDF417_H}px ✅")
-            return img_final
-
+            r = await consulta.execute()
+            return r.data
         except Exception as e:
-            print(f"[ERROR PDF417] {e} — usando QR fallback")
-
-    # Fallback QR estirado
-    try:
-        qr = qrcode.QRCode(version=4, error_correction=qrcode.constants.ERROR_CORRECT_L,
-                           box_size=2, border=1)
-        qr.add_data(texto)
-        qr.make(fit=True)
-        img = qr.make_image(fill_color="black", back_color="white").convert("RGB")
-        img = img.resize((PDF417_W, PDF417_H), Image.NEAREST)
-        print(f"[QR FALLBACK] Generado {PDF417_W}x{PDF417_H}px")
-        return img
-    except Exception as e:
-        print(f"[ERROR QR FALLBACK] {e}")
-        return None
-
-# ============ FSM =============================================================
-
-class PermisoForm(StatesGroup):
-    marca  = State()
-    linea  = State()
-    anio   = State()
-    serie  = State()
-    motor  = State()
-    color  = State()
-    nombre = State()
-
-# ============ GENERACIÓN PDF ==================================================
-
-def _generar_pdf_unificado(datos: dict) -> str:
-    fol       = datos["folio"]
-    fecha_exp = datos["fecha_exp"]
-    fecha_ven = datos["fecha_ven"]
-
-    zona_mexico = pytz.timezone("America/Mexico_City")
-    ahora_cdmx  = datetime.now(zona_mexico)
-
-    os.makedirs(OUTPUT_DIR, exist_ok=True)
-    out = os.path.join(OUTPUT_DIR, f"{fol}_completo.pdf")
+            log.warning("[RECARGA] Página tras %s falló (%s): %s", despues_de, intento + 1, e)
+            await asyncio.sleep(1 + intento)
+    raise RuntimeError(f"No se pudo leer la página de pendientes tras {despues_de}")
 
+async def _inicios_exactos(folios: list[str]) -> dict[str, datetime]:
     try:
-        doc1 = fitz.open(stream=_plantilla1_bytes, filetype="pdf")
-        pg1  = doc1[0]
-
-        for campo in ["marca", "linea", "anio", "serie", "nombre", "color"]:
-            if campo in coords_jalisco and campo in datos:
-                x, y, s, col = coords_jalisco[campo]
-                pg1.insert_text((x, y), datos[campo], fontsize=s, color=col, fontname="hebo")
-
-        pg1.insert_text(
-            coords_jalisco["fecha_ven"][:2],
-            fecha_ven.strftime("%d/%m/%Y"),
-            fontsize=coords_jalisco["fecha_ven"][2],
-            color=coords_jalisco["fecha_ven"][3]
-        )
-
-        pg1.insert_text((860, 364), fol, fontsize=14, color=(0,0,0), fontname="hebo")
-        pg1.insert_text((475, 830), fecha_exp.strftime("%d/%m/%Y"),
-                        fontsize=32, color=(0,0,0), fontname="hebo")
-
-        fol_rep      = obtener_folio_representativo()
-        folio_grande = f"4A-DVM/{fol_rep}"
-        pg1.insert_text((240, 830), folio_grande, fontsize=32, color=(0,0,0), fontname="hebo")
-        pg1.insert_text((480, 182), folio_grande, fontsize=63, color=(0,0,0), fontname="hebo")
-
-        folio_chico = (
-            f"DVM-{fol_rep}   "
-            f"{ahora_cdmx.strftime('%d/%m/%Y')}  "
-            f"{ahora_cdmx.strftime('%H:%M:%S')}"
-        )
-        pg1.insert_text((915, 760), folio_chico, fontsize=14, color=(0,0,0), fontname="hebo")
-        incrementar_folio_representativo(fol_rep)
-
-        pg1.insert_text((935, 600), f"*{fol}*", fontsize=30, color=(0,0,0), fontname="Courier")
-        pg1.insert_text((915, 775), "EXPEDICION: VENTANILLA 32",
-                        fontsize=12, color=(0,0,0), fontname="hebo")
-
-        # ── QR cuadrado ──
-        img_qr = _generar_qr_jalisco(fol)
-        if img_qr:
-            buf = BytesIO()
-            img_qr.save(buf, format="PNG")
-            buf.seek(0)
-            pg1.insert_image(
-                fitz.Rect(
-                    coords_qr_dinamico["x"],
-                    coords_qr_dinamico["y"],
-                    coords_qr_dinamico["x"] + coords_qr_dinamico["ancho"],
-                    coords_qr_dinamico["y"] + coords_qr_dinamico["alto"]
-                ),
-                pixmap=fitz.Pixmap(buf.read()),
-                overlay=True
-            )
-            print("[QR] Insertado ✅")
-
-        # ── PDF417 rectangular tamaño fijo ──
-        img_pdf417 = _generar_pdf417(datos)
-        if img_pdf417:
-            buf2 = BytesIO()
-            img_pdf417.save(buf2, format="PNG")
-            buf2.seek(0)
-            pg1.insert_image(
-                RECT_PDF417,
-                pixmap=fitz.Pixmap(buf2.read()),
-                keep_proportion=False,
-                overlay=True
-            )
-            print("[PDF417] Insertado ✅")
-
-        # ── Página 2 ──
-        doc2 = fitz.open(stream=_plantilla2_bytes, filetype="pdf")
-        pg2  = doc2[0]
-
-        pg2.insert_text((380, 195), fecha_exp.strftime("%d/%m/%Y %H:%M"),
-                        fontsize=10, fontname="helv", color=(0,0,0))
-        pg2.insert_text((380, 290), datos["serie"],
-                        fontsize=10, fontname="helv", color=(0,0,0))
-
-        fp2 = generar_folios_pagina2()
-        pg2.insert_text(coords_pagina2["referencia_pago"][:2],
-                        str(fp2["referencia_pago"]),
-                        fontsize=coords_pagina2["referencia_pago"][2],
-                        color=coords_pagina2["referencia_pago"][3])
-        pg2.insert_text(coords_pagina2["num_autorizacion"][:2],
-                        str(fp2["num_autorizacion"]),
-                        fontsize=coords_pagina2["num_autorizacion"][2],
-                        color=coords_pagina2["num_autorizacion"][3])
-        pg2.insert_text(coords_pagina2["total_pagado"][:2],
-                        f"${PRECIO_FIJO_PAGINA2}.00 MN",
-                        fontsize=coords_pagina2["total_pagado"][2],
-                        color=coords_pagina2["total_pagado"][3])
-        pg2.insert_text(coords_pagina2["folio_seguimiento"][:2],
-                        fp2["folio_seguimiento"],
-                        fontsize=coords_pagina2["folio_seguimiento"][2],
-                        color=coords_pagina2["folio_seguimiento"][3])
-        pg2.insert_text(coords_pagina2["linea_captura"][:2],
-                        str(fp2["linea_captura"]),
-                        fontsize=coords_pagina2["linea_captura"][2],
-                        color=coords_pagina2["linea_captura"][3])
-
-        doc_final = fitz.open()
-        doc_final.insert_pdf(doc1)
-        doc_final.insert_pdf(doc2)
-        doc_final.save(out)
-        doc_final.close()
-        doc1.close()
-        doc2.close()
-
-        print(f"[PDF UNIFICADO] ✅ {out}")
-
+        respuestas = await asyncio.gather(*(
+            supabase.table("borradores_registros")
+            .select("folio,fecha_expedicion")
+            .in_("folio", trozo)
+            .execute()
+            for trozo in _trozos(folios, SB_IN_MAX)
+        ))
     except Exception as e:
-        print(f"[ERROR] Generando PDF: {e}")
-        doc_fb = fitz.open()
-        doc_fb.new_page().insert_text((50, 50), f"ERROR - Folio: {fol}", fontsize=12)
-        doc_fb.save(out)
-        doc_fb.close()
-
-    return out
-
-# ============ BACKGROUND ======================================================
-
-async def _generar_y_enviar_background(chat_id: int, datos: dict, user_id: int):
+        log.warning("[RECARGA] Sin borradores para %s folios, se usa la fecha: %s", len(folios), e)
+        return {}
+    inicios = {}
+    for fila in (f for r in respuestas for f in r.data):
+        inicio = _fecha_local(fila.get("fecha_expedicion"))
+        if inicio is not None:
+            inicios[fila["folio"]] = inicio
+    return inicios
+
+async def recargar_timers_pendientes():
+    t0 = time.perf_counter()
+    _recarga_stats.update(estado="en_curso", folios=0, paginas=0, vencidos=0)
+    _asegurar_scheduler()
+    ahora = time.time()
+    despues_de = None
     try:
-        fecha_ven   = datos["fecha_ven"]
-        pdf_path    = await asyncio.to_thread(_generar_pdf_unificado, datos)
-        folio_final = datos["folio"]
-
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[[
-            InlineKeyboardButton(text="🔑 Validar Admin", callback_data=f"validar_{folio_final}"),
-            InlineKeyboardButton(text="⏹️ Detener Timer", callback_data=f"detener_{folio_final}")
-        ]])
-
-        await bot.send_document(
-            chat_id,
-            FSInputFile(pdf_path),
-            caption=(
-                f"📋 PERMISO DE CIRCULACIÓN - JALISCO\n"
-                f"Folio: {folio_final}\nVigencia: 30 días ({fecha_ven.strftime('%d/%m/%Y')})\n\n"
-                f"✅ Documento con 2 páginas unificadas\n⏰ TIMER ACTIVO (36 horas)"
-            ),
-            reply_markup=keyboard
-        )
-
-        try:
-            await asyncio.to_thread(_sb_insertar_borrador, datos, user_id)
-        except Exception as e:
-            print(f"[WARN] Error guardando borradores: {e}")
-
-        await iniciar_timer_eliminacion(user_id, folio_final)
-
-        await bot.send_message(
-            user_id,
-            "💰 INSTRUCCIONES DE PAGO\n\n"
-            f"📄 Folio: {folio_final}\n"
-            f"💵 Monto: ${PRECIO_PERMISO}\n"
-            "⏰ Tiempo límite: 36 horas\n\n"
-            "🏦 TRANSFERENCIA:\n"
-            "• Institución: SPIN BY OXXO\n"
-            "• Titular: GUILLERMO S.R\n"
-            "• Cuenta: 728969000048442454\n"
-            f"• Concepto: Permiso {folio_final}\n\n"
-            "🏪 OXXO:\n"
-            "• Referencia: 2242170180214090\n"
-            "• Titular: GUILLERMO S.R\n\n"
-            "📸 Envía foto del comprobante para validar.\n"
-            "⚠️ Sin pago en 36h el folio se elimina.\n\n"
-            "📋 Para generar otro permiso use /chuleta"
-        )
-
-    except Exception as e:
-        print(f"[ERROR] background folio {datos.get('folio','?')}: {e}")
-        try:
-            await bot.send_message(user_id,
-                f"❌ Error al generar el documento: {e}\n\nUse /chuleta para reintentar.")
-        except Exception:
-            pass
-
-# ============ HANDLERS ========================================================
-
-@dp.message(Command("start"))
-async def start_cmd(message: types.Message, state: FSMContext):
-    await state.clear()
-    await message.answer(
-        "🏛️ SISTEMA DIGITAL DEL ESTADO DE JALISCO\n\n"
-        f"💰 Costo: ${PRECIO_PERMISO}\n"
-        "⏰ Tiempo límite: 36 horas\n\n"
-        "⚠️ Su folio será eliminado si no paga dentro del tiempo límite"
-    )
-
-@dp.message(Command("chuleta"))
-async def chuleta_cmd(message: types.Message, state: FSMContext):
-    await state.clear()
-    folios_activos = obtener_folios_usuario(message.from_user.id)
-
-    if folios_activos:
-        lineas = []
-        for f in folios_activos:
-            if f in timers_activos:
-                mins = max(0, 2160 - int(
-                    (datetime.now() - timers_activos[f]["start_time"]).total_seconds() / 60
-                ))
-                lineas.append(f"• {f}  ({mins//60}h {mins%60}min restantes)")
-            else:
-                lineas.append(f"• {f}  (sin timer)")
-        botones = [
-            [InlineKeyboardButton(text=f"⏹️ Detener {f}", callback_data=f"detener_{f}")]
-            for f in folios_activos
-        ]
-        await message.answer(
-            f"📋 FOLIOS JALISCO ACTIVOS ({len(folios_activos)}):\n\n" +
-            "\n".join(lineas) + "\n\nPuedes detener el timer de cualquier folio:",
-            reply_markup=InlineKeyboardMarkup(inline_keyboard=botones)
-        )
-
-    await message.answer(
-        f"🚗 NUEVO PERMISO - ESTADO DE JALISCO\n\n"
-        f"💰 Costo: ${PRECIO_PERMISO}\n"
-        f"⏰ Plazo de pago: 36 horas\n\n"
-        f"Primer paso: MARCA del vehículo:"
-    )
-    await state.set_state(PermisoForm.marca)
-
-@dp.message(PermisoForm.marca)
-async def get_marca(message: types.Message, state: FSMContext):
-    await state.update_data(marca=message.text.strip().upper())
-    await message.answer("LÍNEA/MODELO del vehículo:")
-    await state.set_state(PermisoForm.linea)
-
-@dp.message(PermisoForm.linea)
-async def get_linea(message: types.Message, state: FSMContext):
-    await state.update_data(linea=message.text.strip().upper())
-    await message.answer("AÑO del vehículo (4 dígitos):")
-    await state.set_state(PermisoForm.anio)
-
-@dp.message(PermisoForm.anio)
-async def get_anio(message: types.Message, state: FSMContext):
-    anio = message.text.strip()
-    if not anio.isdigit() or len(anio) != 4:
-        await message.answer("⚠️ Formato inválido. Use 4 dígitos (ej. 2021):")
-        return
-    await state.update_data(anio=anio)
-    await message.answer("NÚMERO DE SERIE:")
-    await state.set_state(PermisoForm.serie)
-
-@dp.message(PermisoForm.serie)
-async def get_serie(message: types.Message, state: FSMContext):
-    await state.update_data(serie=message.text.strip().upper())
-    await message.answer("NÚMERO DE MOTOR:")
-    await state.set_state(PermisoForm.motor)
-
-@dp.message(PermisoForm.motor)
-async def get_motor(message: types.Message, state: FSMContext):
-    await state.update_data(motor=message.text.strip().upper())
-    await message.answer("COLOR del vehículo:")
-    await state.set_state(PermisoForm.color)
-
-@dp.message(PermisoForm.color)
-async def get_color(message: types.Message, state: FSMContext):
-    await state.update_data(color=message.text.strip().upper())
-    await message.answer("NOMBRE COMPLETO del propietario:")
-    await state.set_state(PermisoForm.nombre)
-
-@dp.message(PermisoForm.nombre)
-async def get_nombre(message: types.Message, state: FSMContext):
-    datos              = await state.get_data()
-    datos["nombre"]    = message.text.strip().upper()
-    hoy                = datetime.now()
-    datos["fecha_exp"] = hoy
-    datos["fecha_ven"] = hoy + timedelta(days=30)
-    await state.clear()
-
-    ok = await guardar_folio_con_reintento(
-        datos, message.from_user.id, message.from_user.username, "1"
-    )
-    if not ok:
-        await message.answer(
-            "❌ No se pudo registrar el folio. Intenta de nuevo con /chuleta\n\n"
-            "📋 Para generar otro permiso use /chuleta"
-        )
-        return
-
-    await message.answer(
-        f"🔄 Generando documentación...\n"
-        f"<b>Folio:</b> {datos['folio']}\n"
-        f"<b>Titular:</b> {datos['nombre']}",
-        parse_mode="HTML"
-    )
-    asyncio.create_task(
-        _generar_y_enviar_background(message.chat.id, datos, message.from_user.id)
-    )
-
-# ============ CALLBACKS =======================================================
-
-@dp.callback_query(lambda c: c.data and c.data.startswith("validar_"))
-async def callback_validar_admin(callback: CallbackQuery):
-    folio = callback.data.replace("validar_", "")
-    if folio in timers_activos:
-        user_con_folio = timers_activos[folio]["user_id"]
-        cancelar_timer_folio(folio)
-        try:
-            now = datetime.now().isoformat()
-            await asyncio.to_thread(lambda: (
-                supabase.table("folios_registrados").update(
-                    {"estado": "VALIDADO_ADMIN", "fecha_comprobante": now}
-                ).eq("folio", folio).execute(),
-                supabase.table("borradores_registros").update(
-                    {"estado": "VALIDADO_ADMIN", "fecha_comprobante": now}
-                ).eq("folio", folio).execute(),
-            ))
-        except Exception as e:
-            print(f"Error actualizando BD folio {folio}: {e}")
-        await callback.answer("✅ Folio validado por administración", show_alert=True)
-        await callback.message.edit_reply_markup(reply_markup=None)
-        try:
-            await bot.send_message(
-                user_con_folio,
-                f"✅ PAGO VALIDADO POR ADMINISTRACIÓN - JALISCO\n"
-                f"Folio: {folio}\nTu permiso está activo.\n\n"
-                f"📋 Para generar otro permiso use /chuleta"
-            )
-        except Exception as e:
-            print(f"Error notificando usuario: {e}")
-    else:
-        await callback.answer("❌ Folio no encontrado en timers activos", show_alert=True)
-
-@dp.callback_query(lambda c: c.data and c.data.startswith("detener_"))
-async def callback_detener_timer(callback: CallbackQuery):
-    folio = callback.data.replace("detener_", "")
-    if folio in timers_activos:
-        cancelar_timer_folio(folio)
-        try:
-            await asyncio.to_thread(lambda:
-                supabase.table("folios_registrados").update(
-                    {"estado": "TIMER_DETENIDO", "fecha_detencion": datetime.now().isoformat()}
-                ).eq("folio", folio).execute()
-            )
-        except Exception as e:
-            print(f"Error actualizando BD: {e}")
-        await callback.answer("⏹️ Timer detenido exitosamente", show_alert=True)
-        await callback.message.edit_reply_markup(reply_markup=None)
-        await callback.message.answer(
-            f"⏹️ TIMER DETENIDO\n\nFolio: {folio}\n"
-            f"El timer de eliminación ha sido detenido.\n\n"
-            f"📋 Para generar otro permiso use /chuleta"
-        )
-    else:
-        await callback.answer("❌ Timer ya no está activo", show_alert=True)
-
-# ============ ADMIN SERO ======================================================
-
-@dp.message(lambda m: m.text and m.text.strip().upper().startswith("SERO"))
-async def codigo_admin(message: types.Message):
-    texto = message.text.strip().upper()
-    if len(texto) <= 4:
-        await message.answer(
-            "⚠️ Formato: SERO[folio]\nEjemplo: SERO980000000\n\n"
-            "📋 Para generar otro permiso use /chuleta"
-        )
-        return
-    folio_admin = texto[4:]
-    if folio_admin in timers_activos:
-        user_con_folio = timers_activos[folio_admin]["user_id"]
-        cancelar_timer_folio(folio_admin)
-        try:
-            now = datetime.now().isoformat()
-            await asyncio.to_thread(lambda: (
-                supabase.table("folios_registrados").update(
-                    {"estado": "VALIDADO_ADMIN", "fecha_comprobante": now}
-                ).eq("folio", folio_admin).execute(),
-                supabase.table("borradores_registros").update(
-                    {"estado": "VALIDADO_ADMIN", "fecha_comprobante": now}
-                ).eq("folio", folio_admin).execute(),
-            ))
-        except Exception as e:
-            print(f"Error actualizando BD folio {folio_admin}: {e}")
-        await message.answer(
-            f"✅ VALIDACIÓN OK\nFolio: {folio_admin}\nTimer cancelado.\n\n"
-            f"📋 Para generar otro permiso use /chuleta"
-        )
-        try:
-            await bot.send_message(
-                user_con_folio,
-                f"✅ PAGO VALIDADO POR ADMINISTRACIÓN - JALISCO\n"
-                f"Folio: {folio_admin}\nTu permiso está activo.\n\n"
-                f"📋 Para generar otro permiso use /chuleta"
-            )
-        except Exception as e:
-            print(f"Error notificando usuario: {e}")
-    else:
-        await message.answer(
-            f"❌ Folio {folio_admin} no encontrado en timers activos.\n\n"
-            f"📋 Para generar otro permiso use /chuleta"
-        )
-
-# ============ COMPROBANTE =====================================================
-
-@dp.message(lambda m: m.content_type == ContentType.PHOTO)
-async def recibir_comprobante(message: types.Message):
-    try:
-        user_id        = message.from_user.id
-        folios_usuario = obtener_folios_usuario(user_id)
-        if not folios_usuario:
-            await message.answer(
-                "ℹ️ No hay trámites pendientes.\n\n📋 Para generar otro permiso use /chuleta"
-            )
-            return
-        if len(folios_usuario) > 1:
-            lista = "\n".join(f"• {f}" for f in folios_usuario)
-            pending_comprobantes[user_id] = "waiting_folio"
-            await message.answer(
-                f"📄 Tienes varios folios activos:\n\n{lista}\n\n"
-                f"Responde con el NÚMERO DE FOLIO para este comprobante.\n\n"
-                f"📋 Para generar otro permiso use /chuleta"
-            )
-            return
-        folio = folios_usuario[0]
-        cancelar_timer_folio(folio)
-        now = datetime.now().isoformat()
-        await asyncio.to_thread(lambda: (
-            supabase.table("folios_registrados").update(
-                {"estado": "COMPROBANTE_ENVIADO", "fecha_comprobante": now}
-            ).eq("folio", folio).execute(),
-            supabase.table("borradores_registros").update(
-                {"estado": "COMPROBANTE_ENVIADO", "fecha_comprobante": now}
-            ).eq("folio", folio).execute(),
-        ))
-        await message.answer(
-            f"✅ Comprobante recibido.\n📄 Folio: {folio}\n⏹️ Timer detenido.\n\n"
-            f"📋 Para generar otro permiso use /chuleta"
-        )
-    except Exception as e:
-        print(f"[ERROR] recibir_comprobante: {e}")
-        await message.answer(
-            "❌ Error procesando comprobante. Intenta de nuevo.\n\n"
-            "📋 Para generar otro permiso use /chuleta"
-        )
-
-@dp.message(lambda m: m.from_user.id in pending_comprobantes
-            and pending_comprobantes[m.from_user.id] == "waiting_folio")
-async def especificar_folio_comprobante(message: types.Message):
-    try:
-        user_id   = message.from_user.id
-        folio_esp = message.text.strip().upper()
-        if folio_esp not in obtener_folios_usuario(user_id):
-            await message.answer(
-                "❌ Ese folio no está en tu lista activa.\n\n"
-                "📋 Para generar otro permiso use /chuleta"
-            )
-            return
-        cancelar_timer_folio(folio_esp)
-        del pending_comprobantes[user_id]
-        now = datetime.now().isoformat()
-        await asyncio.to_thread(lambda: (
-            supabase.table("folios_registrados").update(
-                {"estado": "COMPROBANTE_ENVIADO", "fecha_comprobante": now}
-            ).eq("folio", folio_esp).execute(),
-            supabase.table("borradores_registros").update(
-                {"estado": "COMPROBANTE_ENVIADO", "fecha_comprobante": now}
-            ).eq("folio", folio_esp).execute(),
-        ))
-        await message.answer(
-            f"✅ Comprobante asociado.\n📄 Folio: {folio_esp}\n⏹️ Timer detenido.\n\n"
-            f"📋 Para generar otro permiso use /chuleta"
-        )
-    except Exception as e:
-        print(f"[ERROR] especificar_folio: {e}")
-        pending_comprobantes.pop(message.from_user.id, None)
-        await message.answer(
-            "❌ Error. Intenta de nuevo.\n\n📋 Para generar otro permiso use /chuleta"
-        )
-
-@dp.message(Command("folios"))
-async def ver_folios_activos(message: types.Message):
-    folios_usuario = obtener_folios_usuario(message.from_user.id)
-    if not folios_usuario:
-        await message.answer(
-            "ℹ️ No tienes folios pendientes.\n\n📋 Para generar otro permiso use /chuleta"
-        )
-        return
-    lista   = []
-    botones = []
-    for folio in folios_usuario:
-        if folio in timers_activos:
-            mins = max(0, 2160 - int(
-                (datetime.now() - timers_activos[folio]["start_time"]).total_seconds() / 60
-            ))
-            lista.append(f"• {folio} ({mins//60}h {mins%60}min)")
-        else:
-            lista.append(f"• {folio} (sin timer)")
-        botones.append([InlineKeyboardButton(
-            text=f"⏹️ Detener {folio}", callback_data=f"detener_{folio}"
-        )])
-    await message.answer(
-        f"📋 FOLIOS JALISCO ACTIVOS ({len(folios_usuario)})\n\n" +
-        "\n".join(lista) +
-        "\n\n⏰ Timer 36h por folio.\n📸 Envía imagen para comprobante.\n\n"
-        "📋 Para generar otro permiso use /chuleta",
-        reply_markup=InlineKeyboardMarkup(inline_keyboard=botones)
-    )
-
-@dp.message(lambda m: m.text and any(
-    p in m.text.lower() for p in
-    ['costo','precio','cuanto','cuánto','deposito','depósito','pago','valor','monto']
-))
-async def responder_costo(message: types.Message):
-    await message.answer(
-        f"💰 El costo del permiso es ${PRECIO_PERMISO}.\n\n📋 Para generar otro permiso use /chuleta"
-    )
-
-@dp.message()
-async def fallback(message: types.Message):
-    await message.answer("🏛️ Sistema Digital Jalisco.")
-
-# ============ FASTAPI =========================================================
-
-_keep_task = None
-
-async def keep_alive():
-    while True:
-        await asyncio.sleep(600)
-        print("[HEARTBEAT] Sistema Jalisco activo")
-
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    global _keep_task
-    try:
-        await inicializar_folio_cursors()
-        _cargar_plantillas()
-        await bot.delete_webhook(drop_pending_updates=True)
-        if BASE_URL:
-            wh = f"{BASE_URL}/webhook"
-            await bot.set_webhook(wh, allowed_updates=["message", "callback_query"])
-            print(f"[WEBHOOK] Configurado: {wh}")
-            _keep_task = asyncio.create_task(keep_alive())
-        else:
-            print("[POLLING] Sin webhook")
-        print(f"[SISTEMA] Jalisco v18.1 iniciado — "
-              f"PDF417 {'✅' if PDF417_DISPONIBLE else '⚠️ fallback QR'}")
-        yield
-    except Exception as e:
-        print(f"[ERROR CRÍTICO] {e}")
-        yield
-    finally:
-        if _keep_task:
-            _keep_task.cancel()
-            with suppress(asyncio.CancelledError):
-                await _keep_task
-        await bot.session.close()
-
-app = FastAPI(lifespan=lifespan, title="Sistema Jalisco Digital", version="18.1")
-
-@app.post("/webhook")
-async def telegram_webhook(request: Request):
-    try:
-        data   = await request.json()
-        update = types.Update(**data)
-        await dp.feed_webhook_update(bot, update)
-        return {"ok": True}
-    except Exception as e:
-        print(f"[ERROR] webhook: {e}")
-        return {"ok": False, "error": str(e)}
-
-@app.get("/")
-async def health():
-    return {
-        "ok":                True,
-        "version":           "18.1",
-        "entidad":           "Jalisco",
-        "pdf417_disponible": PDF417_DISPONIBLE,
-        "active_timers":     len(timers_activos),
-        "cursors_actuales":  _folio_cursors,
-        "fixes_v18.1": [
-            "pdf417gen en lugar de pdf417 — fix import correcto",
-            "Watermark Supabase — contador nunca retrocede tras reinicio",
-            "PDF417 contenido: CAMPO  valor  CAMPO  valor  ... URL",
-            "PDF417 resize() fijo 840x120px — tamaño siempre igual",
-            "keep_proportion=False — llena el rect exacto en PDF",
-        ]
-    }
-
-@app.get("/status")
-async def status_detail():
-    return {
-        "sistema":             "Jalisco Digital v18.1",
-        "pdf417_disponible":   PDF417_DISPONIBLE,
-        "total_timers":        len(timers_activos),
-        "folios_activos":      list(timers_activos.keys()),
-        "cursors_por_prefijo": _folio_cursors,
-        "timestamp":           datetime.now().isoformat(),
-    }
-
-if __name__ == "__main__":
-    import uvicorn
-    port = int(os.getenv("PORT", 8000))
-    print(f"[ARRANQUE] Jalisco v18.1 — puerto {port}")
-    uvicorn.run(app, host="0.0.0.0", port=port)
-from fastapi import FastAPI, Request
-from aiogram import Bot, Dispatcher, types
-from aiogram.client.session.aiohttp import AiohttpSession
-from aiogram.fsm.storage.memory import MemoryStorage
-from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.context import FSMContext
-from aiogram.filters import Command
-from aiogram.types import FSInputFile, ContentType, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery
-from contextlib import asynccontextmanager, suppress
-from datetime import datetime, timedelta
-from supabase import create_client, Client
-import asyncio
-import os
-import fitz
-import pytz
-from PIL import Image
-from io import BytesIO
-import json
-import re
-import qrcode
-
-# PDF417 — usando pdf417gen (el que está en requirements.txt)
-try:
-    import pdf417gen
-    PDF417_DISPONIBLE = True
-    print("[PDF417] pdf417gen disponible ✅")
-except ImportError:
-    PDF417_DISPONIBLE = False
-    print("[PDF417] pdf417gen NO disponible, usando QR fallback")
-
-# ------------ CONFIG ------------
-BOT_TOKEN    = os.getenv("BOT_TOKEN", "")
-SUPABASE_URL = os.getenv("SUPABASE_URL", "")
-SUPABASE_KEY = os.getenv("SUPABASE_KEY", "")
-BASE_URL     = os.getenv("BASE_URL", "").rstrip("/")
-OUTPUT_DIR   = "documentos"
-PLANTILLA_PDF   = "jalisco1.pdf"
-PLANTILLA_BUENO = "jalisco.pdf"
-
-PRECIO_PERMISO      = 250
-PRECIO_FIJO_PAGINA2 = 1080
-
-os.makedirs(OUTPUT_DIR, exist_ok=True)
-os.makedirs("static/pdfs", exist_ok=True)
-
-URL_CONSULTA_BASE = "https://serviciodigital-jaliscogobmx.onrender.com"
-
-coords_qr_dinamico = {"x": 966, "y": 603, "ancho": 140, "alto": 140}
-RECT_PDF417        = fitz.Rect(932.65, 807, 1141.395, 852.127)
-
-# Tamaño fijo PNG interno — el rect de PyMuPDF manda el tamaño visual
-PDF417_W = 840
-PDF417_H = 120
-
-# ------------ PLANTILLAS EN MEMORIA ------------
-_plantilla1_bytes: bytes | None = None
-_plantilla2_bytes: bytes | None = None
-
-def _cargar_plantillas():
-    global _plantilla1_bytes, _plantilla2_bytes
-    with open(PLANTILLA_PDF, "rb") as f:
-        _plantilla1_bytes = f.read()
-    with open(PLANTILLA_BUENO, "rb") as f:
-        _plantilla2_bytes = f.read()
-    print("[PLANTILLAS] Cargadas en memoria ✅")
-
-# ------------ SUPABASE ------------
-supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
-
-# ------------ BOT ------------
-session_bot = AiohttpSession(timeout=300)
-bot         = Bot(token=BOT_TOKEN, session=session_bot)
-storage     = MemoryStorage()
-dp          = Dispatcher(storage=storage)
-
-# ============ FOLIOS — WATERMARK EN SUPABASE =================================
-FOLIO_PREFIJO_JAL = "JAL"
-
-PREFIJOS_VALIDOS = {
-    "1": 980000000,
-    "2": 890000000,
-    "3": 780000000,
-}
-_folio_cursors = {}
-_folio_lock    = asyncio.Lock()
-
-# ── watermark persistido ──────────────────────────────────────────────────────
-
-def _sb_leer_watermark_jal(prefijo_num: str) -> int | None:
-    """Síncrono."""
-    clave = f"{FOLIO_PREFIJO_JAL}_{prefijo_num}"
-    try:
-        r = supabase.table("folio_watermark").select("ultimo_asignado").eq("prefijo", clave).execute()
-        if r.data:
-            return r.data[0]["ultimo_asignado"]
-        return None
-    except Exception as e:
-        print(f"[ERROR] leer_watermark JAL {prefijo_num}: {e}")
-        return None
-
-def _sb_guardar_watermark_jal(prefijo_num: str, numero: int):
-    """Solo avanza, nunca retrocede. Síncrono."""
-    clave = f"{FOLIO_PREFIJO_JAL}_{prefijo_num}"
-    try:
-        supabase.table("folio_watermark").upsert({
-            "prefijo":         clave,
-            "ultimo_asignado": numero
-        }).execute()
-        print(f"[WATERMARK JAL] Guardado {clave}: {numero}")
-    except Exception as e:
-        print(f"[ERROR] guardar_watermark JAL {prefijo_num}: {e}")
-
-# ── cursors locales ───────────────────────────────────────────────────────────
-
-def _leer_cursors_local():
-    try:
-        with open("folio_cursors.json") as f:
-            return {k: int(v) for k, v in json.load(f).items()}
-    except Exception:
-        return {}
-
-def _guardar_cursors_local(cursors: dict):
-    try:
-        with open("folio_cursors.json", "w") as f:
-            json.dump(cursors, f)
-    except Exception as e:
-        print(f"[WARN] No se pudo persistir cursors: {e}")
-
-# ── inicialización ────────────────────────────────────────────────────────────
-
-def _leer_ultimo_folio_por_prefijo_db(prefijo_num: str) -> int:
-    """Fallback primera vez — busca máximo en DB activa. Síncrono."""
-    try:
-        base = PREFIJOS_VALIDOS[prefijo_num]
-        resp = (
-            supabase.table("folios_registrados")
-            .select("folio")
-            .gte("folio", str(base))
-            .lt("folio", str(base + 100000000))
-            .order("folio", desc=True)
-            .limit(1)
-            .execute()
-        )
-        if resp.data:
-            ultimo = int(resp.data[0]["folio"])
-            print(f"[FOLIO][DB fallback] Último prefijo {prefijo_num}: {ultimo}")
-            return ultimo
-        return base - 1
-    except Exception as e:
-        print(f"[ERROR] Consultando folios prefijo {prefijo_num}: {e}")
-        return PREFIJOS_VALIDOS[prefijo_num] - 1
-
-async def inicializar_folio_cursors():
-    """
-    Al arrancar:
-    1) Lee watermark de Supabase (máximo histórico real).
-    2) Si no existe, fallback a DB activa y crea el watermark.
-    3) Toma el mayor entre watermark y cursor local.
-    El contador NUNCA baja aunque se borren folios expirados.
-    """
-    global _folio_cursors
-    cursors_local = _leer_cursors_local()
-
-    for prefijo_num, base in PREFIJOS_VALIDOS.items():
-        watermark = await asyncio.to_thread(_sb_leer_watermark_jal, prefijo_num)
-
-        if watermark is not None:
-            desde = watermark
-            print(f"[FOLIO JAL] Prefijo {prefijo_num} desde watermark: {watermark}")
-        else:
-            desde = await asyncio.to_thread(_leer_ultimo_folio_por_prefijo_db, prefijo_num)
-            await asyncio.to_thread(_sb_guardar_watermark_jal, prefijo_num, desde)
-            print(f"[FOLIO JAL] Prefijo {prefijo_num} watermark creado desde DB: {desde}")
-
-        local = cursors_local.get(prefijo_num)
-        if local is not None and local > desde:
-            desde = local
-            print(f"[FOLIO JAL] Prefijo {prefijo_num} cursor local más alto: {local}")
-
-        _folio_cursors[prefijo_num] = desde
-
-    _guardar_cursors_local(_folio_cursors)
-
-# ── generación de folio ───────────────────────────────────────────────────────
-
-async def generar_folio_con_prefijo(prefijo_num: str) -> str:
-    global _folio_cursors
-    if prefijo_num not in PREFIJOS_VALIDOS:
-        prefijo_num = "1"
-    async with _folio_lock:
-        base   = PREFIJOS_VALIDOS[prefijo_num]
-        limite = base + 100000000
-        _folio_cursors[prefijo_num] += 1
-        if _folio_cursors[prefijo_num] >= limite:
-            _folio_cursors[prefijo_num] = base
-        numero = _folio_cursors[prefijo_num]
-        await asyncio.to_thread(_sb_guardar_watermark_jal, prefijo_num, numero)
-        _guardar_cursors_local(_folio_cursors)
-        folio = f"{numero:09d}"
-        print(f"[FOLIO JAL] Generado prefijo {prefijo_num}: {folio}")
-        return folio
-
-# ============ INSERT SUPABASE =================================================
-
-def _sb_insertar_folio(datos: dict, user_id: int, username: str):
-    supabase.table("folios_registrados").insert({
-        "folio":             datos["folio"],
-        "marca":             datos["marca"],
-        "linea":             datos["linea"],
-        "anio":              datos["anio"],
-        "numero_serie":      datos["serie"],
-        "numero_motor":      datos["motor"],
-        "color":             datos["color"],
-        "nombre":            datos["nombre"],
-        "fecha_expedicion":  datos["fecha_exp"].date().isoformat(),
-        "fecha_vencimiento": datos["fecha_ven"].date().isoformat(),
-        "entidad":  "Jalisco",
-        "estado":   "PENDIENTE",
-        "user_id":  user_id,
-        "username": username or "Sin username",
-    }).execute()
-
-def _sb_insertar_borrador(datos: dict, user_id: int):
-    supabase.table("borradores_registros").insert({
-        "folio":             datos["folio"],
-        "entidad":           "Jalisco",
-        "numero_serie":      datos["serie"],
-        "marca":             datos["marca"],
-        "linea":             datos["linea"],
-        "numero_motor":      datos["motor"],
-        "anio":              datos["anio"],
-        "color":             datos["color"],
-        "fecha_expedicion":  datos["fecha_exp"].isoformat(),
-        "fecha_vencimiento": datos["fecha_ven"].isoformat(),
-        "contribuyente":     datos["nombre"],
-        "estado":            "PENDIENTE",
-        "user_id":           user_id,
-    }).execute()
-
-async def guardar_folio_con_reintento(datos: dict, user_id: int, username: str, prefijo="1") -> bool:
-    for intento in range(100_000_000):
-        if "folio" not in datos or not re.fullmatch(r"\d{9}", str(datos.get("folio", ""))):
-            datos["folio"] = await generar_folio_con_prefijo(prefijo)
-        try:
-            await asyncio.to_thread(_sb_insertar_folio, datos, user_id, username)
-            print(f"[ÉXITO] ✅ Folio {datos['folio']} guardado (intento {intento+1})")
-            return True
-        except Exception as e:
-            em = str(e).lower()
-            if "duplicate" in em or "unique constraint" in em or "23505" in em:
-                print(f"[DUPLICADO] {datos['folio']} existe, reintentando ({intento+1})")
-                datos["folio"] = None
-                await asyncio.sleep(0.1)
-                continue
-            print(f"[ERROR BD] {e}")
-            return False
-    return False
-
-# ============ FOLIOS PÁGINA 2 =================================================
-
-def _leer_folios_pagina2():
-    try:
-        with open("folios_pagina2.json") as f:
-            return json.load(f)
-    except Exception:
-        return {
-            "referencia_pago":   273312001734,
-            "num_autorizacion":  370803,
-            "folio_seguimiento": "GZUdr61oqv2",
-            "linea_captura":     41340816,
-        }
-
-def _guardar_folios_pagina2(folios: dict):
-    try:
-        with open("folios_pagina2.json", "w") as f:
-            json.dump(folios, f)
-    except Exception as e:
-        print(f"[WARN] No se pudo persistir folios página 2: {e}")
-
-def _incrementar_sufijo_alfabetico(sufijo: str) -> str:
-    chars = list(sufijo)
-    for i in range(len(chars)-1, -1, -1):
-        if chars[i] == 'z':
-            chars[i] = 'a'
-        else:
-            chars[i] = chr(ord(chars[i]) + 1)
-            break
-    return ''.join(chars)
-
-def _incrementar_alfanumerico(codigo: str) -> str:
-    match = re.match(r'(\D*)(\d+)([a-z]+)(\d+)$', codigo)
-    if match:
-        prefijo = match.group(1)
-        numero  = match.group(2)
-        letras  = match.group(3)
-        digito  = int(match.group(4)) + 1
-        if digito > 9:
-            digito = 0
-            letras = _incrementar_sufijo_alfabetico(letras)
-        return f"{prefijo}{numero}{letras}{digito}"
-    return codigo[:-1] + str((int(codigo[-1]) + 1) % 10)
-
-def generar_folios_pagina2() -> dict:
-    folios = _leer_folios_pagina2()
-    folios["referencia_pago"]   += 1
-    folios["num_autorizacion"]  += 1
-    folios["folio_seguimiento"]  = _incrementar_alfanumerico(folios["folio_seguimiento"])
-    folios["linea_captura"]     += 1
-    _guardar_folios_pagina2(folios)
-    return folios
-
-# ============ FOLIO REPRESENTATIVO ===========================================
-
-def obtener_folio_representativo():
-    try:
-        with open("folio_representativo.txt") as f:
-            return int(f.read().strip())
-    except FileNotFoundError:
-        folio_inicial = 21385
-        with open("folio_representativo.txt", "w") as f:
-            f.write(str(folio_inicial))
-        return folio_inicial
-    except Exception as e:
-        print(f"[ERROR] Leyendo folio representativo: {e}")
-        return 21385
-
-def incrementar_folio_representativo(folio_actual):
-    try:
-        nuevo = folio_actual + 1
-        with open("folio_representativo.txt", "w") as f:
-            f.write(str(nuevo))
-        return nuevo
-    except Exception as e:
-        print(f"[ERROR] Incrementando folio representativo: {e}")
-        return folio_actual + 1
-
-# ============ TIMERS 36H =====================================================
-
-timers_activos       = {}
-user_folios          = {}
-pending_comprobantes = {}
-
-async def eliminar_folio_automatico(folio: str):
-    try:
-        user_id = timers_activos.get(folio, {}).get("user_id")
-        await asyncio.to_thread(lambda: (
-            supabase.table("folios_registrados").delete().eq("folio", folio).execute(),
-            supabase.table("borradores_registros").delete().eq("folio", folio).execute(),
-        ))
-        if user_id:
-            await bot.send_message(
-                user_id,
-                f"⏰ TIEMPO AGOTADO - ESTADO DE JALISCO\n\n"
-                f"El folio {folio} ha sido eliminado por no completar el pago en 36 horas.\n\n"
-                f"📋 Para generar otro permiso use /chuleta"
-            )
-        limpiar_timer_folio(folio)
-    except Exception as e:
-        print(f"Error eliminando folio {folio}: {e}")
-
-async def enviar_recordatorio(folio: str, minutos_restantes: int):
-    try:
-        if folio not in timers_activos:
-            return
-        user_id = timers_activos[folio]["user_id"]
-        await bot.send_message(
-            user_id,
-            f"⚡ RECORDATORIO DE PAGO - JALISCO\n\n"
-            f"Folio: {folio}\n"
-            f"Tiempo restante: {minutos_restantes} minutos\n"
-            f"Monto: ${PRECIO_PERMISO}\n\n"
-            f"📸 Envíe su comprobante de pago (imagen).\n\n"
-            f"📋 Para generar otro permiso use /chuleta"
-        )
+        while True:
+            filas = await _pagina_pendientes(despues_de)
+            if not filas:
+                break
+            exactos = await _inicios_exactos([f["folio"] for f in filas])
+            for fila in filas:
+                folio  = fila["folio"]
+                actual = timers_activos.get(folio)
+                if actual is not None:
+                    inicio = actual.start_time
+                elif folio in exactos:
+                    inicio = exactos[folio]
+                else:
+                    dia = _fecha_local(fila.get("fecha_expedicion"))
+                    if dia is None:
+                        continue
+                    inicio = dia.replace(hour=23, minute=59, second=59, microsecond=0)
+                # Nuevo seq: las entradas de heap de otro dueño quedan obsoletas
+                timer = _nuevo_timer(int(fila.get("user_id") or 0), inicio)
+                await timers_activos.asignar(folio, timer)
+                _programar_etapa(folio, timer, 0)
+                _recarga_stats["folios"] += 1
+                if inicio.timestamp() + ETAPAS_TIMER[-1][0] <= ahora:
+                    _recarga_stats["vencidos"] += 1
+            _recarga_stats["paginas"] += 1
+            despues_de = filas[-1]["folio"]
+            if len(filas) < RECARGA_PAGINA:
+                break
+        _recarga_stats["estado"] = "completa"
     except Exception as e:
-        print(f"Error enviando recordatorio para folio {folio}: {e}")
-
-async def iniciar_timer_eliminacion(user_id: int, folio: str):
-    async def timer_task():
-        print(f"[TIMER] Iniciado folio {folio}, usuario {user_id} (36h)")
-        await asyncio.sleep(34.5 * 3600)
-        if folio not in timers_activos: return
-        await enviar_recordatorio(folio, 90)
-        await asyncio.sleep(30 * 60)
-        if folio not in timers_activos: return
-        await enviar_recordatorio(folio, 60)
-        await asyncio.sleep(30 * 60)
-        if folio not in timers_activos: return
-        await enviar_recordatorio(folio, 30)
-        await asyncio.sleep(20 * 60)
-        if folio not in timers_activos: return
-        await enviar_recordatorio(folio, 10)
-        await asyncio.sleep(10 * 60)
-        if folio in timers_activos:
-            print(f"[TIMER] Expirado folio {folio} - eliminando")
-            await eliminar_folio_automatico(folio)
-
-    task = asyncio.create_task(timer_task())
-    timers_activos[folio] = {"task": task, "user_id": user_id, "start_time": datetime.now()}
-    user_folios.setdefault(user_id, []).append(folio)
-    print(f"[SISTEMA] Timer 36h iniciado folio {folio}, total: {len(timers_activos)}")
-
-def cancelar_timer_folio(folio: str):
-    if folio in timers_activos:
-        timers_activos[folio]["task"].cancel()
-        user_id = timers_activos[folio]["user_id"]
-        del timers_activos[folio]
-        if user_id in user_folios and folio in user_folios[user_id]:
-            user_folios[user_id].remove(folio)
-            if not user_folios[user_id]:
-                del user_folios[user_id]
-        print(f"[SISTEMA] Timer cancelado folio {folio}")
-
-def limpiar_timer_folio(folio: str):
-    if folio in timers_activos:
-        user_id = timers_activos[folio]["user_id"]
-        del timers_activos[folio]
-        if user_id in user_folios and folio in user_folios[user_id]:
-            user_folios[user_id].remove(folio)
-            if not user_folios[user_id]:
-                del user_folios[user_id]
+        _recarga_stats["estado"] = "error"
+        log.error("[RECARGA] Interrumpida tras %s folios: %s", _recarga_stats["folios"], e)
+    finally:
+        _recarga_stats["segundos"] = round(time.perf_counter() - t0, 3)
+    log.info("[RECARGA] %s folios pendientes en %s páginas (%s vencidos) en %ss",
+             _recarga_stats["folios"], _recarga_stats["paginas"],
+             _recarga_stats["vencidos"], _recarga_stats["segundos"])
+
+def iniciar_recarga_timers():
+    global _recarga_task
+    if RECARGA_TIMERS and _recarga_task is None:
+        _recarga_task = asyncio.create_task(recargar_timers_pendientes())
+
+# ── barrido de expirados ──────────────────────────────────────────────────────
+# La última etapa del timer no borra folio por folio: reclama el folio y
+# despierta al barrido, que junta lo que venció en los últimos segundos.
+# Cada BARRIDO_INTERVALO además consulta (una sola consulta paginada) todos
+# los PENDIENTE con más de 36 h en borradores_registros, que tiene el
+# timestamp completo: así se cubren folios sin timer en este proceso. El
+# borrado va en trozos de SB_IN_MAX con filtro in_ y estado=PENDIENTE, y
+# solo se avisa de los folios que de verdad se borraron. Los avisos salen
+# por una cola con prioridad baja en el limitador de envíos, que es quien
+# los espacia; AVISOS_CONCURRENCIA solo acota cuántos esperan turno a la vez.
+
+BARRIDO_INTERVALO  = int(os.getenv("BARRIDO_INTERVALO", "300"))
+BARRIDO_AGRUPAR    = float(os.getenv("BARRIDO_AGRUPAR", "2"))
+BARRIDO_PAGINA     = int(os.getenv("BARRIDO_PAGINA", "1000"))
+AVISOS_CONCURRENCIA = int(os.getenv("AVISOS_CONCURRENCIA", "8"))
+
+_expirados_locales: dict[str, int] = {}   # folio → user_id, reclamados por el scheduler
+_barrido_despertar = asyncio.Event()
+_barrido_task      = None
+_avisos_tasks: list[asyncio.Task] = []
+_cola_avisos: asyncio.Queue = asyncio.Queue()   # (user_id, folio)
+_barrido_stats     = {"barridos": 0, "eliminados_total": 0, "ultimo": None}
+
+async def _pendientes_vencidos(corte: datetime) -> dict[str, int]:
+    """folio → user_id de todos los PENDIENTE expedidos antes de `corte`."""
+    vencidos, despues_de = {}, None
+    while True:
+        consulta = (
+            supabase.table("borradores_registros")
+            .select("folio,user_id")
+            .eq("entidad", "Jalisco")
+            .eq("estado", "PENDIENTE")
+            .lt("fecha_expedicion", corte.isoformat())
+        )
+        if despues_de is not None:
+            consulta = consulta.gt("folio", despues_de)
+        r = await consulta.order("folio").limit(BARRIDO_PAGINA).execute()
+        for fila in r.data:
+            vencidos[fila["folio"]] = int(fila.get("user_id") or 0)
+        if len(r.data) < BARRIDO_PAGINA:
+            return vencidos
+        despues_de = r.data[-1]["folio"]
+
+async def barrer_expirados(consultar_bd: bool = True) -> dict:
+    t0 = time.perf_counter()
+    stats = {"fecha": datetime.now().isoformat(timespec="seconds"), "locales": 0,
+             "consulta": 0, "eliminados": 0, "borradores": 0, "avisos": 0, "errores": 0}
+    candidatos = dict(_expirados_locales)
+    _expirados_locales.clear()
+    stats["locales"] = len(candidatos)
+
+    if consultar_bd:
+        try:
+            vencidos = await _pendientes_vencidos(datetime.now() - timedelta(seconds=ETAPAS_TIMER[-1][0]))
+        except Exception as e:
+            stats["errores"] += 1
+            log.error("[BARRIDO] Consulta de vencidos falló: %s", e)
+            vencidos = {}
+        stats["consulta"] = len(vencidos)
+        sacados = await timers_activos.sacar_varios(vencidos)
+        for folio, user_id in vencidos.items():
+            timer = sacados.get(folio)
+            candidatos.setdefault(folio, timer.user_id if timer else user_id)
+        await _compactar_timers()
+
+    if candidatos:
+        trozos = _trozos(list(candidatos), SB_IN_MAX)
+        resultados = await asyncio.gather(
+            *(eliminar_folios_db(trozo, estado="PENDIENTE") for trozo in trozos),
+            return_exceptions=True,
+        )
+        for trozo, res in zip(trozos, resultados):
+            if isinstance(res, Exception):
+                # Siguen reclamados: se reintentan en el próximo barrido
+                stats["errores"] += 1
+                log.error("[BARRIDO] Borrado de %s folios falló: %s", len(trozo), res)
+                _expirados_locales.update((f, candidatos[f]) for f in trozo)
+                continue
+            stats["borradores"] += len(res.borradores)
+            for fila in res.folios:
+                stats["eliminados"] += 1
+                user_id = int(fila.get("user_id") or candidatos.get(fila["folio"]) or 0)
+                if user_id:
+                    _cola_avisos.put_nowait((user_id, fila["folio"]))
+                    stats["avisos"] += 1
+
+    stats["ms"] = round((time.perf_counter() - t0) * 1000, 1)
+    M_BARRIDO.observar(stats["ms"] / 1000, "bd" if consultar_bd else "local")
+    _barrido_stats["barridos"] += 1
+    _barrido_stats["eliminados_total"] += stats["eliminados"]
+    _barrido_stats["ultimo"] = stats
+    if candidatos or stats["errores"]:
+        log.info("[BARRIDO] %s candidatos (%s locales, %s consulta) → %s folios y %s borradores "
+                 "eliminados, %s avisos, %s errores en %sms",
+                 len(candidatos), stats["locales"], stats["consulta"], stats["eliminados"],
+                 stats["borradores"], stats["avisos"], stats["errores"], stats["ms"])
+    return stats
+
+async def _barrido_periodico():
+    log.info("[BARRIDO] Iniciado, cada %ss", BARRIDO_INTERVALO)
+    ultima_bd = time.monotonic()
+    while True:
+        # Los despertares locales no posponen la consulta a la BD: corre en
+        # cuanto toca, haya o no expiraciones locales de por medio
+        espera = max(0.0, ultima_bd + BARRIDO_INTERVALO - time.monotonic())
+        with suppress(asyncio.TimeoutError):
+            await asyncio.wait_for(_barrido_despertar.wait(), espera)
+            await asyncio.sleep(BARRIDO_AGRUPAR)   # junta los que vencen a la vez
+        _barrido_despertar.clear()
+        consultar_bd = time.monotonic() - ultima_bd >= BARRIDO_INTERVALO
+        if consultar_bd:
+            ultima_bd = time.monotonic()
+        try:
+            await barrer_expirados(consultar_bd=consultar_bd)
+        except Exception as e:
+            log.exception("[BARRIDO] %s", e)
 
-def obtener_folios_usuario(user_id: int) -> list:
-    return user_folios.get(user_id, [])
+async def _enviar_avisos():
+    while True:
+        user_id, folio = await _cola_avisos.get()
+        try:
+            with prioridad_envio(PRIORIDAD_BAJA):
+                await bot.send_message(
+                    user_id,
+                    f"⏰ TIEMPO AGOTADO - ESTADO DE JALISCO\n\n"
+                    f"El folio {folio} ha sido eliminado por no completar el pago en 36 horas.\n\n"
+                    f"📋 Para generar otro permiso use /chuleta"
+                )
+        except Exception as e:
+            log.warning("[BARRIDO] Aviso de folio %s a %s falló: %s", folio, user_id, e)
+
+def iniciar_barrido():
+    global _barrido_task
+    if _barrido_task is None:
+        _barrido_task = asyncio.create_task(_barrido_periodico())
+    if not _avisos_tasks:
+        _avisos_tasks.extend(asyncio.create_task(_enviar_avisos()) for _ in range(AVISOS_CONCURRENCIA))
+
+async def detener_barrido():
+    for tarea in (_barrido_task, *_avisos_tasks):
+        if tarea:
+            tarea.cancel()
+            with suppress(asyncio.CancelledError):
+                await tarea
 
 # ============ COORDENADAS PDF =================================================
 
@@ -1588,33 +2198,29 @@ coords_pagina2 = {
 
 # ============ QR PRINCIPAL ====================================================
 
+def _qr_jalisco(folio: str) -> qrcode.QRCode:
+    url = f"{URL_CONSULTA_BASE}/consulta/{folio}"
+    qr  = qrcode.QRCode(version=2, error_correction=qrcode.constants.ERROR_CORRECT_M,
+                        box_size=4, border=1)
+    qr.add_data(url)
+    qr.make(fit=True)
+    return qr
+
 def _generar_qr_jalisco(folio: str):
     try:
-        url = f"{URL_CONSULTA_BASE}/consulta/{folio}"
-        qr  = qrcode.QRCode(version=2, error_correction=qrcode.constants.ERROR_CORRECT_M,
-                            box_size=4, border=1)
-        qr.add_data(url)
-        qr.make(fit=True)
-        img = qr.make_image(fill_color="black", back_color=(220,220,220)).convert("RGB")
-        print(f"[QR] Generado para folio {folio}")
+        img = _qr_jalisco(folio).make_image(fill_color="black", back_color=(220,220,220)).convert("RGB")
+        log.debug("[QR] Generado para folio %s", folio)
         return img
     except Exception as e:
-        print(f"[ERROR QR] {e}")
+        log.error("[ERROR QR] %s", e)
         return None
 
 # ============ PDF417 TAMAÑO FIJO =============================================
 
-def _generar_pdf417(datos: dict) -> Image.Image | None:
-    """
-    PDF417 con pdf417gen.
-    Contenido: CAMPO  valor  CAMPO  valor  ...  URL
-    Tamaño final SIEMPRE PDF417_W x PDF417_H via resize().
-    keep_proportion=False en PyMuPDF garantiza que llene el rect exacto.
-    Síncrono — usar con asyncio.to_thread.
-    """
+def _texto_pdf417(datos: dict) -> str:
+    """Contenido: CAMPO  valor  CAMPO  valor  ...  URL"""
     url_consulta = f"{URL_CONSULTA_BASE}/consulta/{datos['folio']}"
-
-    texto = (
+    return (
         f"MARCA  {datos['marca']}  "
         f"LINEA  {datos['linea']}  "
         f"ANO  {datos['anio']}  "
@@ -1626,44 +2232,134 @@ def _generar_pdf417(datos: dict) -> Image.Image | None:
         f"{url_consulta}"
     )
 
+def _codigos_pdf417(texto: str) -> list:
+    return pdf417gen.encode(texto, columns=10, security_level=2)
+
+def _qr_fallback_pdf417(texto: str) -> qrcode.QRCode:
+    qr = qrcode.QRCode(version=4, error_correction=qrcode.constants.ERROR_CORRECT_L,
+                       box_size=2, border=1)
+    qr.add_data(texto)
+    qr.make(fit=True)
+    return qr
+
+def _generar_pdf417(datos: dict) -> Image.Image | None:
+    """
+    PDF417 con pdf417gen.
+    Tamaño final SIEMPRE PDF417_W x PDF417_H via resize().
+    keep_proportion=False en PyMuPDF garantiza que llene el rect exacto.
+    Síncrono — usar con asyncio.to_thread.
+    """
+    texto = _texto_pdf417(datos)
+
     if PDF417_DISPONIBLE:
         try:
-            codes = pdf417gen.encode(texto, columns=10, security_level=2)
+            codes = _codigos_pdf417(texto)
             img   = pdf417gen.render_image(codes, scale=2, ratio=3)
-            img   = img.convert("RGB")
-
-            # Fondo gris claro, barras negras
-            px  = img.load()
-            out = Image.new("RGB", img.size, (220, 220, 220))
-            ox  = out.load()
-            for y in range(img.height):
-                for x in range(img.width):
-                    p = px[x, y]
-                    if (sum(p[:3]) if isinstance(p, tuple) else p) < 384:
-                        ox[x, y] = (0, 0, 0)
+
+            # Fondo gris claro, barras negras — LUT sobre la imagen completa.
+            # pdf417gen solo pinta blanco/negro, así que el canal L basta
+            # para el umbral; el resize en L y la expansión final a RGB dan
+            # exactamente los mismos bytes que el recoloreo por píxel.
+            out = img.convert("L").point(_LUT_PDF417)
 
             # Resize fijo — siempre mismo tamaño sin importar el contenido
-            img_final = out.resize((PDF417_W, PDF417_H), Image.LANCZOS)
-            print(f"[PDF417] Generado {PDF417_W}x{PDF417_H}px ✅")
+            img_final = out.resize((PDF417_W, PDF417_H), Image.LANCZOS).convert("RGB")
+            log.debug("[PDF417] Generado %sx%spx ✅", PDF417_W, PDF417_H)
             return img_final
 
         except Exception as e:
-            print(f"[ERROR PDF417] {e} — usando QR fallback")
+            log.error("[ERROR PDF417] %s — usando QR fallback", e)
 
     # Fallback QR estirado
     try:
-        qr = qrcode.QRCode(version=4, error_correction=qrcode.constants.ERROR_CORRECT_L,
-                           box_size=2, border=1)
-        qr.add_data(texto)
-        qr.make(fit=True)
-        img = qr.make_image(fill_color="black", back_color="white").convert("RGB")
+        img = _qr_fallback_pdf417(texto).make_image(fill_color="black", back_color="white").convert("RGB")
         img = img.resize((PDF417_W, PDF417_H), Image.NEAREST)
-        print(f"[QR FALLBACK] Generado {PDF417_W}x{PDF417_H}px")
+        log.debug("[QR FALLBACK] Generado %sx%spx", PDF417_W, PDF417_H)
         return img
     except Exception as e:
-        print(f"[ERROR QR FALLBACK] {e}")
+        log.error("[ERROR QR FALLBACK] %s", e)
         return None
 
+# ============ CÓDIGOS VECTORIALES ============================================
+# QR y PDF417 dibujados como rectángulos rellenos directo en la página, sin
+# pasar por PIL → PNG → Pixmap. Cada racha horizontal de módulos oscuros es
+# un solo rect y todo va en un único shape por código. Misma geometría que
+# la versión raster (fondo gris, márgenes, estirado al rect fijo).
+# CODIGOS_VECTORIALES=0 vuelve a insertar imágenes.
+
+CODIGOS_VECTORIALES = os.getenv("CODIGOS_VECTORIALES", "1") == "1"
+
+_GRIS_FONDO = (220 / 255,) * 3
+
+def _dibujar_matriz(pg: fitz.Page, rect: fitz.Rect, matriz: list, fondo: tuple,
+                    margen: tuple = (0, 0)):
+    """
+    matriz: filas de bool (True = módulo oscuro). margen = (mx, my) en
+    módulos de fondo alrededor de la matriz, como el padding del raster.
+    """
+    filas, cols = len(matriz), len(matriz[0])
+    mx, my = margen
+    ancho  = rect.width  / (cols  + 2 * mx)
+    alto   = rect.height / (filas + 2 * my)
+
+    shape = pg.new_shape()
+    shape.draw_rect(rect)
+    shape.finish(color=None, fill=fondo, width=0)
+    for j, fila in enumerate(matriz):
+        y0 = rect.y0 + (my + j) * alto
+        i = 0
+        while i < cols:
+            if not fila[i]:
+                i += 1
+                continue
+            k = i + 1
+            while k < cols and fila[k]:
+                k += 1
+            shape.draw_rect(fitz.Rect(rect.x0 + (mx + i) * ancho, y0,
+                                      rect.x0 + (mx + k) * ancho, y0 + alto))
+            i = k
+    shape.finish(color=None, fill=(0, 0, 0), width=0)
+    shape.commit(overlay=True)
+
+def _matriz_pdf417(codes: list) -> list:
+    ancho, alto = pdf417gen.rendering.barcode_size(codes)
+    matriz = [[False] * ancho for _ in range(alto)]
+    for x, y in pdf417gen.rendering.modules(codes):
+        matriz[y][x] = True
+    return matriz
+
+def _insertar_qr_vector(pg1: fitz.Page, fol: str):
+    try:
+        rect_qr = fitz.Rect(
+            coords_qr_dinamico["x"],
+            coords_qr_dinamico["y"],
+            coords_qr_dinamico["x"] + coords_qr_dinamico["ancho"],
+            coords_qr_dinamico["y"] + coords_qr_dinamico["alto"]
+        )
+        # get_matrix() ya incluye el borde de 1 módulo
+        _dibujar_matriz(pg1, rect_qr, _qr_jalisco(fol).get_matrix(), _GRIS_FONDO)
+        log.debug("[QR] Vectorial insertado ✅")
+    except Exception as e:
+        log.error("[ERROR QR] %s", e)
+
+def _insertar_pdf417_vector(pg1: fitz.Page, datos: dict):
+    texto = _texto_pdf417(datos)
+    if PDF417_DISPONIBLE:
+        try:
+            # render_image(scale=2, ratio=3) deja 20 px de padding: 10 módulos
+            # a lo ancho (2 px c/u) y 20/6 a lo alto (6 px c/u)
+            _dibujar_matriz(pg1, RECT_PDF417, _matriz_pdf417(_codigos_pdf417(texto)),
+                            _GRIS_FONDO, margen=(10, 20 / 6))
+            log.debug("[PDF417] Vectorial insertado ✅")
+            return
+        except Exception as e:
+            log.error("[ERROR PDF417] %s — usando QR fallback", e)
+    try:
+        _dibujar_matriz(pg1, RECT_PDF417, _qr_fallback_pdf417(texto).get_matrix(), (1, 1, 1))
+        log.debug("[QR FALLBACK] Vectorial insertado")
+    except Exception as e:
+        log.error("[ERROR QR FALLBACK] %s", e)
+
 # ============ FSM =============================================================
 
 class PermisoForm(StatesGroup):
@@ -1677,199 +2373,642 @@ class PermisoForm(StatesGroup):
 
 # ============ GENERACIÓN PDF ==================================================
 
-def _generar_pdf_unificado(datos: dict) -> str:
-    fol       = datos["folio"]
+@_fase("qr")
+def _insertar_qr(pg1: fitz.Page, fol: str):
+    if CODIGOS_VECTORIALES:
+        _insertar_qr_vector(pg1, fol)
+        return
+    img_qr = _generar_qr_jalisco(fol)
+    if img_qr:
+        buf = BytesIO()
+        img_qr.save(buf, format="PNG")
+        buf.seek(0)
+        pg1.insert_image(
+            fitz.Rect(
+                coords_qr_dinamico["x"],
+                coords_qr_dinamico["y"],
+                coords_qr_dinamico["x"] + coords_qr_dinamico["ancho"],
+                coords_qr_dinamico["y"] + coords_qr_dinamico["alto"]
+            ),
+            pixmap=fitz.Pixmap(buf.read()),
+            overlay=True
+        )
+        log.debug("[QR] Insertado ✅")
+
+@_fase("pdf417")
+def _insertar_pdf417(pg1: fitz.Page, datos: dict):
+    if CODIGOS_VECTORIALES:
+        _insertar_pdf417_vector(pg1, datos)
+        return
+    img_pdf417 = _generar_pdf417(datos)
+    if img_pdf417:
+        buf2 = BytesIO()
+        img_pdf417.save(buf2, format="PNG")
+        buf2.seek(0)
+        pg1.insert_image(
+            RECT_PDF417,
+            pixmap=fitz.Pixmap(buf2.read()),
+            keep_proportion=False,
+            overlay=True
+        )
+        log.debug("[PDF417] Insertado ✅")
+
+@_fase("texto")
+def _estampar_pagina1_conocidos(pg1: fitz.Page, datos: dict):
+    """Lo que no depende del nombre ni de la hora de emisión (pre-render)."""
+    fol = datos["folio"]
+
+    for campo in ["marca", "linea", "anio", "serie", "color"]:
+        if campo in coords_jalisco and campo in datos:
+            x, y, s, col = coords_jalisco[campo]
+            pg1.insert_text((x, y), datos[campo], fontsize=s, color=col, fontname="hebo")
+
+    pg1.insert_text((860, 364), fol, fontsize=14, color=(0,0,0), fontname="hebo")
+    pg1.insert_text((935, 600), f"*{fol}*", fontsize=30, color=(0,0,0), fontname="Courier")
+    pg1.insert_text((915, 775), "EXPEDICION: VENTANILLA 32",
+                    fontsize=12, color=(0,0,0), fontname="hebo")
+
+    # ── QR cuadrado ──
+    _insertar_qr(pg1, fol)
+
+@_fase("texto")
+def _estampar_pagina1_final(pg1: fitz.Page, datos: dict, fol_rep: int, ahora_cdmx: datetime):
+    """Nombre, fechas, folio DVM y PDF417 (depende del nombre)."""
     fecha_exp = datos["fecha_exp"]
     fecha_ven = datos["fecha_ven"]
 
-    zona_mexico = pytz.timezone("America/Mexico_City")
-    ahora_cdmx  = datetime.now(zona_mexico)
+    if "nombre" in coords_jalisco and "nombre" in datos:
+        x, y, s, col = coords_jalisco["nombre"]
+        pg1.insert_text((x, y), datos["nombre"], fontsize=s, color=col, fontname="hebo")
 
-    os.makedirs(OUTPUT_DIR, exist_ok=True)
-    out = os.path.join(OUTPUT_DIR, f"{fol}_completo.pdf")
+    pg1.insert_text(
+        coords_jalisco["fecha_ven"][:2],
+        fecha_ven.strftime("%d/%m/%Y"),
+        fontsize=coords_jalisco["fecha_ven"][2],
+        color=coords_jalisco["fecha_ven"][3]
+    )
 
-    try:
-        doc1 = fitz.open(stream=_plantilla1_bytes, filetype="pdf")
-        pg1  = doc1[0]
-
-        for campo in ["marca", "linea", "anio", "serie", "nombre", "color"]:
-            if campo in coords_jalisco and campo in datos:
-                x, y, s, col = coords_jalisco[campo]
-                pg1.insert_text((x, y), datos[campo], fontsize=s, color=col, fontname="hebo")
-
-        pg1.insert_text(
-            coords_jalisco["fecha_ven"][:2],
-            fecha_ven.strftime("%d/%m/%Y"),
-            fontsize=coords_jalisco["fecha_ven"][2],
-            color=coords_jalisco["fecha_ven"][3]
-        )
+    pg1.insert_text((475, 830), fecha_exp.strftime("%d/%m/%Y"),
+                    fontsize=32, color=(0,0,0), fontname="hebo")
 
-        pg1.insert_text((860, 364), fol, fontsize=14, color=(0,0,0), fontname="hebo")
-        pg1.insert_text((475, 830), fecha_exp.strftime("%d/%m/%Y"),
-                        fontsize=32, color=(0,0,0), fontname="hebo")
+    folio_grande = f"4A-DVM/{fol_rep}"
+    pg1.insert_text((240, 830), folio_grande, fontsize=32, color=(0,0,0), fontname="hebo")
+    pg1.insert_text((480, 182), folio_grande, fontsize=63, color=(0,0,0), fontname="hebo")
 
-        fol_rep      = obtener_folio_representativo()
-        folio_grande = f"4A-DVM/{fol_rep}"
-        pg1.insert_text((240, 830), folio_grande, fontsize=32, color=(0,0,0), fontname="hebo")
-        pg1.insert_text((480, 182), folio_grande, fontsize=63, color=(0,0,0), fontname="hebo")
+    folio_chico = (
+        f"DVM-{fol_rep}   "
+        f"{ahora_cdmx.strftime('%d/%m/%Y')}  "
+        f"{ahora_cdmx.strftime('%H:%M:%S')}"
+    )
+    pg1.insert_text((915, 760), folio_chico, fontsize=14, color=(0,0,0), fontname="hebo")
+
+    # ── PDF417 rectangular tamaño fijo ──
+    _insertar_pdf417(pg1, datos)
+
+def _estampar_pagina1(pg1: fitz.Page, datos: dict, fol_rep: int, ahora_cdmx: datetime):
+    _estampar_pagina1_conocidos(pg1, datos)
+    _estampar_pagina1_final(pg1, datos, fol_rep, ahora_cdmx)
+
+@_fase("texto")
+def _estampar_pagina2(pg2: fitz.Page, datos: dict, fp2: dict):
+    pg2.insert_text((380, 195), datos["fecha_exp"].strftime("%d/%m/%Y %H:%M"),
+                    fontsize=10, fontname="helv", color=(0,0,0))
+    pg2.insert_text((380, 290), datos["serie"],
+                    fontsize=10, fontname="helv", color=(0,0,0))
+
+    pg2.insert_text(coords_pagina2["referencia_pago"][:2],
+                    str(fp2["referencia_pago"]),
+                    fontsize=coords_pagina2["referencia_pago"][2],
+                    color=coords_pagina2["referencia_pago"][3])
+    pg2.insert_text(coords_pagina2["num_autorizacion"][:2],
+                    str(fp2["num_autorizacion"]),
+                    fontsize=coords_pagina2["num_autorizacion"][2],
+                    color=coords_pagina2["num_autorizacion"][3])
+    pg2.insert_text(coords_pagina2["total_pagado"][:2],
+                    f"${PRECIO_FIJO_PAGINA2}.00 MN",
+                    fontsize=coords_pagina2["total_pagado"][2],
+                    color=coords_pagina2["total_pagado"][3])
+    pg2.insert_text(coords_pagina2["folio_seguimiento"][:2],
+                    fp2["folio_seguimiento"],
+                    fontsize=coords_pagina2["folio_seguimiento"][2],
+                    color=coords_pagina2["folio_seguimiento"][3])
+    pg2.insert_text(coords_pagina2["linea_captura"][:2],
+                    str(fp2["linea_captura"]),
+                    fontsize=coords_pagina2["linea_captura"][2],
+                    color=coords_pagina2["linea_captura"][3])
+
+async def _preparar_payload_render(datos: dict) -> dict:
+    """
+    Reserva en el proceso principal los contadores que consume el render
+    (folio DVM y folios de página 2) y fija la hora de emisión, para que el
+    payload sea autocontenido y serializable hacia el pool de procesos.
+    """
+    payload = dict(datos)
+    payload["fol_rep"], payload["fp2"] = await reservar_contadores_render()
+    payload["ahora_cdmx"] = datetime.now(pytz.timezone("America/Mexico_City"))
+    return payload
+
+def _render_parcial(datos: dict) -> bytes:
+    """Pre-render: plantilla + campos conocidos de página 1 + QR."""
+    doc = _abrir_plantilla_base()
+    _estampar_pagina1_conocidos(doc[0], datos)
+    with _fase("guardado"):
+        pdf = doc.tobytes()
+    doc.close()
+    log.debug("[PDF PARCIAL] ✅ %s (%s bytes)", datos['folio'], len(pdf))
+    return pdf
+
+def _generar_pdf_unificado(datos: dict) -> bytes:
+    """
+    Render completo en memoria desde un payload de _preparar_payload_render;
+    devuelve los bytes del PDF final. Si el payload trae pdf_parcial
+    (pre-render especulativo) solo se estampa lo que falta encima.
+    """
+    fol = datos["folio"]
 
-        folio_chico = (
-            f"DVM-{fol_rep}   "
-            f"{ahora_cdmx.strftime('%d/%m/%Y')}  "
-            f"{ahora_cdmx.strftime('%H:%M:%S')}"
-        )
-        pg1.insert_text((915, 760), folio_chico, fontsize=14, color=(0,0,0), fontname="hebo")
-        incrementar_folio_representativo(fol_rep)
-
-        pg1.insert_text((935, 600), f"*{fol}*", fontsize=30, color=(0,0,0), fontname="Courier")
-        pg1.insert_text((915, 775), "EXPEDICION: VENTANILLA 32",
-                        fontsize=12, color=(0,0,0), fontname="hebo")
-
-        # ── QR cuadrado ──
-        img_qr = _generar_qr_jalisco(fol)
-        if img_qr:
-            buf = BytesIO()
-            img_qr.save(buf, format="PNG")
-            buf.seek(0)
-            pg1.insert_image(
-                fitz.Rect(
-                    coords_qr_dinamico["x"],
-                    coords_qr_dinamico["y"],
-                    coords_qr_dinamico["x"] + coords_qr_dinamico["ancho"],
-                    coords_qr_dinamico["y"] + coords_qr_dinamico["alto"]
-                ),
-                pixmap=fitz.Pixmap(buf.read()),
-                overlay=True
-            )
-            print("[QR] Insertado ✅")
-
-        # ── PDF417 rectangular tamaño fijo ──
-        img_pdf417 = _generar_pdf417(datos)
-        if img_pdf417:
-            buf2 = BytesIO()
-            img_pdf417.save(buf2, format="PNG")
-            buf2.seek(0)
-            pg1.insert_image(
-                RECT_PDF417,
-                pixmap=fitz.Pixmap(buf2.read()),
-                keep_proportion=False,
-                overlay=True
-            )
-            print("[PDF417] Insertado ✅")
-
-        # ── Página 2 ──
-        doc2 = fitz.open(stream=_plantilla2_bytes, filetype="pdf")
-        pg2  = doc2[0]
-
-        pg2.insert_text((380, 195), fecha_exp.strftime("%d/%m/%Y %H:%M"),
-                        fontsize=10, fontname="helv", color=(0,0,0))
-        pg2.insert_text((380, 290), datos["serie"],
-                        fontsize=10, fontname="helv", color=(0,0,0))
-
-        fp2 = generar_folios_pagina2()
-        pg2.insert_text(coords_pagina2["referencia_pago"][:2],
-                        str(fp2["referencia_pago"]),
-                        fontsize=coords_pagina2["referencia_pago"][2],
-                        color=coords_pagina2["referencia_pago"][3])
-        pg2.insert_text(coords_pagina2["num_autorizacion"][:2],
-                        str(fp2["num_autorizacion"]),
-                        fontsize=coords_pagina2["num_autorizacion"][2],
-                        color=coords_pagina2["num_autorizacion"][3])
-        pg2.insert_text(coords_pagina2["total_pagado"][:2],
-                        f"${PRECIO_FIJO_PAGINA2}.00 MN",
-                        fontsize=coords_pagina2["total_pagado"][2],
-                        color=coords_pagina2["total_pagado"][3])
-        pg2.insert_text(coords_pagina2["folio_seguimiento"][:2],
-                        fp2["folio_seguimiento"],
-                        fontsize=coords_pagina2["folio_seguimiento"][2],
-                        color=coords_pagina2["folio_seguimiento"][3])
-        pg2.insert_text(coords_pagina2["linea_captura"][:2],
-                        str(fp2["linea_captura"]),
-                        fontsize=coords_pagina2["linea_captura"][2],
-                        color=coords_pagina2["linea_captura"][3])
-
-        doc_final = fitz.open()
-        doc_final.insert_pdf(doc1)
-        doc_final.insert_pdf(doc2)
-        doc_final.save(out)
+    try:
+        parcial = datos.get("pdf_parcial")
+        if parcial:
+            with _fase("fusion"):
+                doc_final = fitz.open(stream=parcial, filetype="pdf")
+            _estampar_pagina1_final(doc_final[0], datos, datos["fol_rep"], datos["ahora_cdmx"])
+        else:
+            doc_final = _abrir_plantilla_base()
+            _estampar_pagina1(doc_final[0], datos, datos["fol_rep"], datos["ahora_cdmx"])
+        _estampar_pagina2(doc_final[1], datos, datos["fp2"])
+
+        with _fase("guardado"):
+            pdf = doc_final.tobytes()
         doc_final.close()
-        doc1.close()
-        doc2.close()
 
-        print(f"[PDF UNIFICADO] ✅ {out}")
+        log.debug("[PDF UNIFICADO] ✅ %s (%s bytes)", fol, len(pdf))
 
     except Exception as e:
-        print(f"[ERROR] Generando PDF: {e}")
+        log.error("Generando PDF: %s", e)
         doc_fb = fitz.open()
         doc_fb.new_page().insert_text((50, 50), f"ERROR - Folio: {fol}", fontsize=12)
-        doc_fb.save(out)
+        pdf = doc_fb.tobytes()
         doc_fb.close()
 
-    return out
+    return pdf
 
-# ============ BACKGROUND ======================================================
+# ── copia en disco opcional ───────────────────────────────────────────────────
 
-async def _generar_y_enviar_background(chat_id: int, datos: dict, user_id: int):
+_pdfs_en_disco: set[asyncio.Task] = set()   # escrituras en curso, se esperan al apagar
+
+def _guardar_pdf_en_fondo(folio: str, pdf: bytes):
+    tarea = asyncio.create_task(asyncio.to_thread(_persistir_pdf, folio, pdf))
+    _pdfs_en_disco.add(tarea)
+    tarea.add_done_callback(_fin_guardado_pdf)
+
+def _fin_guardado_pdf(tarea: asyncio.Task):
+    _pdfs_en_disco.discard(tarea)
+    if not tarea.cancelled() and tarea.exception() is not None:
+        log.warning("No se pudo guardar PDF en disco: %s", tarea.exception())
+
+async def esperar_pdfs_en_disco(timeout: float = 10):
+    if _pdfs_en_disco:
+        _, pendientes = await asyncio.wait(set(_pdfs_en_disco), timeout=timeout)
+        if pendientes:
+            log.warning("[PDF] %s copias en disco sin terminar al apagar", len(pendientes))
+
+def _persistir_pdf(folio: str, pdf: bytes):
+    """
+    Guarda documentos/{folio}_completo.pdf y poda los más viejos hasta que
+    el directorio quede bajo DOCUMENTOS_MAX_MB. Síncrono.
+    """
     try:
-        fecha_ven   = datos["fecha_ven"]
-        pdf_path    = await asyncio.to_thread(_generar_pdf_unificado, datos)
-        folio_final = datos["folio"]
-
-        keyboard = InlineKeyboardMarkup(inline_keyboard=[[
-            InlineKeyboardButton(text="🔑 Validar Admin", callback_data=f"validar_{folio_final}"),
-            InlineKeyboardButton(text="⏹️ Detener Timer", callback_data=f"detener_{folio_final}")
-        ]])
-
-        await bot.send_document(
-            chat_id,
-            FSInputFile(pdf_path),
-            caption=(
-                f"📋 PERMISO DE CIRCULACIÓN - JALISCO\n"
-                f"Folio: {folio_final}\nVigencia: 30 días ({fecha_ven.strftime('%d/%m/%Y')})\n\n"
-                f"✅ Documento con 2 páginas unificadas\n⏰ TIMER ACTIVO (36 horas)"
-            ),
-            reply_markup=keyboard
-        )
+        os.makedirs(OUTPUT_DIR, exist_ok=True)
+        with open(os.path.join(OUTPUT_DIR, f"{folio}_completo.pdf"), "wb") as f:
+            f.write(pdf)
+
+        archivos = []
+        total    = 0
+        with os.scandir(OUTPUT_DIR) as it:
+            for entrada in it:
+                if entrada.is_file() and entrada.name.endswith(".pdf"):
+                    st = entrada.stat()
+                    archivos.append((st.st_mtime, st.st_size, entrada.path))
+                    total += st.st_size
+
+        limite = int(DOCUMENTOS_MAX_MB * 1024 * 1024)
+        archivos.sort()
+        for _, tam, ruta in archivos:
+            if total <= limite:
+                break
+            with suppress(FileNotFoundError):
+                os.remove(ruta)
+            total -= tam
+    except Exception as e:
+        log.warning("No se pudo guardar PDF %s en disco: %s", folio, e)
+
+# ============ MOTOR DE RENDER (POOL DE PROCESOS) ==============================
+# PyMuPDF, qrcode y pdf417gen retienen el GIL; con un pool de procesos cada
+# render usa su propio núcleo. Los workers precargan plantillas y librerías
+# una vez. RENDER_COLA_MAX acota los renders en vuelo: si se llena, quien
+# llama espera (backpressure) en lugar de acumular trabajo sin límite.
+# RENDER_WORKERS=0 vuelve al render en el pool de hilos por defecto.
+#
+# Cada worker (spawn) reimporta app completo: Bot, almacén, listener de logs
+# y métricas. os.cpu_count() en un contenedor reporta los CPUs del host, así
+# que por defecto se usan los CPUs realmente asignados, con tope de
+# RENDER_WORKERS_MAX para no agotar la memoria de una instancia chica.
+
+def _cpus_disponibles() -> int:
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0)) or 1
+    return os.cpu_count() or 1
+
+RENDER_WORKERS_MAX = int(os.getenv("RENDER_WORKERS_MAX", "2"))
+RENDER_WORKERS  = int(os.getenv("RENDER_WORKERS", str(min(_cpus_disponibles(), RENDER_WORKERS_MAX))))
+RENDER_COLA_MAX = int(os.getenv("RENDER_COLA_MAX", str(max(1, RENDER_WORKERS) * 4)))
+
+_render_pool: ProcessPoolExecutor | None = None
+_render_slots: asyncio.Semaphore | None  = None
+_render_esperando = 0
+_render_en_vuelo  = 0
+_render_reinicio: asyncio.Task | None = None
+
+def _render_worker_init():
+    """Inicializador de cada proceso del pool: precarga y calienta."""
+    _cargar_plantillas()
+    try:
+        _generar_qr_jalisco("000000000")
+        _generar_pdf417({
+            "folio": "000000000", "marca": "-", "linea": "-", "anio": "0000",
+            "serie": "-", "motor": "-", "color": "-", "nombre": "-",
+        })
+    except Exception as e:
+        log.warning("[RENDER] Calentamiento de worker incompleto: %s", e)
+
+def _render_worker_ping() -> int:
+    return os.getpid()
+
+async def iniciar_motor_render():
+    global _render_pool, _render_slots
+    if _render_slots is None:
+        _render_slots = asyncio.Semaphore(RENDER_COLA_MAX)
+    if RENDER_WORKERS <= 0:
+        log.info("[RENDER] Pool de procesos desactivado — usando hilos")
+        return
+    _render_pool = ProcessPoolExecutor(
+        max_workers=RENDER_WORKERS,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_render_worker_init,
+    )
+    # Arranca todos los workers ahora para no pagar el spawn en el primer permiso
+    loop = asyncio.get_running_loop()
+    pids = await asyncio.gather(*(
+        loop.run_in_executor(_render_pool, _render_worker_ping) for _ in range(RENDER_WORKERS)
+    ))
+    log.info("[RENDER] Pool listo: %s workers, cola máx %s", len(set(pids)), RENDER_COLA_MAX)
+
+async def _reiniciar_motor_render():
+    try:
+        await iniciar_motor_render()
+    except Exception as e:
+        log.error("[RENDER] No se pudo recrear el pool, se sigue con hilos: %s", e)
+        detener_motor_render()
 
+def detener_motor_render():
+    global _render_pool
+    if _render_pool:
+        _render_pool.shutdown(wait=False, cancel_futures=True)
+        _render_pool = None
+
+async def renderizar_permiso(datos: dict) -> bytes:
+    """
+    Render completo del permiso; devuelve los bytes del PDF. Si los datos ya
+    traen fol_rep (payload preparado o reenvío) no se reservan contadores.
+    """
+    if "fol_rep" not in datos:
+        datos = await _preparar_payload_render(datos)
+    return await _ejecutar_render(_generar_pdf_unificado, datos)
+
+async def renderizar_parcial(datos: dict) -> bytes:
+    """Pre-render especulativo (sin nombre ni fechas); ver _render_parcial."""
+    return await _ejecutar_render(_render_parcial, datos)
+
+async def _ejecutar_render(fn, payload: dict) -> bytes:
+    tipo = "parcial" if fn is _render_parcial else "completo"
+    t0 = time.perf_counter()
+    with span(f"render {tipo}", pool=_render_pool is not None,
+              parcial_reusado="pdf_parcial" in payload):
+        pdf, fases = await _ejecutar_render_medido(fn, payload)
+        etiquetar(bytes=len(pdf), **{f"fase.{f}_ms": round(s * 1000, 3) for f, s in fases.items()})
+    M_RENDER.observar(time.perf_counter() - t0, tipo)
+    for fase, segundos in fases.items():
+        M_RENDER_FASE.observar(segundos, tipo, fase)
+    return pdf
+
+async def _ejecutar_render_medido(fn, payload: dict) -> tuple[bytes, dict]:
+    global _render_esperando, _render_en_vuelo, _render_reinicio
+    if _render_slots is None:
+        return await asyncio.to_thread(_render_medido, fn, payload)
+
+    _render_esperando += 1
+    try:
+        await _render_slots.acquire()
+    finally:
+        _render_esperando -= 1
+    _render_en_vuelo += 1
+    try:
+        pool = _render_pool
+        if pool is None:
+            return await asyncio.to_thread(_render_medido, fn, payload)
         try:
-            await asyncio.to_thread(_sb_insertar_borrador, datos, user_id)
-        except Exception as e:
-            print(f"[WARN] Error guardando borradores: {e}")
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(pool, _render_medido, fn, payload)
+        except BrokenProcessPool:
+            log.warning("[RENDER] Pool roto — recreando y renderizando en hilo")
+            if _render_pool is pool:
+                detener_motor_render()
+                if _render_reinicio is None or _render_reinicio.done():
+                    _render_reinicio = asyncio.create_task(_reiniciar_motor_render())
+            return await asyncio.to_thread(_render_medido, fn, payload)
+    finally:
+        _render_en_vuelo -= 1
+        _render_slots.release()
+
+# ============ PRE-RENDER ESPECULATIVO =========================================
+# Al llegar el color ya se conocen marca, línea, año, serie y motor: se
+# reserva el folio y se pre-renderiza en segundo plano lo que no depende del
+# nombre ni de la hora de emisión (campos conocidos, folio, QR). Con el
+# nombre solo falta estamparlo junto con fechas, folio DVM, PDF417 y página
+# 2. Si el formulario se abandona (/start, /chuleta o RENDER_ESPECULATIVO_TTL
+# sin respuesta) el folio reservado se descarta, igual que los sobrantes de
+# un bloque del lease: los folios emitidos nunca retroceden. Solo se
+# especula si no hay renders esperando turno.
+#
+# Desactivado por defecto (RENDER_ESPECULATIVO=1 para activarlo) porque
+# tiene dos huecos conocidos:
+#   - cada formulario abandonado después del color quema un número de folio
+#     (queda un hueco en la numeración; el folio y el QR van en el parcial,
+#     así que no se puede especular sin reservarlo);
+#   - el pre-render vive en la memoria del proceso que recibió el color. Con
+#     ALMACEN_URL (varios workers compartiendo el FSM) el nombre puede llegar
+#     a otro worker y el pre-render nunca se reclamaría, así que ahí se
+#     desactiva siempre.
+
+ESPECULATIVO     = os.getenv("RENDER_ESPECULATIVO", "0") == "1" and not ALMACEN_URL
+ESPECULATIVO_TTL = int(os.getenv("RENDER_ESPECULATIVO_TTL", "1800"))   # segundos
+
+class Especulacion(NamedTuple):
+    prefijo: str
+    tarea:   asyncio.Task   # → (folio, pdf parcial)
+    creado:  float          # time.monotonic()
+
+_especulaciones: dict[int, Especulacion] = {}
+_especulacion_limpieza: asyncio.Task | None = None
+
+async def _especular(prefijo_num: str, datos: dict) -> tuple[str, bytes]:
+    folio = await generar_folio_con_prefijo(prefijo_num)
+    return folio, await renderizar_parcial({**datos, "folio": folio})
+
+def iniciar_especulacion(user_id: int, datos: dict, prefijo_num: str = "1"):
+    if not ESPECULATIVO or _render_esperando:
+        return
+    descartar_especulacion(user_id)
+    tarea = asyncio.create_task(_especular(prefijo_num, dict(datos)))
+    tarea.add_done_callback(lambda t: t.cancelled() or t.exception())
+    _especulaciones[user_id] = Especulacion(prefijo_num, tarea, time.monotonic())
+    _asegurar_limpieza_especulaciones()
+
+def descartar_especulacion(user_id: int):
+    esp = _especulaciones.pop(user_id, None)
+    if esp is None:
+        return
+    if not esp.tarea.done():
+        esp.tarea.cancel()
+    elif not esp.tarea.cancelled() and esp.tarea.exception() is None:
+        log.debug("[ESPECULATIVO] Folio %s descartado (prefijo %s)", esp.tarea.result()[0], esp.prefijo)
+
+async def tomar_especulacion(user_id: int) -> tuple[str, bytes] | None:
+    """(folio, pdf parcial) pre-renderizados para el usuario, si los hay."""
+    esp = _especulaciones.pop(user_id, None)
+    if esp is None:
+        return None
+    try:
+        return await esp.tarea
+    except Exception as e:
+        log.warning("[ESPECULATIVO] Pre-render de %s falló, render completo: %s", user_id, e)
+        return None
 
-        await iniciar_timer_eliminacion(user_id, folio_final)
+async def _limpiar_especulaciones():
+    while True:
+        await asyncio.sleep(60)
+        limite = time.monotonic() - ESPECULATIVO_TTL
+        for user_id in [u for u, e in _especulaciones.items() if e.creado < limite]:
+            descartar_especulacion(user_id)
+
+def _asegurar_limpieza_especulaciones():
+    global _especulacion_limpieza
+    if _especulacion_limpieza is None or _especulacion_limpieza.done():
+        _especulacion_limpieza = asyncio.create_task(_limpiar_especulaciones())
+
+# ============ CACHE FILE_ID TELEGRAM ==========================================
+# Tras el primer envío, Telegram ya tiene el PDF: reenviar por file_id no
+# renderiza ni sube nada. El file_id y las entradas del render original
+# (folio DVM, folios de página 2, hora de emisión y fechas completas) se
+# guardan en folios_registrados (sql/entregas_documentos.sql), así cualquier
+# worker los encuentra y sobreviven a un redeploy; un reenvío re-renderizado
+# produce el MISMO documento sin consumir contadores. En memoria queda solo
+# una cache LRU de FILE_IDS_MAX folios para no releer la fila.
+
+FILE_IDS_MAX = int(os.getenv("FILE_IDS_MAX", "5000"))
+
+_file_ids: OrderedDict[str, dict] = OrderedDict()   # folio -> {"file_id", "render"}
+
+def _recordar_entrega(folio: str, entrega: dict):
+    _file_ids.pop(folio, None)
+    _file_ids[folio] = entrega
+    while len(_file_ids) > FILE_IDS_MAX:
+        _file_ids.popitem(last=False)
+
+def _entradas_render(payload: dict) -> dict:
+    """Payload de _preparar_payload_render → entradas serializables del render."""
+    return {
+        "fol_rep":    payload["fol_rep"],
+        "fp2":        payload["fp2"],
+        "ahora_cdmx": payload["ahora_cdmx"].isoformat(),
+        "fecha_exp":  payload["fecha_exp"].isoformat(),
+        "fecha_ven":  payload["fecha_ven"].isoformat(),
+    }
 
-        await bot.send_message(
-            user_id,
-            "💰 INSTRUCCIONES DE PAGO\n\n"
-            f"📄 Folio: {folio_final}\n"
-            f"💵 Monto: ${PRECIO_PERMISO}\n"
-            "⏰ Tiempo límite: 36 horas\n\n"
-            "🏦 TRANSFERENCIA:\n"
-            "• Institución: SPIN BY OXXO\n"
-            "• Titular: GUILLERMO S.R\n"
-            "• Cuenta: 728969000048442454\n"
-            f"• Concepto: Permiso {folio_final}\n\n"
-            "🏪 OXXO:\n"
-            "• Referencia: 2242170180214090\n"
-            "• Titular: GUILLERMO S.R\n\n"
-            "📸 Envía foto del comprobante para validar.\n"
-            "⚠️ Sin pago en 36h el folio se elimina.\n\n"
-            "📋 Para generar otro permiso use /chuleta"
+async def registrar_file_id(folio: str, file_id: str, render: dict):
+    _recordar_entrega(folio, {"file_id": file_id, "render": render})
+    try:
+        await supabase.table("folios_registrados").update({
+            "telegram_file_id": file_id,
+            "render_entradas":  render,
+        }).eq("folio", folio).execute()
+    except Exception as e:
+        log.warning("No se pudo persistir file_id %s: %s", folio, e)
+
+async def _sb_leer_folio(folio: str) -> dict | None:
+    r = await supabase.table("folios_registrados").select("*").eq("folio", folio).limit(1).execute()
+    return r.data[0] if r.data else None
+
+def _entrega_de_registro(registro: dict) -> dict:
+    """file_id y entradas del render: cache local o, si no, la fila de BD."""
+    entrega = _file_ids.get(registro["folio"])
+    if entrega is None:
+        render = registro.get("render_entradas")
+        if isinstance(render, str):
+            with suppress(ValueError):
+                render = json.loads(render)
+        entrega = {"file_id": registro.get("telegram_file_id"),
+                   "render":  render if isinstance(render, dict) else None}
+    return entrega
+
+def _datos_desde_registro(registro: dict, render: dict | None) -> dict:
+    """
+    Fila de folios_registrados → datos de render. Con las entradas del render
+    original el payload sale completo (no reserva contadores ni toma la hora
+    actual); sin ellas renderizar_permiso reserva contadores nuevos.
+    """
+    datos = {
+        "folio":  registro["folio"],
+        "marca":  registro["marca"],
+        "linea":  registro["linea"],
+        "anio":   str(registro["anio"]),
+        "serie":  registro["numero_serie"],
+        "motor":  registro["numero_motor"],
+        "color":  registro["color"],
+        "nombre": registro["nombre"],
+    }
+    if render:
+        datos.update(
+            fol_rep    = render["fol_rep"],
+            fp2        = render["fp2"],
+            ahora_cdmx = datetime.fromisoformat(render["ahora_cdmx"]),
+            fecha_exp  = datetime.fromisoformat(render["fecha_exp"]),
+            fecha_ven  = datetime.fromisoformat(render["fecha_ven"]),
         )
+    else:
+        fecha_exp = datetime.fromisoformat(str(registro["fecha_expedicion"]))
+        datos.update(fecha_exp=fecha_exp, fecha_ven=fecha_exp + timedelta(days=30))
+    return datos
+
+_VIAS_REENVIO = {
+    "cache":        "file_id guardado",
+    "render":       "render con las entradas originales",
+    "reconstruido": "render nuevo desde el registro",
+}
 
-    except Exception as e:
-        print(f"[ERROR] background folio {datos.get('folio','?')}: {e}")
+async def reenviar_permiso(chat_id: int, registro: dict) -> str:
+    """
+    Reenvía el PDF del folio. Con file_id (cache o BD): cero render, cero
+    bytes subidos. Si no hay file_id o Telegram lo rechaza se renderiza de
+    nuevo con las entradas del render original; un folio sin entradas
+    guardadas (emitido antes de guardarlas) se reconstruye desde la fila.
+    Devuelve "cache", "render" o "reconstruido".
+    """
+    folio   = registro["folio"]
+    caption = (
+        f"📋 PERMISO DE CIRCULACIÓN - JALISCO\n"
+        f"Folio: {folio}\n\n🔁 Reenvío del documento"
+    )
+    entrega = _entrega_de_registro(registro)
+    if entrega.get("file_id"):
+        try:
+            await bot.send_document(chat_id, entrega["file_id"], caption=caption)
+            _recordar_entrega(folio, entrega)
+            return "cache"
+        except TelegramBadRequest as e:
+            log.warning("[FILE_ID] %s rechazado por Telegram, re-renderizando: %s", folio, e)
+
+    payload = _datos_desde_registro(registro, entrega.get("render"))
+    if "fol_rep" not in payload:
+        log.warning("[FILE_ID] %s sin entradas del render original, se reconstruye", folio)
+        payload = await _preparar_payload_render(payload)
+    pdf_bytes = await renderizar_permiso(payload)
+    enviado   = await bot.send_document(
+        chat_id,
+        BufferedInputFile(pdf_bytes, filename=f"{folio}_completo.pdf"),
+        caption=caption
+    )
+    await registrar_file_id(folio, enviado.document.file_id, _entradas_render(payload))
+    return "render" if entrega.get("render") else "reconstruido"
+
+# ============ BACKGROUND ======================================================
+
+async def _generar_y_enviar_background(chat_id: int, datos: dict, user_id: int):
+    with span("background", folio=datos.get("folio"), user_id=user_id), \
+         campos_log(folio=datos.get("folio"), user_id=user_id):
         try:
-            await bot.send_message(user_id,
-                f"❌ Error al generar el documento: {e}\n\nUse /chuleta para reintentar.")
-        except Exception:
-            pass
+            fecha_ven   = datos["fecha_ven"]
+            payload     = await _preparar_payload_render(datos)
+            pdf_bytes   = await renderizar_permiso(payload)
+            folio_final = datos["folio"]
+
+            keyboard = InlineKeyboardMarkup(inline_keyboard=[[
+                InlineKeyboardButton(text="🔑 Validar Admin", callback_data=f"validar_{folio_final}"),
+                InlineKeyboardButton(text="⏹️ Detener Timer", callback_data=f"detener_{folio_final}")
+            ]])
+
+            enviado = await bot.send_document(
+                chat_id,
+                BufferedInputFile(pdf_bytes, filename=f"{folio_final}_completo.pdf"),
+                caption=(
+                    f"📋 PERMISO DE CIRCULACIÓN - JALISCO\n"
+                    f"Folio: {folio_final}\nVigencia: 30 días ({fecha_ven.strftime('%d/%m/%Y')})\n\n"
+                    f"✅ Documento con 2 páginas unificadas\n⏰ TIMER ACTIVO (36 horas)"
+                ),
+                reply_markup=keyboard
+            )
+
+            with span("registrar_file_id"):
+                await registrar_file_id(folio_final, enviado.document.file_id,
+                                        _entradas_render(payload))
+
+            if GUARDAR_PDFS:
+                _guardar_pdf_en_fondo(folio_final, pdf_bytes)
+
+            with span("insertar_borrador"):
+                try:
+                    await _sb_insertar_borrador(datos, user_id)
+                except Exception as e:
+                    marcar_error(e)
+                    log.warning("Error guardando borradores: %s", e)
+
+            with span("iniciar_timer"):
+                await iniciar_timer_eliminacion(user_id, folio_final)
+
+            await bot.send_message(
+                user_id,
+                "💰 INSTRUCCIONES DE PAGO\n\n"
+                f"📄 Folio: {folio_final}\n"
+                f"💵 Monto: ${PRECIO_PERMISO}\n"
+                "⏰ Tiempo límite: 36 horas\n\n"
+                "🏦 TRANSFERENCIA:\n"
+                "• Institución: SPIN BY OXXO\n"
+                "• Titular: GUILLERMO S.R\n"
+                "• Cuenta: 728969000048442454\n"
+                f"• Concepto: Permiso {folio_final}\n\n"
+                "🏪 OXXO:\n"
+                "• Referencia: 2242170180214090\n"
+                "• Titular: GUILLERMO S.R\n\n"
+                "📸 Envía foto del comprobante para validar.\n"
+                "⚠️ Sin pago en 36h el folio se elimina.\n\n"
+                "📋 Para generar otro permiso use /chuleta"
+            )
+
+        except Exception as e:
+            marcar_error(e)
+            log.exception("background folio %s: %s", datos.get('folio','?'), e)
+            try:
+                await bot.send_message(user_id,
+                    f"❌ Error al generar el documento: {e}\n\nUse /chuleta para reintentar.")
+            except Exception:
+                pass
 
 # ============ HANDLERS ========================================================
 
 @dp.message(Command("start"))
 async def start_cmd(message: types.Message, state: FSMContext):
     await state.clear()
+    descartar_especulacion(message.from_user.id)
     await message.answer(
         "🏛️ SISTEMA DIGITAL DEL ESTADO DE JALISCO\n\n"
         f"💰 Costo: ${PRECIO_PERMISO}\n"
@@ -1880,6 +3019,7 @@ async def start_cmd(message: types.Message, state: FSMContext):
 @dp.message(Command("chuleta"))
 async def chuleta_cmd(message: types.Message, state: FSMContext):
     await state.clear()
+    descartar_especulacion(message.from_user.id)
     folios_activos = obtener_folios_usuario(message.from_user.id)
 
     if folios_activos:
@@ -1887,7 +3027,7 @@ async def chuleta_cmd(message: types.Message, state: FSMContext):
         for f in folios_activos:
             if f in timers_activos:
                 mins = max(0, 2160 - int(
-                    (datetime.now() - timers_activos[f]["start_time"]).total_seconds() / 60
+                    (datetime.now() - timers_activos[f].start_time).total_seconds() / 60
                 ))
                 lineas.append(f"• {f}  ({mins//60}h {mins%60}min restantes)")
             else:
@@ -1949,6 +3089,7 @@ async def get_color(message: types.Message, state: FSMContext):
     await state.update_data(color=message.text.strip().upper())
     await message.answer("NOMBRE COMPLETO del propietario:")
     await state.set_state(PermisoForm.nombre)
+    iniciar_especulacion(message.from_user.id, await state.get_data())
 
 @dp.message(PermisoForm.nombre)
 async def get_nombre(message: types.Message, state: FSMContext):
@@ -1959,25 +3100,34 @@ async def get_nombre(message: types.Message, state: FSMContext):
     datos["fecha_ven"] = hoy + timedelta(days=30)
     await state.clear()
 
-    ok = await guardar_folio_con_reintento(
-        datos, message.from_user.id, message.from_user.username, "1"
-    )
-    if not ok:
-        await message.answer(
-            "❌ No se pudo registrar el folio. Intenta de nuevo con /chuleta\n\n"
-            "📋 Para generar otro permiso use /chuleta"
+    # Raíz de la traza del folio; el background la hereda vía create_task
+    with traza("permiso", user_id=message.from_user.id, chat_id=message.chat.id):
+        with span("tomar_especulacion"):
+            especulado = await tomar_especulacion(message.from_user.id)
+            etiquetar(acierto=especulado is not None)
+        if especulado:
+            datos["folio"], datos["pdf_parcial"] = especulado
+
+        ok = await guardar_folio_con_reintento(
+            datos, message.from_user.id, message.from_user.username, "1"
         )
-        return
+        etiquetar(folio=datos.get("folio"), registrado=ok)
+        if not ok:
+            await message.answer(
+                "❌ No se pudo registrar el folio. Intenta de nuevo con /chuleta\n\n"
+                "📋 Para generar otro permiso use /chuleta"
+            )
+            return
 
-    await message.answer(
-        f"🔄 Generando documentación...\n"
-        f"<b>Folio:</b> {datos['folio']}\n"
-        f"<b>Titular:</b> {datos['nombre']}",
-        parse_mode="HTML"
-    )
-    asyncio.create_task(
-        _generar_y_enviar_background(message.chat.id, datos, message.from_user.id)
-    )
+        await message.answer(
+            f"🔄 Generando documentación...\n"
+            f"<b>Folio:</b> {datos['folio']}\n"
+            f"<b>Titular:</b> {datos['nombre']}",
+            parse_mode="HTML"
+        )
+        asyncio.create_task(
+            _generar_y_enviar_background(message.chat.id, datos, message.from_user.id)
+        )
 
 # ============ CALLBACKS =======================================================
 
@@ -1985,20 +3135,14 @@ async def get_nombre(message: types.Message, state: FSMContext):
 async def callback_validar_admin(callback: CallbackQuery):
     folio = callback.data.replace("validar_", "")
     if folio in timers_activos:
-        user_con_folio = timers_activos[folio]["user_id"]
-        cancelar_timer_folio(folio)
+        user_con_folio = timers_activos[folio].user_id
+        await cancelar_timer_folio(folio)
         try:
-            now = datetime.now().isoformat()
-            await asyncio.to_thread(lambda: (
-                supabase.table("folios_registrados").update(
-                    {"estado": "VALIDADO_ADMIN", "fecha_comprobante": now}
-                ).eq("folio", folio).execute(),
-                supabase.table("borradores_registros").update(
-                    {"estado": "VALIDADO_ADMIN", "fecha_comprobante": now}
-                ).eq("folio", folio).execute(),
-            ))
+            res = await transicionar_folio(folio, "VALIDADO_ADMIN")
+            if not res.folios:
+                log.warning("Folio %s validado pero sin fila en folios_registrados", folio)
         except Exception as e:
-            print(f"Error actualizando BD folio {folio}: {e}")
+            log.error("Error actualizando BD folio %s: %s", folio, e)
         await callback.answer("✅ Folio validado por administración", show_alert=True)
         await callback.message.edit_reply_markup(reply_markup=None)
         try:
@@ -2009,7 +3153,7 @@ async def callback_validar_admin(callback: CallbackQuery):
                 f"📋 Para generar otro permiso use /chuleta"
             )
         except Exception as e:
-            print(f"Error notificando usuario: {e}")
+            log.error("Error notificando usuario: %s", e)
     else:
         await callback.answer("❌ Folio no encontrado en timers activos", show_alert=True)
 
@@ -2017,15 +3161,16 @@ async def callback_validar_admin(callback: CallbackQuery):
 async def callback_detener_timer(callback: CallbackQuery):
     folio = callback.data.replace("detener_", "")
     if folio in timers_activos:
-        cancelar_timer_folio(folio)
+        # Ambas tablas salen de PENDIENTE (si el borrador se quedara así, el
+        # barrido lo volvería a traer como candidato en cada consulta). BD
+        # primero: si falla, el timer sigue y el usuario puede reintentar.
         try:
-            await asyncio.to_thread(lambda:
-                supabase.table("folios_registrados").update(
-                    {"estado": "TIMER_DETENIDO", "fecha_detencion": datetime.now().isoformat()}
-                ).eq("folio", folio).execute()
-            )
+            await transicionar_folio(folio, "TIMER_DETENIDO")
         except Exception as e:
-            print(f"Error actualizando BD: {e}")
+            log.error("Error actualizando BD: %s", e)
+            await callback.answer("❌ No se pudo detener el timer. Intenta de nuevo.", show_alert=True)
+            return
+        await cancelar_timer_folio(folio)
         await callback.answer("⏹️ Timer detenido exitosamente", show_alert=True)
         await callback.message.edit_reply_markup(reply_markup=None)
         await callback.message.answer(
@@ -2038,49 +3183,98 @@ async def callback_detener_timer(callback: CallbackQuery):
 
 # ============ ADMIN SERO ======================================================
 
+# Un mensaje puede traer varios folios separados por coma, espacio o renglón
+# (SERO opcional en cada uno). BD, timers y avisos se hacen en lote: una
+# actualización in_ por tabla (en trozos de SB_IN_MAX), luego se cancelan
+# los timers de lo actualizado y los avisos salen en segundo plano por el
+# limitador de envíos.
+
+SERO_LISTA_MAX = 50   # folios listados por grupo en el resumen (límite de 4096 caracteres)
+
+def _folios_sero(texto: str) -> list[str]:
+    folios = (t[4:] if t.startswith("SERO") else t for t in re.split(r"[\s,;]+", texto.upper()))
+    return list(dict.fromkeys(f for f in folios if f))
+
+def _lista_folios(folios: list[str]) -> str:
+    lineas = [f"• {f}" for f in folios[:SERO_LISTA_MAX]]
+    if len(folios) > SERO_LISTA_MAX:
+        lineas.append(f"… y {len(folios) - SERO_LISTA_MAX} más")
+    return "\n".join(lineas)
+
+async def _avisar_validacion(user_id: int, folios: list[str]):
+    if len(folios) == 1:
+        detalle = f"Folio: {folios[0]}\nTu permiso está activo."
+    else:
+        detalle = f"Folios:\n{_lista_folios(folios)}\nTus permisos están activos."
+    try:
+        await bot.send_message(
+            user_id,
+            f"✅ PAGO VALIDADO POR ADMINISTRACIÓN - JALISCO\n{detalle}\n\n"
+            f"📋 Para generar otro permiso use /chuleta"
+        )
+    except Exception as e:
+        log.error("Error notificando usuario %s: %s", user_id, e)
+
+async def _notificar_validados(cancelados: dict[str, int]):
+    por_usuario: dict[int, list[str]] = {}
+    for folio, user_id in cancelados.items():
+        if user_id:
+            por_usuario.setdefault(user_id, []).append(folio)
+    await asyncio.gather(*(_avisar_validacion(u, f) for u, f in por_usuario.items()))
+
 @dp.message(lambda m: m.text and m.text.strip().upper().startswith("SERO"))
 async def codigo_admin(message: types.Message):
-    texto = message.text.strip().upper()
-    if len(texto) <= 4:
+    folios = _folios_sero(message.text)
+    if not folios:
         await message.answer(
-            "⚠️ Formato: SERO[folio]\nEjemplo: SERO980000000\n\n"
+            "⚠️ Formato: SERO[folio]\nEjemplo: SERO980000000\n"
+            "Varios: SERO980000000, 980000001 (o uno por renglón)\n\n"
             "📋 Para generar otro permiso use /chuleta"
         )
         return
-    folio_admin = texto[4:]
-    if folio_admin in timers_activos:
-        user_con_folio = timers_activos[folio_admin]["user_id"]
-        cancelar_timer_folio(folio_admin)
-        try:
-            now = datetime.now().isoformat()
-            await asyncio.to_thread(lambda: (
-                supabase.table("folios_registrados").update(
-                    {"estado": "VALIDADO_ADMIN", "fecha_comprobante": now}
-                ).eq("folio", folio_admin).execute(),
-                supabase.table("borradores_registros").update(
-                    {"estado": "VALIDADO_ADMIN", "fecha_comprobante": now}
-                ).eq("folio", folio_admin).execute(),
-            ))
-        except Exception as e:
-            print(f"Error actualizando BD folio {folio_admin}: {e}")
-        await message.answer(
-            f"✅ VALIDACIÓN OK\nFolio: {folio_admin}\nTimer cancelado.\n\n"
-            f"📋 Para generar otro permiso use /chuleta"
+    # Un solo folio sigue como siempre; el lote (validar y cancelar timers
+    # de muchos folios con un mensaje) es solo para ADMIN_IDS
+    if len(folios) > 1 and message.from_user.id not in ADMIN_IDS:
+        log.warning("[SERO] Lote de %s folios rechazado: %s no es admin", len(folios), message.from_user.id)
+        await message.answer("🏛️ Sistema Digital Jalisco.")
+        return
+    # Primero la BD: el timer se cancela y el usuario se entera solo de los
+    # folios que de verdad quedaron VALIDADO_ADMIN. Los que fallen conservan
+    # su timer (y siguen PENDIENTE, así que el barrido no borra un pagado).
+    activos = {f: t.user_id for f in folios if (t := timers_activos.get(f)) is not None}
+    no_encontrados = [f for f in folios if f not in activos]
+    actualizados, borradores, fallidos = set(), 0, []
+    if activos:
+        trozos = _trozos(list(activos), SB_IN_MAX)
+        resultados = await asyncio.gather(
+            *(transicionar_folios(trozo, "VALIDADO_ADMIN") for trozo in trozos),
+            return_exceptions=True,
         )
-        try:
-            await bot.send_message(
-                user_con_folio,
-                f"✅ PAGO VALIDADO POR ADMINISTRACIÓN - JALISCO\n"
-                f"Folio: {folio_admin}\nTu permiso está activo.\n\n"
-                f"📋 Para generar otro permiso use /chuleta"
-            )
-        except Exception as e:
-            print(f"Error notificando usuario: {e}")
-    else:
-        await message.answer(
-            f"❌ Folio {folio_admin} no encontrado en timers activos.\n\n"
-            f"📋 Para generar otro permiso use /chuleta"
+        for trozo, res in zip(trozos, resultados):
+            if isinstance(res, Exception):
+                log.error("Error actualizando BD de %s folios: %s", len(trozo), res)
+                fallidos += trozo
+                continue
+            actualizados.update(f["folio"] for f in res.folios)
+            borradores += len(res.borradores)
+            fallidos += [f for f in trozo if f not in actualizados]
+    validados = [f for f in activos if f in actualizados]
+    partes = []
+    if validados:
+        await cancelar_timers(validados)
+        _disparar(_notificar_validados({f: activos[f] for f in validados}))
+        partes.append(
+            f"✅ VALIDACIÓN OK ({len(validados)} de {len(folios)})\n"
+            f"{_lista_folios(validados)}\n"
+            f"Timers cancelados.\nBD: {len(validados)} registro(s), {borradores} borrador(es) actualizados"
         )
+    if fallidos:
+        partes.append(f"⚠️ Sin actualizar en BD, timer intacto ({len(fallidos)}):\n"
+                      f"{_lista_folios(fallidos)}\nReintente con SERO.")
+    if no_encontrados:
+        partes.append(f"❌ No encontrados en timers activos ({len(no_encontrados)}):\n"
+                      f"{_lista_folios(no_encontrados)}")
+    await message.answer("\n\n".join(partes) + "\n\n📋 Para generar otro permiso use /chuleta")
 
 # ============ COMPROBANTE =====================================================
 
@@ -2096,7 +3290,7 @@ async def recibir_comprobante(message: types.Message):
             return
         if len(folios_usuario) > 1:
             lista = "\n".join(f"• {f}" for f in folios_usuario)
-            pending_comprobantes[user_id] = "waiting_folio"
+            await pending_comprobantes.asignar(user_id, "waiting_folio")
             await message.answer(
                 f"📄 Tienes varios folios activos:\n\n{lista}\n\n"
                 f"Responde con el NÚMERO DE FOLIO para este comprobante.\n\n"
@@ -2104,29 +3298,22 @@ async def recibir_comprobante(message: types.Message):
             )
             return
         folio = folios_usuario[0]
-        cancelar_timer_folio(folio)
-        now = datetime.now().isoformat()
-        await asyncio.to_thread(lambda: (
-            supabase.table("folios_registrados").update(
-                {"estado": "COMPROBANTE_ENVIADO", "fecha_comprobante": now}
-            ).eq("folio", folio).execute(),
-            supabase.table("borradores_registros").update(
-                {"estado": "COMPROBANTE_ENVIADO", "fecha_comprobante": now}
-            ).eq("folio", folio).execute(),
-        ))
+        await cancelar_timer_folio(folio)
+        res = await transicionar_folio(folio, "COMPROBANTE_ENVIADO")
+        if not res.folios:
+            log.warning("Comprobante de %s sin fila en folios_registrados", folio)
         await message.answer(
             f"✅ Comprobante recibido.\n📄 Folio: {folio}\n⏹️ Timer detenido.\n\n"
             f"📋 Para generar otro permiso use /chuleta"
         )
     except Exception as e:
-        print(f"[ERROR] recibir_comprobante: {e}")
+        log.exception("recibir_comprobante: %s", e)
         await message.answer(
             "❌ Error procesando comprobante. Intenta de nuevo.\n\n"
             "📋 Para generar otro permiso use /chuleta"
         )
 
-@dp.message(lambda m: m.from_user.id in pending_comprobantes
-            and pending_comprobantes[m.from_user.id] == "waiting_folio")
+@dp.message(lambda m: pending_comprobantes.get(m.from_user.id) == "waiting_folio")
 async def especificar_folio_comprobante(message: types.Message):
     try:
         user_id   = message.from_user.id
@@ -2137,24 +3324,18 @@ async def especificar_folio_comprobante(message: types.Message):
                 "📋 Para generar otro permiso use /chuleta"
             )
             return
-        cancelar_timer_folio(folio_esp)
-        del pending_comprobantes[user_id]
-        now = datetime.now().isoformat()
-        await asyncio.to_thread(lambda: (
-            supabase.table("folios_registrados").update(
-                {"estado": "COMPROBANTE_ENVIADO", "fecha_comprobante": now}
-            ).eq("folio", folio_esp).execute(),
-            supabase.table("borradores_registros").update(
-                {"estado": "COMPROBANTE_ENVIADO", "fecha_comprobante": now}
-            ).eq("folio", folio_esp).execute(),
-        ))
+        await cancelar_timer_folio(folio_esp)
+        await pending_comprobantes.sacar(user_id)
+        res = await transicionar_folio(folio_esp, "COMPROBANTE_ENVIADO")
+        if not res.folios:
+            log.warning("Comprobante de %s sin fila en folios_registrados", folio_esp)
         await message.answer(
             f"✅ Comprobante asociado.\n📄 Folio: {folio_esp}\n⏹️ Timer detenido.\n\n"
             f"📋 Para generar otro permiso use /chuleta"
         )
     except Exception as e:
-        print(f"[ERROR] especificar_folio: {e}")
-        pending_comprobantes.pop(message.from_user.id, None)
+        log.exception("especificar_folio: %s", e)
+        await pending_comprobantes.sacar(message.from_user.id)
         await message.answer(
             "❌ Error. Intenta de nuevo.\n\n📋 Para generar otro permiso use /chuleta"
         )
@@ -2172,7 +3353,7 @@ async def ver_folios_activos(message: types.Message):
     for folio in folios_usuario:
         if folio in timers_activos:
             mins = max(0, 2160 - int(
-                (datetime.now() - timers_activos[folio]["start_time"]).total_seconds() / 60
+                (datetime.now() - timers_activos[folio].start_time).total_seconds() / 60
             ))
             lista.append(f"• {folio} ({mins//60}h {mins%60}min)")
         else:
@@ -2188,6 +3369,54 @@ async def ver_folios_activos(message: types.Message):
         reply_markup=InlineKeyboardMarkup(inline_keyboard=botones)
     )
 
+@dp.message(Command("reenviar"))
+async def reenviar_cmd(message: types.Message, command: CommandObject):
+    folio = (command.args or "").strip().upper()
+    if not folio:
+        await message.answer(
+            "⚠️ Formato: /reenviar [folio]\nEjemplo: /reenviar 980000000\n\n"
+            "📋 Para generar otro permiso use /chuleta"
+        )
+        return
+    try:
+        registro = await _sb_leer_folio(folio)
+        if not registro or registro.get("user_id") != message.from_user.id:
+            await message.answer(
+                f"❌ Folio {folio} no encontrado en tus permisos.\n\n"
+                f"📋 Para generar otro permiso use /chuleta"
+            )
+            return
+        await reenviar_permiso(message.chat.id, registro)
+    except Exception as e:
+        log.exception("reenviar %s: %s", folio, e)
+        await message.answer(
+            "❌ Error reenviando el documento. Intenta de nuevo.\n\n"
+            "📋 Para generar otro permiso use /chuleta"
+        )
+
+@dp.message(Command("reenviar_admin"))
+async def reenviar_admin_cmd(message: types.Message, command: CommandObject):
+    if message.from_user.id not in ADMIN_IDS:
+        await message.answer("🏛️ Sistema Digital Jalisco.")
+        return
+    folio = (command.args or "").strip().upper()
+    if not folio:
+        await message.answer("⚠️ Formato: /reenviar_admin [folio]")
+        return
+    try:
+        registro = await _sb_leer_folio(folio)
+        if not registro:
+            await message.answer(f"❌ Folio {folio} no existe.")
+            return
+        via = await reenviar_permiso(registro["user_id"], registro)
+        await message.answer(
+            f"✅ REENVÍO OK\nFolio: {folio}\nUsuario: {registro['user_id']}\n"
+            f"Vía: {_VIAS_REENVIO[via]}"
+        )
+    except Exception as e:
+        log.exception("reenviar_admin %s: %s", folio, e)
+        await message.answer(f"❌ Error reenviando folio {folio}: {e}")
+
 @dp.message(lambda m: m.text and any(
     p in m.text.lower() for p in
     ['costo','precio','cuanto','cuánto','deposito','depósito','pago','valor','monto']
@@ -2201,6 +3430,164 @@ async def responder_costo(message: types.Message):
 async def fallback(message: types.Message):
     await message.answer("🏛️ Sistema Digital Jalisco.")
 
+# ============ COLA DE UPDATES =================================================
+# El webhook solo parsea y encola; Telegram recibe 200 de inmediato. Cada
+# chat se asigna siempre al mismo worker (chat_id % UPDATE_WORKERS), así los
+# pasos de un mismo usuario se procesan en orden y chats distintos corren en
+# paralelo. Con la cola del shard llena se responde 503 y Telegram reintenta.
+
+UPDATE_WORKERS  = int(os.getenv("UPDATE_WORKERS", "8"))
+UPDATE_COLA_MAX = int(os.getenv("UPDATE_COLA_MAX", "1000"))
+
+_colas_updates: list[asyncio.Queue]   = []
+_workers_updates: list[asyncio.Task]  = []
+_updates_stats = {"recibidos": 0, "procesados": 0, "descartados": 0, "errores": 0}
+
+def _chat_de_update(update: types.Update) -> int:
+    if update.message:
+        return update.message.chat.id
+    if update.callback_query:
+        return update.callback_query.from_user.id
+    return update.update_id
+
+async def _worker_updates(cola: asyncio.Queue):
+    while True:
+        update = await cola.get()
+        try:
+            with campos_log(user_id=_chat_de_update(update)):
+                await dp.feed_update(bot, update)
+        except Exception as e:
+            _updates_stats["errores"] += 1
+            log.exception("update %s: %s", update.update_id, e)
+        finally:
+            _updates_stats["procesados"] += 1
+            cola.task_done()
+
+def iniciar_workers_updates():
+    if _workers_updates:
+        return
+    por_shard = max(1, UPDATE_COLA_MAX // max(1, UPDATE_WORKERS))
+    for _ in range(max(1, UPDATE_WORKERS)):
+        cola = asyncio.Queue(maxsize=por_shard)
+        _colas_updates.append(cola)
+        _workers_updates.append(asyncio.create_task(_worker_updates(cola)))
+    log.info("[UPDATES] %s workers, %s updates máx por shard", len(_workers_updates), por_shard)
+
+async def detener_workers_updates(timeout: float = 5):
+    # Drena lo ya aceptado antes de cortar
+    with suppress(asyncio.TimeoutError):
+        await asyncio.wait_for(asyncio.gather(*(c.join() for c in _colas_updates)), timeout)
+    for t in _workers_updates:
+        t.cancel()
+    for t in _workers_updates:
+        with suppress(asyncio.CancelledError):
+            await t
+    _workers_updates.clear()
+    _colas_updates.clear()
+
+def encolar_update(update: types.Update) -> bool:
+    iniciar_workers_updates()
+    _updates_stats["recibidos"] += 1
+    cola = _colas_updates[_chat_de_update(update) % len(_colas_updates)]
+    try:
+        cola.put_nowait(update)
+        return True
+    except asyncio.QueueFull:
+        _updates_stats["descartados"] += 1
+        return False
+
+def estado_cola_updates() -> dict:
+    return {
+        "profundidad": sum(c.qsize() for c in _colas_updates),
+        "max_shard":   max((c.qsize() for c in _colas_updates), default=0),
+        "workers":     len(_workers_updates),
+        **_updates_stats,
+    }
+
+# ============ EXPORTACIÓN ADMIN ===============================================
+# Permisos de folios_registrados para conciliación, en CSV o JSONL. Se
+# recorre por páginas con keyset sobre folio (sin OFFSET) y cada página se
+# escribe en cuanto llega, pidiendo la siguiente mientras tanto: en memoria
+# nunca hay más de dos páginas, sean 100 filas o un millón.
+
+EXPORT_PAGINA   = int(os.getenv("EXPORT_PAGINA", "1000"))
+EXPORT_COLUMNAS = (
+    "folio", "fecha_expedicion", "fecha_vencimiento", "estado", "marca", "linea", "anio",
+    "numero_serie", "numero_motor", "color", "nombre", "user_id", "username", "fecha_comprobante",
+)
+_ESTADO_VALIDO = re.compile(r"^[A-Z_]+$")
+
+def _admin_autorizado(request: Request) -> bool:
+    if not ADMIN_TOKEN:
+        return False
+    recibido = request.headers.get("authorization", "").encode()
+    return hmac.compare_digest(recibido, f"Bearer {ADMIN_TOKEN}".encode())
+
+async def _pagina_export(despues_de: str | None, desde: str | None, hasta: str | None,
+                         estados: list[str]) -> list[dict]:
+    consulta = (
+        supabase.table("folios_registrados")
+        .select(",".join(EXPORT_COLUMNAS))
+        .eq("entidad", "Jalisco")
+    )
+    if desde:
+        consulta = consulta.gte("fecha_expedicion", desde)
+    if hasta:
+        consulta = consulta.lte("fecha_expedicion", hasta)
+    if estados:
+        consulta = consulta.in_("estado", estados)
+    if despues_de is not None:
+        consulta = consulta.gt("folio", despues_de)
+    consulta = consulta.order("folio").limit(EXPORT_PAGINA)
+    for intento in range(3):
+        try:
+            r = await consulta.execute()
+            return r.data
+        except Exception as e:
+            log.warning("[EXPORT] Página tras %s falló (%s): %s", despues_de, intento + 1, e)
+            await asyncio.sleep(1 + intento)
+    raise RuntimeError(f"No se pudo leer la página de exportación tras {despues_de}")
+
+def _filas_csv(filas: list[dict], encabezado: bool) -> bytes:
+    buf = StringIO()
+    escritor = csv.writer(buf)
+    if encabezado:
+        escritor.writerow(EXPORT_COLUMNAS)
+    escritor.writerows([f.get(c) for c in EXPORT_COLUMNAS] for f in filas)
+    return buf.getvalue().encode()
+
+def _filas_jsonl(filas: list[dict]) -> bytes:
+    return "".join(json.dumps({c: f.get(c) for c in EXPORT_COLUMNAS}, ensure_ascii=False) + "\n"
+                   for f in filas).encode()
+
+async def exportar_permisos(formato: str, desde: str | None, hasta: str | None, estados: list[str]):
+    t0, total = time.perf_counter(), 0
+    siguiente = asyncio.create_task(_pagina_export(None, desde, hasta, estados))
+    try:
+        if formato == "csv":
+            yield _filas_csv([], encabezado=True)
+        while True:
+            filas = await siguiente
+            if len(filas) == EXPORT_PAGINA:
+                siguiente = asyncio.create_task(_pagina_export(filas[-1]["folio"], desde, hasta, estados))
+            else:
+                siguiente = None
+            total += len(filas)
+            if filas:
+                yield _filas_csv(filas, encabezado=False) if formato == "csv" else _filas_jsonl(filas)
+            if siguiente is None:
+                break
+        log.info("[EXPORT] %s filas %s (%s a %s, estado %s) en %.1fs", total, formato,
+                 desde or "inicio", hasta or "hoy", ",".join(estados) or "todos",
+                 time.perf_counter() - t0)
+    except Exception as e:
+        # Con la respuesta ya en curso no se puede cambiar el status: se corta
+        log.error("[EXPORT] Interrumpida tras %s filas: %s", total, e)
+        raise
+    finally:
+        if siguiente is not None and not siguiente.done():
+            siguiente.cancel()
+
 # ============ FASTAPI =========================================================
 
 _keep_task = None
@@ -2208,7 +3595,7 @@ _keep_task = None
 async def keep_alive():
     while True:
         await asyncio.sleep(600)
-        print("[HEARTBEAT] Sistema Jalisco activo")
+        log.info("[HEARTBEAT] Sistema Jalisco activo")
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
@@ -2216,38 +3603,81 @@ async def lifespan(app: FastAPI):
     try:
         await inicializar_folio_cursors()
         _cargar_plantillas()
+        await iniciar_motor_render()
+        _asegurar_scheduler()
+        iniciar_recarga_timers()
+        iniciar_barrido()
+        iniciar_workers_updates()
+        iniciar_exportador_trazas()
         await bot.delete_webhook(drop_pending_updates=True)
         if BASE_URL:
             wh = f"{BASE_URL}/webhook"
             await bot.set_webhook(wh, allowed_updates=["message", "callback_query"])
-            print(f"[WEBHOOK] Configurado: {wh}")
+            log.info("[WEBHOOK] Configurado: %s", wh)
             _keep_task = asyncio.create_task(keep_alive())
         else:
-            print("[POLLING] Sin webhook")
-        print(f"[SISTEMA] Jalisco v18.1 iniciado — "
-              f"PDF417 {'✅' if PDF417_DISPONIBLE else '⚠️ fallback QR'}")
+            log.info("[POLLING] Sin webhook")
+        log.info("[SISTEMA] Jalisco v18.1 iniciado — PDF417 %s",
+                 "✅" if PDF417_DISPONIBLE else "⚠️ fallback QR")
         yield
     except Exception as e:
-        print(f"[ERROR CRÍTICO] {e}")
+        log.exception("[ERROR CRÍTICO] %s", e)
         yield
     finally:
+        await detener_workers_updates()
+        if _recarga_task:
+            _recarga_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await _recarga_task
+        await detener_barrido()
         if _keep_task:
             _keep_task.cancel()
             with suppress(asyncio.CancelledError):
                 await _keep_task
+        if _timer_task:
+            _timer_task.cancel()
+            with suppress(asyncio.CancelledError):
+                await _timer_task
+        if _especulacion_limpieza:
+            _especulacion_limpieza.cancel()
+        if _render_reinicio:
+            _render_reinicio.cancel()
+            with suppress(asyncio.CancelledError):
+                await _render_reinicio
+        detener_motor_render()
+        await esperar_pdfs_en_disco()
+        await planificador_envios.cerrar()
+        await detener_exportador_trazas()
+        await esperar_renovaciones()
+        await supabase.cerrar()
         await bot.session.close()
 
 app = FastAPI(lifespan=lifespan, title="Sistema Jalisco Digital", version="18.1")
 
+Medidor("jalisco_timers_activos", "Folios con timer de 36h vigente", lambda: len(timers_activos))
+Medidor("jalisco_sesiones_fsm", "Chats con el formulario en curso", sesiones_fsm_activas)
+Medidor("jalisco_cola_render", "Renders esperando cupo y en ejecución",
+        lambda: {("esperando",): _render_esperando, ("en_vuelo",): _render_en_vuelo}, ("estado",))
+Medidor("jalisco_envios_en_vuelo", "Llamadas a la Bot API sin respuesta todavía",
+        lambda: _bot_api_en_vuelo)
+Medidor("jalisco_envios_en_cola", "Envíos a Telegram esperando turno en el limitador",
+        planificador_envios.en_cola, ("prioridad",))
+Medidor("jalisco_cola_avisos_expiracion", "Avisos de folio expirado por enviar",
+        lambda: _cola_avisos.qsize())
+Medidor("jalisco_cola_updates", "Updates del webhook encolados sin procesar",
+        lambda: sum(c.qsize() for c in _colas_updates))
+
 @app.post("/webhook")
 async def telegram_webhook(request: Request):
     try:
         data   = await request.json()
         update = types.Update(**data)
-        await dp.feed_webhook_update(bot, update)
+        if not encolar_update(update):
+            return JSONResponse({"ok": False, "error": "cola llena"}, status_code=503,
+                                headers={"Retry-After": "1"})
         return {"ok": True}
     except Exception as e:
-        print(f"[ERROR] webhook: {e}")
+        log.exception("webhook: %s", e)
         return {"ok": False, "error": str(e)}
 
 @app.get("/")
@@ -2259,6 +3689,7 @@ async def health():
         "pdf417_disponible": PDF417_DISPONIBLE,
         "active_timers":     len(timers_activos),
         "cursors_actuales":  _folio_cursors,
+        "cola_updates":      estado_cola_updates(),
         "fixes_v18.1": [
             "pdf417gen en lugar de pdf417 — fix import correcto",
             "Watermark Supabase — contador nunca retrocede tras reinicio",
@@ -2268,6 +3699,10 @@ async def health():
         ]
     }
 
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(exportar_metricas(), media_type="text/plain; version=0.0.4")
+
 @app.get("/status")
 async def status_detail():
     return {
@@ -2275,12 +3710,41 @@ async def status_detail():
         "pdf417_disponible":   PDF417_DISPONIBLE,
         "total_timers":        len(timers_activos),
         "folios_activos":      list(timers_activos.keys()),
+        "recarga_timers":      _recarga_stats,
+        "barrido_expirados":   _barrido_stats,
         "cursors_por_prefijo": _folio_cursors,
+        "cola_updates":        estado_cola_updates(),
         "timestamp":           datetime.now().isoformat(),
     }
 
+@app.get("/admin/export")
+async def admin_export(request: Request, formato: str = "csv", desde: str | None = None,
+                       hasta: str | None = None, estado: str | None = None):
+    """?formato=csv|jsonl&desde=AAAA-MM-DD&hasta=AAAA-MM-DD&estado=PENDIENTE,VALIDADO_ADMIN"""
+    if not _admin_autorizado(request):
+        return JSONResponse({"ok": False, "error": "no autorizado"}, status_code=401,
+                            headers={"WWW-Authenticate": "Bearer"})
+    if formato not in ("csv", "jsonl"):
+        return JSONResponse({"ok": False, "error": "formato debe ser csv o jsonl"}, status_code=400)
+    try:
+        for fecha in (desde, hasta):
+            if fecha:
+                date.fromisoformat(fecha)
+    except ValueError:
+        return JSONResponse({"ok": False, "error": "fechas en formato AAAA-MM-DD"}, status_code=400)
+    estados = [e for e in (estado or "").upper().replace(" ", "").split(",") if e]
+    if not all(_ESTADO_VALIDO.match(e) for e in estados):
+        return JSONResponse({"ok": False, "error": "estado inválido"}, status_code=400)
+
+    nombre = f"permisos_{desde or 'inicio'}_{hasta or 'hoy'}.{formato}"
+    return StreamingResponse(
+        exportar_permisos(formato, desde, hasta, estados),
+        media_type="text/csv; charset=utf-8" if formato == "csv" else "application/x-ndjson",
+        headers={"Content-Disposition": f'attachment; filename="{nombre}"'},
+    )
+
 if __name__ == "__main__":
     import uvicorn
     port = int(os.getenv("PORT", 8000))
-    print(f"[ARRANQUE] Jalisco v18.1 — puerto {port}")
+    log.info("[ARRANQUE] Jalisco v18.1 — puerto %s", port)
     uvicorn.run(app, host="0.0.0.0", port=port)
@@ -0,0 +1,100 @@
+"""
+Latencia por paso del FSM según el almacén (ALMACEN_URL).
+
+Simula el flujo /chuleta → PermisoForm (7 pasos) para muchos usuarios:
+en cada paso get_state + update_data + set_state, igual que los handlers,
+más el filtro de pending_comprobantes que corre en cada mensaje. Con
+--procesos N, N procesos recorren el flujo a la vez sobre el mismo SQLite
+(como N workers de uvicorn). Además de la latencia por paso reporta el
+bloqueo del event loop (retraso de un tick de 1 ms que corre en paralelo):
+esperar el lock de SQLite no debe congelar el resto del proceso.
+
+Uso:  python bench/bench_almacen.py [--usuarios 500] [--procesos 1]
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+os.environ.setdefault("SUPABASE_URL", "http://127.0.0.1:54321")
+os.environ.setdefault("SUPABASE_KEY", "bench")
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+
+PASOS = ("marca", "linea", "anio", "serie", "motor", "color", "nombre")
+
+
+def _correr(almacen_url: str, usuarios: int, desfase: int) -> tuple[list[float], list[float]]:
+    os.environ["ALMACEN_URL"] = almacen_url
+    import app
+    from aiogram.fsm.storage.base import StorageKey
+
+    async def vigilar(retrasos: list[float]):
+        while True:
+            t0 = time.perf_counter()
+            await asyncio.sleep(0.001)
+            retrasos.append(time.perf_counter() - t0 - 0.001)
+
+    async def flujo() -> tuple[list[float], list[float]]:
+        lat, retrasos = [], []
+        vigia = asyncio.create_task(vigilar(retrasos))
+        for u in range(desfase, desfase + usuarios):
+            key = StorageKey(bot_id=1, chat_id=u, user_id=u)
+            await app.storage.set_state(key, app.PermisoForm.marca)
+            for paso in PASOS:
+                t0 = time.perf_counter()
+                app.pending_comprobantes.get(u)
+                await app.storage.get_state(key)
+                await app.storage.update_data(key, {paso: f"VALOR {paso.upper()}"})
+                await app.storage.set_state(key, f"PermisoForm:{paso}")
+                lat.append(time.perf_counter() - t0)
+                await asyncio.sleep(0)   # como entre updates: deja correr al resto del loop
+            await app.storage.get_data(key)
+            await app.storage.set_state(key, None)
+            await app.storage.set_data(key, {})
+        vigia.cancel()
+        return lat, retrasos
+
+    return asyncio.run(flujo())
+
+
+def _worker(args):
+    sys.stdout = open(os.devnull, "w")
+    return _correr(*args)
+
+
+def _reporte(nombre: str, partes: list[tuple[list[float], list[float]]]):
+    lat = sorted(x for p, _ in partes for x in p)
+    retrasos = sorted(x for _, r in partes for x in r) or [0.0]
+    us = lambda xs, q: xs[min(len(xs) - 1, int(q * len(xs)))] * 1e6
+    print(f"{nombre:28} pasos={len(lat):6}  media={statistics.fmean(lat) * 1e6:8.1f}µs"
+          f"  p50={us(lat, 0.50):8.1f}µs  p99={us(lat, 0.99):8.1f}µs"
+          f"  bloqueo loop p99={us(retrasos, 0.99):8.1f}µs  máx={retrasos[-1] * 1e6:8.1f}µs")
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--usuarios", type=int, default=500)
+    p.add_argument("--procesos", type=int, default=1)
+    a = p.parse_args()
+
+    sys.stdout = open(os.devnull, "w")
+    lat_mem = _correr("", a.usuarios, 0)
+    with tempfile.TemporaryDirectory() as tmp:
+        url = f"sqlite:///{os.path.join(tmp, 'almacen.db')}"
+        ctx = multiprocessing.get_context("spawn")
+        with ctx.Pool(a.procesos) as pool:
+            partes = pool.map(_worker, [(url, a.usuarios, i * a.usuarios) for i in range(a.procesos)])
+    sys.stdout = sys.__stdout__
+
+    _reporte("memoria (1 proceso)", [lat_mem])
+    _reporte(f"sqlite WAL ({a.procesos} proceso/s)", partes)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+"""
+Micro-benchmark del recoloreo PDF417.
+
+Compara el recoloreo píxel a píxel original contra la LUT vectorizada de
+_generar_pdf417 y verifica que los bytes de salida sean idénticos.
+
+Uso:  python bench/bench_pdf417.py [iteraciones]
+"""
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("SUPABASE_URL", "http://127.0.0.1:54321")
+os.environ.setdefault("SUPABASE_KEY", "bench")
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+
+import pdf417gen
+from PIL import Image
+
+import app
+
+DATOS = {
+    "folio":  "980000123",
+    "marca":  "NISSAN",
+    "linea":  "VERSA SENSE",
+    "anio":   "2021",
+    "serie":  "3N1CN8AE5ML123456",
+    "motor":  "HR16DE123456",
+    "color":  "BLANCO",
+    "nombre": "JUAN PEREZ LOPEZ",
+    "fecha_exp": datetime(2026, 1, 15, 10, 30),
+}
+
+
+def _pdf417_original(datos: dict) -> Image.Image:
+    """Copia del recoloreo por píxel previo a la LUT (referencia)."""
+    codes = pdf417gen.encode(app._texto_pdf417(datos), columns=10, security_level=2)
+    img   = pdf417gen.render_image(codes, scale=2, ratio=3).convert("RGB")
+    px  = img.load()
+    out = Image.new("RGB", img.size, (220, 220, 220))
+    ox  = out.load()
+    for y in range(img.height):
+        for x in range(img.width):
+            p = px[x, y]
+            if (sum(p[:3]) if isinstance(p, tuple) else p) < 384:
+                ox[x, y] = (0, 0, 0)
+    return out.resize((app.PDF417_W, app.PDF417_H), Image.LANCZOS)
+
+
+def _medir(fn, n: int) -> float:
+    t0 = time.perf_counter()
+    for _ in range(n):
+        fn(DATOS)
+    return (time.perf_counter() - t0) / n
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+
+    ref   = _pdf417_original(DATOS)
+    nuevo = app._generar_pdf417(DATOS)
+    identico = ref.mode == nuevo.mode and ref.size == nuevo.size and ref.tobytes() == nuevo.tobytes()
+
+    t_ref   = _medir(_pdf417_original, n)
+    t_nuevo = _medir(app._generar_pdf417, n)
+
+    print(f"iteraciones:     {n}")
+    print(f"por píxel:       {t_ref * 1000:8.2f} ms/render")
+    print(f"LUT vectorizada: {t_nuevo * 1000:8.2f} ms/render")
+    print(f"aceleración:     {t_ref / t_nuevo:8.1f}x")
+    print(f"bytes idénticos: {'SI' if identico else 'NO'}")
+    sys.exit(0 if identico else 1)
+
+
+if __name__ == "__main__":
+    main()
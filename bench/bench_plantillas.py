@@ -0,0 +1,125 @@
+"""
+Benchmark del manejo de plantillas en _generar_pdf_unificado.
+
+antes:   fitz.open() de jalisco1.pdf y jalisco.pdf por render + documento
+         vacío + 2x insert_pdf.
+después: un solo fitz.open() del documento base pre-fusionado.
+
+Ambos caminos estampan exactamente lo mismo (_estampar_pagina1/2); se
+reporta tiempo por render y asignaciones Python (tracemalloc) por render,
+con estampado completo y solo con el manejo de plantillas.
+
+Uso:  python bench/bench_plantillas.py [iteraciones]
+"""
+import os
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+os.environ.setdefault("SUPABASE_URL", "http://127.0.0.1:54321")
+os.environ.setdefault("SUPABASE_KEY", "bench")
+os.environ.setdefault("BOT_TOKEN", "123456:BENCH")
+
+import fitz
+import pytz
+
+import app
+
+DATOS = {
+    "folio":  "980000123",
+    "marca":  "NISSAN",
+    "linea":  "VERSA SENSE",
+    "anio":   "2021",
+    "serie":  "3N1CN8AE5ML123456",
+    "motor":  "HR16DE123456",
+    "color":  "BLANCO",
+    "nombre": "JUAN PEREZ LOPEZ",
+    "fecha_exp": datetime(2026, 1, 15, 10, 30),
+    "fecha_ven": datetime(2026, 1, 15, 10, 30) + timedelta(days=30),
+}
+FP2 = {
+    "referencia_pago":   273312001735,
+    "num_autorizacion":  370804,
+    "folio_seguimiento": "GZUdr61oqv3",
+    "linea_captura":     41340817,
+}
+AHORA = datetime(2026, 1, 15, 10, 30, tzinfo=pytz.timezone("America/Mexico_City"))
+
+with open(os.path.join(RAIZ, app.PLANTILLA_PDF), "rb") as f:
+    P1 = f.read()
+with open(os.path.join(RAIZ, app.PLANTILLA_BUENO), "rb") as f:
+    P2 = f.read()
+
+
+def render_antes(estampar: bool = True) -> bytes:
+    doc1 = fitz.open(stream=P1, filetype="pdf")
+    doc2 = fitz.open(stream=P2, filetype="pdf")
+    if estampar:
+        app._estampar_pagina1(doc1[0], DATOS, 21385, AHORA)
+        app._estampar_pagina2(doc2[0], DATOS, FP2)
+    doc_final = fitz.open()
+    doc_final.insert_pdf(doc1)
+    doc_final.insert_pdf(doc2)
+    pdf = doc_final.tobytes()
+    doc_final.close()
+    doc1.close()
+    doc2.close()
+    return pdf
+
+
+def render_despues(estampar: bool = True) -> bytes:
+    doc = app._abrir_plantilla_base()
+    if estampar:
+        app._estampar_pagina1(doc[0], DATOS, 21385, AHORA)
+        app._estampar_pagina2(doc[1], DATOS, FP2)
+    pdf = doc.tobytes()
+    doc.close()
+    return pdf
+
+
+def medir(fn, n: int) -> dict:
+    fn()  # calentamiento
+    t0 = time.perf_counter()
+    for _ in range(n):
+        fn()
+    ms = (time.perf_counter() - t0) / n * 1000
+
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    antes = tracemalloc.take_snapshot()
+    for _ in range(n):
+        fn()
+    despues = tracemalloc.take_snapshot()
+    _, pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    asignaciones = sum(s.count_diff for s in despues.compare_to(antes, "filename") if s.count_diff > 0)
+    return {"ms": ms, "pico_kb": pico / 1024, "asignaciones": asignaciones / n}
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 30
+    os.chdir(RAIZ)
+    app._cargar_plantillas()
+    # Los print() del render no forman parte de la medición
+    sys.stdout = open(os.devnull, "w")
+    filas = [
+        ("antes",             medir(render_antes, n)),
+        ("después",           medir(render_despues, n)),
+        ("antes (plantilla)", medir(lambda: render_antes(False), n)),
+        ("después (plant.)",  medir(lambda: render_despues(False), n)),
+    ]
+    paginas = fitz.open(stream=render_despues(), filetype="pdf").page_count
+    sys.stdout = sys.__stdout__
+
+    print(f"iteraciones: {n}")
+    print(f"{'':18}{'ms/render':>12}{'pico KB':>12}{'asig/render':>14}")
+    for nombre, r in filas:
+        print(f"{nombre:18}{r['ms']:12.2f}{r['pico_kb']:12.1f}{r['asignaciones']:14.1f}")
+    print(f"páginas en salida: {paginas}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,266 @@
+"""
+Prueba de carga de punta a punta contra /webhook.
+
+Cada usuario simulado recorre el flujo completo como en Telegram:
+/chuleta → marca → línea → año → serie → motor → color → nombre, espera el
+PDF (sendDocument) y las instrucciones de pago, y manda la foto del
+comprobante. Cada mensaje espera la respuesta del bot antes del siguiente.
+La Bot API y Supabase son stubs locales (stub_telegram / stub_postgrest),
+así que lo que se mide es la instancia: webhook, FSM, folios, render y
+envío.
+
+Por defecto la app corre en este mismo proceso (httpx ASGITransport, con
+su lifespan). Con --url se apunta a una instancia ya levantada con:
+
+    TELEGRAM_API_URL=http://127.0.0.1:<puerto-telegram> \\
+    SUPABASE_URL=http://127.0.0.1:<puerto-supabase> SUPABASE_KEY=carga \\
+    BOT_TOKEN=123456:CARGA uvicorn app:app
+
+Reporta permisos por minuto, latencia nombre → documento y foto →
+confirmación (p50/p95/p99), latencia por paso del formulario, errores por
+tipo, respuestas 503 del webhook y 429 del stub.
+
+En proceso, el limitador de envíos de la app queda desactivado salvo que
+se pidan --envios-por-segundo / --envios-por-chat: sin ellos se mide la
+instancia y no el límite de Telegram.
+
+Uso:  python bench/carga_webhook.py [--usuarios 200] [--concurrencia 20]
+                                    [--pensar-ms 0] [--url http://...]
+                                    [--envios-por-segundo 0] [--envios-por-chat 0]
+                                    [--limite-chat 0]
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import sys
+import tempfile
+import time
+from collections import Counter
+
+import httpx
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+sys.path.insert(0, os.path.join(RAIZ, "bench"))
+
+import stub_postgrest
+import stub_telegram
+
+TOKEN = "123456:CARGA"
+PASOS = ("MARCA", "LINEA", "2021", "SERIE", "MOTOR", "COLOR")
+
+
+class ErrorFlujo(Exception):
+    pass
+
+
+class Carga:
+    def __init__(self, cliente: httpx.AsyncClient, telegram: stub_telegram.StubTelegram, a):
+        self.cliente  = cliente
+        self.telegram = telegram
+        self.a        = a
+        self.updates  = itertools.count(1)
+        self.mensajes = itertools.count(1)
+        self.lat_doc:  list[float] = []
+        self.lat_comp: list[float] = []
+        self.lat_paso: list[float] = []
+        self.errores  = Counter()
+        self.rechazos = 0    # 503 del webhook (cola llena)
+        self.completos = 0
+
+    async def _enviar(self, uid: int, **contenido):
+        update = {
+            "update_id": next(self.updates),
+            "message": {
+                "message_id": next(self.mensajes),
+                "date":       int(time.time()),
+                "chat":       {"id": uid, "type": "private"},
+                "from":       {"id": uid, "is_bot": False, "first_name": "Carga",
+                               "username": f"carga{uid}"},
+                **contenido,
+            },
+        }
+        while True:
+            r = await self.cliente.post("/webhook", json=update)
+            if r.status_code != 503:
+                break
+            self.rechazos += 1
+            await asyncio.sleep(float(r.headers.get("Retry-After", "1")))
+        if r.status_code != 200 or not r.json().get("ok"):
+            raise ErrorFlujo(f"webhook {r.status_code}")
+
+    async def _esperar(self, uid: int, metodo: str, timeout: float,
+                       contiene: str = "") -> stub_telegram.Llamada:
+        cola = self.telegram.cola(uid)
+        limite = time.perf_counter() + timeout
+        while True:
+            try:
+                ll = await asyncio.wait_for(cola.get(), limite - time.perf_counter())
+            except (asyncio.TimeoutError, ValueError):
+                raise ErrorFlujo(f"timeout esperando {metodo}")
+            if ll.texto.startswith("❌"):
+                raise ErrorFlujo("respuesta de error del bot")
+            if ll.metodo == metodo and contiene in ll.texto:
+                return ll
+
+    async def _pensar(self):
+        if self.a.pensar_ms:
+            await asyncio.sleep(self.a.pensar_ms / 1000)
+
+    async def usuario(self, uid: int):
+        self.telegram.cola(uid)
+        try:
+            for texto in ("/chuleta",) + PASOS:
+                t0 = time.perf_counter()
+                await self._enviar(uid, text=texto)
+                ll = await self._esperar(uid, "sendMessage", self.a.timeout)
+                self.lat_paso.append(ll.t - t0)
+                await self._pensar()
+
+            t0 = time.perf_counter()
+            await self._enviar(uid, text=f"USUARIO DE CARGA {uid}")
+            doc = await self._esperar(uid, "sendDocument", self.a.timeout)
+            self.lat_doc.append(doc.t - t0)
+            if not doc.bytes:
+                raise ErrorFlujo("documento vacío")
+            await self._esperar(uid, "sendMessage", self.a.timeout, "INSTRUCCIONES DE PAGO")
+            await self._pensar()
+
+            t0 = time.perf_counter()
+            await self._enviar(uid, photo=[{
+                "file_id": f"COMP{uid}", "file_unique_id": f"UC{uid}", "width": 800, "height": 600,
+            }])
+            ok = await self._esperar(uid, "sendMessage", self.a.timeout, "Comprobante recibido")
+            self.lat_comp.append(ok.t - t0)
+            self.completos += 1
+        except ErrorFlujo as e:
+            self.errores[str(e)] += 1
+        except Exception as e:
+            self.errores[type(e).__name__] += 1
+
+    async def correr(self) -> float:
+        sem = asyncio.Semaphore(self.a.concurrencia)
+
+        async def con_cupo(uid):
+            async with sem:
+                await self.usuario(uid)
+
+        t0 = time.perf_counter()
+        await asyncio.gather(*(con_cupo(10_000_000 + i) for i in range(self.a.usuarios)))
+        return time.perf_counter() - t0
+
+
+def _percentiles(nombre: str, xs: list[float]):
+    if not xs:
+        print(f"{nombre:28} sin datos")
+        return
+    xs = sorted(xs)
+    q = lambda p: xs[min(len(xs) - 1, int(p * len(xs)))] * 1000
+    print(f"{nombre:28} p50={q(0.50):8.1f}ms  p95={q(0.95):8.1f}ms  "
+          f"p99={q(0.99):8.1f}ms  máx={xs[-1] * 1000:8.1f}ms  n={len(xs)}")
+
+
+def _reporte(c: Carga, duracion: float, a):
+    total = a.usuarios
+    fallidos = sum(c.errores.values())
+    print(f"usuarios={total}  concurrencia={a.concurrencia}  pensar={a.pensar_ms}ms  "
+          f"duración={duracion:.1f}s")
+    print(f"completos={c.completos}  fallidos={fallidos} "
+          f"({fallidos / total * 100 if total else 0:.1f}%)  503 webhook={c.rechazos}  "
+          f"429 telegram={c.telegram.rechazos_429}")
+    print(f"throughput: {c.completos / duracion * 60:.1f} permisos/min")
+    _percentiles("nombre → documento", c.lat_doc)
+    _percentiles("foto → confirmación", c.lat_comp)
+    _percentiles("paso del formulario", c.lat_paso)
+    for error, n in c.errores.most_common():
+        print(f"  error: {error} × {n}")
+    print("llamadas Bot API: " + ", ".join(f"{m}={n}" for m, n in c.telegram.llamadas.most_common()))
+
+
+async def _esperar_instancia(cliente: httpx.AsyncClient, timeout: float):
+    """La instancia externa puede arrancar antes o después que los stubs."""
+    limite = time.perf_counter() + timeout
+    while True:
+        try:
+            if (await cliente.get("/")).status_code == 200:
+                return
+        except httpx.TransportError:
+            pass
+        if time.perf_counter() > limite:
+            raise SystemExit(f"La instancia en {cliente.base_url} no respondió en {timeout:.0f}s")
+        await asyncio.sleep(0.5)
+
+
+async def main_async(a):
+    telegram, r_tg = await stub_telegram.iniciar(port=a.puerto_telegram,
+                                                 latencia_ms=a.latencia_telegram_ms,
+                                                 limite_chat=a.limite_chat)
+    _, r_sb = await stub_postgrest.iniciar(port=a.puerto_supabase,
+                                           latencia_ms=a.latencia_supabase_ms)
+    try:
+        if a.url:
+            async with httpx.AsyncClient(base_url=a.url, timeout=30) as cliente:
+                await _esperar_instancia(cliente, a.timeout)
+                carga = Carga(cliente, telegram, a)
+                duracion = await carga.correr()
+        else:
+            os.environ.update({
+                "TELEGRAM_API_URL": f"http://127.0.0.1:{a.puerto_telegram}",
+                "SUPABASE_URL":     f"http://127.0.0.1:{a.puerto_supabase}",
+                "SUPABASE_KEY":     "carga",
+                "BOT_TOKEN":        TOKEN,
+                "ENVIOS_POR_SEGUNDO": str(a.envios_por_segundo),
+                "ENVIOS_POR_CHAT":    str(a.envios_por_chat),
+            })
+            # Los print() de la app y de los workers de render (que heredan el
+            # fd 1) no forman parte de la medición
+            sys.stdout.flush()
+            fd_stdout = os.dup(1)
+            nulo = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(nulo, 1)
+            try:
+                import app as bot_app
+                async with bot_app.app.router.lifespan_context(bot_app.app):
+                    transporte = httpx.ASGITransport(app=bot_app.app)
+                    async with httpx.AsyncClient(transport=transporte, base_url="http://carga",
+                                                 timeout=30) as cliente:
+                        carga = Carga(cliente, telegram, a)
+                        duracion = await carga.correr()
+            finally:
+                sys.stdout.flush()
+                os.dup2(fd_stdout, 1)
+                os.close(nulo)
+                os.close(fd_stdout)
+        _reporte(carga, duracion, a)
+    finally:
+        await r_tg.cleanup()
+        await r_sb.cleanup()
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--usuarios", type=int, default=200)
+    p.add_argument("--concurrencia", type=int, default=20)
+    p.add_argument("--pensar-ms", type=float, default=0, help="pausa del usuario entre mensajes")
+    p.add_argument("--timeout", type=float, default=60, help="espera máxima por respuesta (s)")
+    p.add_argument("--url", default="", help="instancia externa; vacío = app en este proceso")
+    p.add_argument("--puerto-telegram", type=int, default=8081)
+    p.add_argument("--puerto-supabase", type=int, default=54321)
+    p.add_argument("--latencia-telegram-ms", type=float, default=0)
+    p.add_argument("--latencia-supabase-ms", type=float, default=0)
+    p.add_argument("--envios-por-segundo", type=float, default=0, help="limitador de la app; 0 = sin límite")
+    p.add_argument("--envios-por-chat", type=float, default=0, help="limitador de la app; 0 = sin límite")
+    p.add_argument("--limite-chat", type=int, default=0, help="el stub responde 429 arriba de N/s por chat")
+    a = p.parse_args()
+    # Aislado del árbol: folio_cursors.json, contadores, file_ids
+    if not a.url:
+        tmp = tempfile.mkdtemp(prefix="carga_")
+        for plantilla in ("jalisco1.pdf", "jalisco.pdf"):
+            os.symlink(os.path.join(RAIZ, plantilla), os.path.join(tmp, plantilla))
+        os.chdir(tmp)
+    asyncio.run(main_async(a))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,123 @@
+"""
+Contención de folios entre procesos.
+
+Levanta el stub de PostgREST y arranca N procesos (como N workers de
+uvicorn o N instancias) que piden folios a la vez con
+generar_folio_con_prefijo. Al final junta todos los folios y cuenta
+duplicados, y reporta la latencia por folio para cada N.
+
+  --modo rpc    FOLIO_RESERVA_RPC=1: bloques reservados en la BD (esperado:
+                0 duplicados y latencia plana al crecer N).
+  --modo local  lease clásico con watermark local de cada proceso (muestra
+                los duplicados que provoca con más de un proceso).
+
+Uso:  python bench/contencion_folios.py [--procesos 1,2,4,8] [--folios 2000]
+                                        [--modo rpc] [--latencia-ms 5]
+"""
+import argparse
+import asyncio
+import multiprocessing
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+sys.path.insert(0, os.path.join(RAIZ, "bench"))
+
+PUERTO = 54329
+
+
+def _worker(modo: str, folios: int, prefijo: str, barrera, salida):
+    sys.stdout = open(os.devnull, "w")
+    os.environ.update({
+        "SUPABASE_URL":      f"http://127.0.0.1:{PUERTO}",
+        "SUPABASE_KEY":      "bench",
+        "BOT_TOKEN":         "123456:BENCH",
+        "FOLIO_RESERVA_RPC": "1" if modo == "rpc" else "0",
+    })
+    import app
+
+    async def correr():
+        await app.inicializar_folio_cursors()
+        barrera.wait()
+        lat, generados = [], []
+        for _ in range(folios):
+            t0 = time.perf_counter()
+            generados.append(await app.generar_folio_con_prefijo(prefijo))
+            lat.append(time.perf_counter() - t0)
+        await app.supabase.cerrar()
+        return generados, lat
+
+    salida.put(asyncio.run(correr()))
+
+
+def _ronda(modo: str, procesos: int, folios: int) -> tuple[int, int, list[float]]:
+    ctx = multiprocessing.get_context("spawn")
+    barrera = ctx.Barrier(procesos)
+    salida = ctx.Queue()
+    hijos = [ctx.Process(target=_worker, args=(modo, folios, "1", barrera, salida))
+             for _ in range(procesos)]
+    for h in hijos:
+        h.start()
+    partes = [salida.get() for _ in hijos]
+    for h in hijos:
+        h.join()
+    todos = [f for generados, _ in partes for f in generados]
+    duplicados = sum(n - 1 for n in Counter(todos).values() if n > 1)
+    return len(todos), duplicados, [x for _, lat in partes for x in lat]
+
+
+def _levantar_stub(latencia_ms: float):
+    import stub_postgrest
+    loop = asyncio.new_event_loop()
+    listo = threading.Event()
+    caja = {}
+
+    def hilo():
+        asyncio.set_event_loop(loop)
+        caja["stub"], caja["runner"] = loop.run_until_complete(
+            stub_postgrest.iniciar(port=PUERTO, latencia_ms=latencia_ms))
+        listo.set()
+        loop.run_forever()
+
+    threading.Thread(target=hilo, daemon=True).start()
+    listo.wait()
+    return caja["stub"]
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--procesos", default="1,2,4,8")
+    p.add_argument("--folios", type=int, default=2000, help="folios por proceso")
+    p.add_argument("--modo", choices=("rpc", "local"), default="rpc")
+    p.add_argument("--latencia-ms", type=float, default=5)
+    a = p.parse_args()
+
+    stub = _levantar_stub(a.latencia_ms)
+    print(f"modo={a.modo}  folios/proceso={a.folios}  latencia stub={a.latencia_ms}ms")
+    fallo = False
+    with tempfile.TemporaryDirectory() as tmp:
+        os.chdir(tmp)   # folio_cursors.json compartido, como en un mismo host
+        for n in (int(x) for x in a.procesos.split(",")):
+            stub.tablas.clear()
+            stub.peticiones = 0
+            if os.path.exists("folio_cursors.json"):
+                os.remove("folio_cursors.json")
+            total, dup, lat = _ronda(a.modo, n, a.folios)
+            lat.sort()
+            us = lambda q: lat[min(len(lat) - 1, int(q * len(lat)))] * 1e6
+            print(f"procesos={n:2}  folios={total:6}  duplicados={dup:5}"
+                  f"  media={statistics.fmean(lat) * 1e6:8.1f}µs"
+                  f"  p50={us(0.50):8.1f}µs  p99={us(0.99):9.1f}µs"
+                  f"  peticiones={stub.peticiones}")
+            fallo |= dup > 0
+    sys.exit(1 if fallo and a.modo == "rpc" else 0)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,240 @@
+"""
+Stub local compatible con el subconjunto de PostgREST que usa app.py.
+
+Tablas en memoria, filtros eq/neq/gt/gte/lt/lte/in/is, select de columnas,
+order, limit, Prefer return=representation / resolution=merge-duplicates /
+count=exact, violación de llave única con código 23505 y funciones RPC
+registrables. Sirve para probar el cliente SupabaseAsync y para los
+benchmarks y la prueba de carga sin tocar el Supabase real.
+
+Uso:  python bench/stub_postgrest.py [--port 54321] [--latencia-ms 0]
+      SUPABASE_URL=http://127.0.0.1:54321 SUPABASE_KEY=stub uvicorn app:app
+"""
+import argparse
+import asyncio
+
+from aiohttp import web
+
+LLAVES_UNICAS = {
+    "folios_registrados":   "folio",
+    "borradores_registros": "folio",
+    "folio_watermark":      "prefijo",
+}
+
+
+class StubPostgrest:
+    def __init__(self, latencia_ms: float = 0):
+        self.tablas: dict[str, list[dict]] = {}
+        self.rpcs = dict(RPCS_SQL)
+        self.latencia = latencia_ms / 1000
+        self.peticiones = 0
+
+    # ── filtros ──────────────────────────────────────────────────────────────
+
+    @staticmethod
+    def _coaccionar(valor_fila, texto: str):
+        if isinstance(valor_fila, bool):
+            return texto == "true"
+        if isinstance(valor_fila, int):
+            try:
+                return int(texto)
+            except ValueError:
+                return texto
+        if isinstance(valor_fila, float):
+            return float(texto)
+        return texto
+
+    def _cumple(self, fila: dict, columna: str, expr: str) -> bool:
+        op, _, valor = expr.partition(".")
+        actual = fila.get(columna)
+        if op == "is":
+            return actual is None if valor == "null" else str(actual).lower() == valor
+        if actual is None:
+            return False
+        if op == "in":
+            valores = [v.strip().strip('"') for v in valor.strip("()").split(",") if v.strip()]
+            return any(actual == self._coaccionar(actual, v) for v in valores)
+        v = self._coaccionar(actual, valor)
+        try:
+            return {
+                "eq":  actual == v,
+                "neq": actual != v,
+                "gt":  actual > v,
+                "gte": actual >= v,
+                "lt":  actual < v,
+                "lte": actual <= v,
+            }[op]
+        except (KeyError, TypeError):
+            return False
+
+    def _filtrar(self, filas: list[dict], query) -> list[dict]:
+        reservados = {"select", "order", "limit", "offset", "on_conflict"}
+        for columna, expr in query.items():
+            if columna in reservados:
+                continue
+            filas = [f for f in filas if self._cumple(f, columna, expr)]
+        return filas
+
+    @staticmethod
+    def _proyectar(filas: list[dict], select: str | None) -> list[dict]:
+        if not select or select == "*":
+            return [dict(f) for f in filas]
+        columnas = [c.strip() for c in select.split(",")]
+        return [{c: f.get(c) for c in columnas} for f in filas]
+
+    # ── handlers ─────────────────────────────────────────────────────────────
+
+    async def _tabla(self, request: web.Request) -> web.Response:
+        self.peticiones += 1
+        if self.latencia:
+            await asyncio.sleep(self.latencia)
+        nombre = request.match_info["tabla"]
+        filas  = self.tablas.setdefault(nombre, [])
+        prefer = request.headers.get("Prefer", "")
+        query  = request.rel_url.query
+
+        if request.method == "GET":
+            res = self._filtrar(filas, query)
+            if "order" in query:
+                for parte in reversed(query["order"].split(",")):
+                    col, _, dirc = parte.partition(".")
+                    res = sorted(res, key=lambda f: (f.get(col) is None, f.get(col)),
+                                 reverse=dirc.startswith("desc"))
+            total = len(res)
+            offset = int(query.get("offset", 0))
+            res = res[offset:]
+            if "limit" in query:
+                res = res[:int(query["limit"])]
+            headers = {}
+            if "count=exact" in prefer:
+                headers["Content-Range"] = f"{offset}-{offset + len(res) - 1}/{total}"
+            return web.json_response(self._proyectar(res, query.get("select")), headers=headers)
+
+        if request.method == "POST":
+            cuerpo = await request.json()
+            nuevas = cuerpo if isinstance(cuerpo, list) else [cuerpo]
+            llave  = query.get("on_conflict") or LLAVES_UNICAS.get(nombre)
+            upsert = "merge-duplicates" in prefer
+            salida = []
+            for fila in nuevas:
+                existente = None
+                if llave:
+                    existente = next((f for f in filas if f.get(llave) == fila.get(llave)), None)
+                if existente is not None:
+                    if not upsert:
+                        return web.json_response({
+                            "code":    "23505",
+                            "message": f'duplicate key value violates unique constraint "{nombre}_{llave}_key"',
+                            "details": f"Key ({llave})=({fila.get(llave)}) already exists.",
+                        }, status=409)
+                    existente.update(fila)
+                    salida.append(dict(existente))
+                else:
+                    filas.append(dict(fila))
+                    salida.append(dict(fila))
+            return web.json_response(salida, status=201)
+
+        objetivo = self._filtrar(filas, query)
+        if request.method == "PATCH":
+            valores = await request.json()
+            for f in objetivo:
+                f.update(valores)
+            return web.json_response([dict(f) for f in objetivo])
+
+        if request.method == "DELETE":
+            ids = {id(f) for f in objetivo}
+            self.tablas[nombre] = [f for f in filas if id(f) not in ids]
+            return web.json_response([dict(f) for f in objetivo])
+
+        return web.json_response({"message": "método no soportado"}, status=405)
+
+    async def _rpc(self, request: web.Request) -> web.Response:
+        self.peticiones += 1
+        if self.latencia:
+            await asyncio.sleep(self.latencia)
+        fn = self.rpcs.get(request.match_info["funcion"])
+        if fn is None:
+            return web.json_response({"code": "PGRST202", "message": "function not found"}, status=404)
+        params = await request.json() if request.can_read_body else {}
+        try:
+            return web.json_response(fn(self, **params))
+        except Exception as e:
+            return web.json_response({"code": "P0001", "message": str(e)}, status=400)
+
+    def crear_app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_route("POST", "/rest/v1/rpc/{funcion}", self._rpc)
+        app.router.add_route("*", "/rest/v1/{tabla}", self._tabla)
+        return app
+
+
+# ── RPCs de sql/ ─────────────────────────────────────────────────────────────
+
+def _rpc_transicionar_folios(stub: StubPostgrest, p_folios, p_estado, p_fecha=None):
+    res = {}
+    for tabla, clave in (("folios_registrados", "folios"), ("borradores_registros", "borradores")):
+        filas = [f for f in stub.tablas.get(tabla, []) if f.get("folio") in p_folios]
+        for f in filas:
+            f.update({"estado": p_estado, "fecha_comprobante": p_fecha})
+        res[clave] = [dict(f) for f in filas]
+    return res
+
+
+def _rpc_eliminar_folios(stub: StubPostgrest, p_folios, p_estado=None):
+    res = {}
+    for tabla, clave in (("folios_registrados", "folios"), ("borradores_registros", "borradores")):
+        filas = stub.tablas.get(tabla, [])
+        if p_estado is not None and tabla == "folios_registrados":
+            # Los borradores siguen a los folios que de verdad se borraron
+            p_folios = [f["folio"] for f in filas
+                        if f.get("folio") in p_folios and f.get("estado") == p_estado]
+        res[clave] = [dict(f) for f in filas if f.get("folio") in p_folios]
+        stub.tablas[tabla] = [f for f in filas if f.get("folio") not in p_folios]
+    return res
+
+
+def _rpc_reservar_folios(stub: StubPostgrest, p_prefijo, p_cantidad, p_desde, p_base, p_limite):
+    # Sin awaits: el loop del stub la ejecuta de forma atómica, como el FOR UPDATE
+    filas = stub.tablas.setdefault("folio_watermark", [])
+    fila = next((f for f in filas if f.get("prefijo") == p_prefijo), None)
+    if fila is None:
+        fila = {"prefijo": p_prefijo, "ultimo_asignado": p_desde}
+        filas.append(fila)
+    inicio = fila["ultimo_asignado"] + 1
+    if inicio >= p_limite:
+        inicio = p_base
+    fin = min(inicio + max(p_cantidad, 1) - 1, p_limite - 1)
+    fila["ultimo_asignado"] = fin
+    return {"inicio": inicio, "fin": fin}
+
+
+RPCS_SQL = {
+    "transicionar_folios": _rpc_transicionar_folios,
+    "eliminar_folios":     _rpc_eliminar_folios,
+    "reservar_folios":     _rpc_reservar_folios,
+}
+
+
+async def iniciar(host: str = "127.0.0.1", port: int = 54321,
+                  latencia_ms: float = 0) -> tuple[StubPostgrest, web.AppRunner]:
+    """Levanta el stub en el loop actual. Devuelve (stub, runner)."""
+    stub   = StubPostgrest(latencia_ms)
+    runner = web.AppRunner(stub.crear_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return stub, runner
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=54321)
+    p.add_argument("--latencia-ms", type=float, default=0)
+    a = p.parse_args()
+    stub = StubPostgrest(a.latencia_ms)
+    print(f"[STUB POSTGREST] http://{a.host}:{a.port}/rest/v1  latencia={a.latencia_ms}ms")
+    web.run_app(stub.crear_app(), host=a.host, port=a.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
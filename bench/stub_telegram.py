@@ -0,0 +1,147 @@
+"""
+Stub local de la Bot API de Telegram para pruebas de carga.
+
+Responde POST /bot<token>/<método> con resultados válidos para aiogram
+(sendMessage, sendDocument, sendPhoto, editMessageReplyMarkup, getMe,
+set/deleteWebhook, ...) y deja cada llamada dirigida a un chat observado en
+una cola por chat_id con su instante de llegada, para que el generador de carga
+mida cuándo recibe el usuario cada respuesta.
+
+Con --limite-chat N responde 429 (retry_after=1), como Telegram, a los
+envíos que pasen de N por segundo a un mismo chat.
+
+Uso:  python bench/stub_telegram.py [--port 8081] [--latencia-ms 0] [--limite-chat 0]
+      TELEGRAM_API_URL=http://127.0.0.1:8081 uvicorn app:app
+"""
+import argparse
+import asyncio
+import itertools
+import time
+from collections import Counter, defaultdict, deque
+from typing import NamedTuple
+
+from aiohttp import web
+
+
+class Llamada(NamedTuple):
+    metodo: str
+    texto:  str
+    bytes:  int      # tamaño del archivo subido (sendDocument/sendPhoto)
+    t:      float    # time.perf_counter() al recibirla
+
+
+class StubTelegram:
+    def __init__(self, latencia_ms: float = 0, limite_chat: int = 0):
+        self.latencia = latencia_ms / 1000
+        self.limite_chat = limite_chat
+        self.llamadas = Counter()
+        self.rechazos_429 = 0
+        self._recientes: dict[int, deque] = defaultdict(deque)   # chat_id → instantes del último segundo
+        self._colas: dict[int, asyncio.Queue] = {}
+        self._ids = itertools.count(1)
+
+    def cola(self, chat_id: int) -> asyncio.Queue:
+        if chat_id not in self._colas:
+            self._colas[chat_id] = asyncio.Queue()
+        return self._colas[chat_id]
+
+    def _mensaje(self, chat_id: int, **extra) -> dict:
+        return {
+            "message_id": next(self._ids),
+            "date":       int(time.time()),
+            "chat":       {"id": chat_id, "type": "private"},
+            "from":       {"id": 1, "is_bot": True, "first_name": "Stub"},
+            **extra,
+        }
+
+    async def _metodo(self, request: web.Request) -> web.Response:
+        t = time.perf_counter()
+        metodo = request.match_info["metodo"]
+        self.llamadas[metodo] += 1
+        if self.latencia:
+            await asyncio.sleep(self.latencia)
+
+        campos, subido = {}, 0
+        if request.content_type == "multipart/form-data":
+            async for parte in await request.multipart():
+                if parte.filename:
+                    subido += len(await parte.read())
+                else:
+                    campos[parte.name] = await parte.text()
+        elif request.can_read_body:
+            campos = dict(await request.post())
+
+        try:
+            chat_id = int(campos.get("chat_id", 0))
+        except ValueError:
+            chat_id = 0
+        texto = campos.get("text") or campos.get("caption") or ""
+
+        if self.limite_chat and chat_id and metodo.startswith("send"):
+            recientes = self._recientes[chat_id]
+            while recientes and t - recientes[0] > 1:
+                recientes.popleft()
+            if len(recientes) >= self.limite_chat:
+                self.rechazos_429 += 1
+                return web.json_response({
+                    "ok": False, "error_code": 429,
+                    "description": "Too Many Requests: retry after 1",
+                    "parameters": {"retry_after": 1},
+                }, status=429)
+            recientes.append(t)
+
+        if metodo == "getMe":
+            res = {"id": 1, "is_bot": True, "first_name": "Stub", "username": "stub_bot"}
+        elif metodo == "sendMessage":
+            res = self._mensaje(chat_id, text=texto)
+        elif metodo == "sendDocument":
+            n = next(self._ids)
+            res = self._mensaje(chat_id, caption=texto, document={
+                "file_id": f"DOC{n}", "file_unique_id": f"U{n}",
+                "file_name": "permiso.pdf", "file_size": subido,
+            })
+        elif metodo == "sendPhoto":
+            n = next(self._ids)
+            res = self._mensaje(chat_id, caption=texto, photo=[{
+                "file_id": f"FOTO{n}", "file_unique_id": f"U{n}", "width": 1, "height": 1,
+            }])
+        elif metodo == "editMessageReplyMarkup":
+            res = self._mensaje(chat_id)
+        else:
+            res = True
+
+        # Solo se encola para chats observados (cola() ya llamado)
+        if chat_id in self._colas:
+            self._colas[chat_id].put_nowait(Llamada(metodo, texto, subido, t))
+        return web.json_response({"ok": True, "result": res})
+
+    def crear_app(self) -> web.Application:
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/bot{token}/{metodo}", self._metodo)
+        return app
+
+
+async def iniciar(host: str = "127.0.0.1", port: int = 8081, latencia_ms: float = 0,
+                  limite_chat: int = 0) -> tuple[StubTelegram, web.AppRunner]:
+    """Levanta el stub en el loop actual. Devuelve (stub, runner)."""
+    stub   = StubTelegram(latencia_ms, limite_chat)
+    runner = web.AppRunner(stub.crear_app(), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return stub, runner
+
+
+def main():
+    p = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8081)
+    p.add_argument("--latencia-ms", type=float, default=0)
+    p.add_argument("--limite-chat", type=int, default=0, help="envíos/s por chat antes de 429")
+    a = p.parse_args()
+    stub = StubTelegram(a.latencia_ms, a.limite_chat)
+    print(f"[STUB TELEGRAM] http://{a.host}:{a.port}  latencia={a.latencia_ms}ms")
+    web.run_app(stub.crear_app(), host=a.host, port=a.port, print=None)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,309 @@
+"""
+Suite de benchmarks reproducible.
+
+Cubre el render de punta a punta (_generar_pdf_unificado) y por fases,
+_generar_pdf417, _generar_qr_jalisco (más sus variantes vectoriales),
+generar_folio_con_prefijo, generar_folios_pagina2 y
+guardar_folio_con_reintento. Supabase es el stub de PostgREST levantado en
+el mismo loop (sin red real), los contadores van a un SQLite temporal y el
+reloj de app queda fijo, así la salida es la misma en cada corrida.
+
+Por caso reporta ms (mín / mediana / p95 / media), pico de memoria Python
+(tracemalloc, pasada aparte), RSS máximo del proceso y tamaño + hash de la
+salida. El resultado se guarda como JSON para comparar entre commits.
+
+Uso:  python bench/suite.py [--iteraciones 30] [--solo render,qr]
+                            [--salida bench/resultados/X.json]
+                            [--comparar bench/resultados/BASE.json]
+"""
+import argparse
+import asyncio
+import hashlib
+import inspect
+import json
+import os
+import platform
+import re
+import resource
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+from io import BytesIO
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+sys.path.insert(0, os.path.join(RAIZ, "bench"))
+
+_TMP = tempfile.mkdtemp(prefix="bench_suite_")
+_PUERTO = None
+with socket.socket() as _s:
+    _s.bind(("127.0.0.1", 0))
+    _PUERTO = _s.getsockname()[1]
+os.environ.update({
+    "SUPABASE_URL":    f"http://127.0.0.1:{_PUERTO}",
+    "SUPABASE_KEY":    "bench",
+    "BOT_TOKEN":       "123456:BENCH",
+    "CONTADORES_PATH": os.path.join(_TMP, "contadores.db"),
+    "RENDER_WORKERS":  "0",
+    "LOG_NIVEL":       "ERROR",
+})
+
+import fitz
+import pytz
+from PIL import Image
+
+import app
+import stub_postgrest
+
+# ── reloj fijo ───────────────────────────────────────────────────────────────
+
+AHORA = datetime(2026, 1, 15, 10, 30)
+
+class _RelojFijo(datetime):
+    @classmethod
+    def now(cls, tz=None):
+        return tz.localize(AHORA) if tz is not None else AHORA
+
+app.datetime = _RelojFijo
+
+DATOS = {
+    "folio":     "980000123",
+    "marca":     "NISSAN",
+    "linea":     "VERSA SENSE",
+    "anio":      "2021",
+    "serie":     "3N1CN8AE5ML123456",
+    "motor":     "HR16DE123456",
+    "color":     "BLANCO",
+    "nombre":    "JUAN PEREZ LOPEZ",
+    "fecha_exp": AHORA,
+    "fecha_ven": AHORA + timedelta(days=30),
+}
+PAYLOAD = {
+    **DATOS,
+    "fol_rep":    21385,
+    "fp2": {
+        "referencia_pago":   273312001735,
+        "num_autorizacion":  370804,
+        "folio_seguimiento": "GZUdr61oqv3",
+        "linea_captura":     41340817,
+    },
+    "ahora_cdmx": pytz.timezone("America/Mexico_City").localize(AHORA),
+}
+
+# ── casos ────────────────────────────────────────────────────────────────────
+
+def render_e2e():
+    return app._generar_pdf_unificado(PAYLOAD)
+
+def render_fases(fases: dict):
+    """Mismo trabajo que _generar_pdf_unificado, cronometrado por fase."""
+    def paso(nombre, fn, *args):
+        t0 = time.perf_counter()
+        r = fn(*args)
+        fases[nombre] = fases.get(nombre, 0) + time.perf_counter() - t0
+        return r
+    doc = paso("plantilla", app._abrir_plantilla_base)
+    paso("pagina1_conocidos", app._estampar_pagina1_conocidos, doc[0], PAYLOAD)
+    paso("pagina1_final", app._estampar_pagina1_final, doc[0], PAYLOAD,
+         PAYLOAD["fol_rep"], PAYLOAD["ahora_cdmx"])
+    paso("pagina2", app._estampar_pagina2, doc[1], PAYLOAD, PAYLOAD["fp2"])
+    pdf = paso("serializar", doc.tobytes)
+    doc.close()
+    return pdf
+
+def pdf417_raster():
+    return app._generar_pdf417(DATOS)
+
+def pdf417_vector():
+    return app._matriz_pdf417(app._codigos_pdf417(app._texto_pdf417(DATOS)))
+
+def qr_raster():
+    return app._generar_qr_jalisco(DATOS["folio"])
+
+def qr_vector():
+    return app._qr_jalisco(DATOS["folio"]).get_matrix()
+
+async def folio_con_prefijo():
+    return await app.generar_folio_con_prefijo("1")
+
+async def folios_pagina2():
+    return await app.generar_folios_pagina2()
+
+async def guardar_folio():
+    datos = {k: v for k, v in DATOS.items() if k != "folio"}
+    assert await app.guardar_folio_con_reintento(datos, 1, "bench", "1")
+    return datos["folio"]
+
+def _caso_colision(stub):
+    async def guardar_folio_colision():
+        # El siguiente folio del lease ya existe: fuerza un reintento
+        siguiente = app._folio_bloques["1"][0][0] if app._folio_bloques.get("1") else None
+        if siguiente is not None:
+            stub.tablas.setdefault("folios_registrados", []).append({"folio": f"{siguiente:09d}"})
+        return await guardar_folio()
+    return guardar_folio_colision
+
+# ── medición ─────────────────────────────────────────────────────────────────
+
+def _tamano(salida) -> int | None:
+    if isinstance(salida, bytes):
+        return len(salida)
+    if isinstance(salida, Image.Image):
+        buf = BytesIO()
+        salida.save(buf, format="PNG")
+        return len(buf.getvalue())
+    return None
+
+def _huella(salida) -> str:
+    if isinstance(salida, bytes) and salida.startswith(b"%PDF"):
+        # MuPDF pone un /ID aleatorio en el trailer; el resto es estable
+        salida = re.sub(rb"/ID\s*\[<[0-9A-Fa-f]*>\s*<[0-9A-Fa-f]*>\]", b"", salida)
+    if isinstance(salida, Image.Image):
+        salida = salida.tobytes()
+    elif not isinstance(salida, bytes):
+        salida = json.dumps(salida, sort_keys=True, default=str).encode()
+    return hashlib.sha256(salida).hexdigest()[:16]
+
+async def _llamar(fn):
+    r = fn()
+    return await r if inspect.isawaitable(r) else r
+
+async def medir(fn, n: int, fases: dict | None = None) -> dict:
+    await _llamar(fn)   # calentamiento
+    if fases is not None:
+        fases.clear()
+    tiempos = []
+    for _ in range(n):
+        t0 = time.perf_counter()
+        salida = await _llamar(fn)
+        tiempos.append((time.perf_counter() - t0) * 1000)
+    fases_ms = {k: v / n * 1000 for k, v in (fases or {}).items()}
+
+    tracemalloc.start()
+    for _ in range(max(1, n // 5)):
+        await _llamar(fn)
+    _, pico = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    tiempos.sort()
+    res = {
+        "n":          n,
+        "ms_min":     tiempos[0],
+        "ms_mediana": statistics.median(tiempos),
+        "ms_p95":     tiempos[min(n - 1, int(0.95 * n))],
+        "ms_media":   statistics.fmean(tiempos),
+        "pico_kb":    pico / 1024,
+        "rss_max_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "bytes":      _tamano(salida),
+        "huella":     _huella(salida),
+    }
+    if fases_ms:
+        res["fases_ms"] = fases_ms
+    return res
+
+# ── reporte ──────────────────────────────────────────────────────────────────
+
+def _commit() -> str:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"],
+                                       cwd=RAIZ, text=True).strip()
+    except Exception:
+        return "sin-git"
+
+def _imprimir(res: dict, base: dict | None):
+    print(f"{'caso':26}{'mediana ms':>12}{'p95 ms':>10}{'pico KB':>10}{'bytes':>10}"
+          + ("   vs base" if base else ""))
+    for nombre, r in res.items():
+        linea = (f"{nombre:26}{r['ms_mediana']:12.3f}{r['ms_p95']:10.3f}"
+                 f"{r['pico_kb']:10.1f}{r['bytes'] if r['bytes'] is not None else '-':>10}")
+        b = (base or {}).get(nombre)
+        if b:
+            delta = (r["ms_mediana"] / b["ms_mediana"] - 1) * 100 if b["ms_mediana"] else 0
+            linea += f"   {delta:+6.1f}%"
+            if b.get("huella") != r["huella"]:
+                linea += "  salida distinta"
+        print(linea)
+        for fase, ms in r.get("fases_ms", {}).items():
+            print(f"  · {fase:22}{ms:12.3f}")
+
+async def correr(a) -> dict:
+    stub, runner = await stub_postgrest.iniciar(port=_PUERTO)
+    await app.inicializar_folio_cursors()
+    app._cargar_plantillas()
+
+    fases: dict[str, float] = {}
+    casos = {
+        "render_e2e":             render_e2e,
+        "render_fases":           lambda: render_fases(fases),
+        "pdf417_raster":          pdf417_raster,
+        "pdf417_vector":          pdf417_vector,
+        "qr_raster":              qr_raster,
+        "qr_vector":              qr_vector,
+        "folio_con_prefijo":      folio_con_prefijo,
+        "folios_pagina2":         folios_pagina2,
+        "guardar_folio":          guardar_folio,
+        "guardar_folio_colision": _caso_colision(stub),
+    }
+    if a.solo:
+        filtros = a.solo.split(",")
+        casos = {k: v for k, v in casos.items() if any(f in k for f in filtros)}
+
+    res = {}
+    for nombre, fn in casos.items():
+        n = a.iteraciones * (20 if nombre in ("folio_con_prefijo", "folios_pagina2") else 1)
+        res[nombre] = await medir(fn, n, fases if nombre == "render_fases" else None)
+
+    await app.esperar_renovaciones()
+    await app.supabase.cerrar()
+    await runner.cleanup()
+    return res
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--iteraciones", type=int, default=30)
+    p.add_argument("--solo", default="", help="subcadenas de casos, separadas por coma")
+    p.add_argument("--salida", default="")
+    p.add_argument("--comparar", default="")
+    a = p.parse_args()
+
+    # Plantillas enlazadas en un directorio temporal: los archivos de estado
+    # (folio_cursors.json, contadores) no tocan el árbol del repo
+    for plantilla in (app.PLANTILLA_PDF, app.PLANTILLA_BUENO):
+        os.symlink(os.path.join(RAIZ, plantilla), os.path.join(_TMP, plantilla))
+    os.chdir(_TMP)
+    sys.stdout = open(os.devnull, "w")
+    res = asyncio.run(correr(a))
+    sys.stdout = sys.__stdout__
+
+    commit = _commit()
+    informe = {
+        "commit":    commit,
+        "fecha":     time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python":    platform.python_version(),
+        "pymupdf":   fitz.VersionBind,
+        "maquina":   platform.machine(),
+        "cpus":      os.cpu_count(),
+        "vectorial": app.CODIGOS_VECTORIALES,
+        "resultados": res,
+    }
+    salida = a.salida or os.path.join(RAIZ, "bench", "resultados", f"{commit}.json")
+    os.makedirs(os.path.dirname(salida), exist_ok=True)
+    with open(salida, "w") as f:
+        json.dump(informe, f, indent=2)
+
+    base = None
+    if a.comparar:
+        with open(a.comparar) as f:
+            base = json.load(f)["resultados"]
+    print(f"commit {commit}  python {informe['python']}  pymupdf {informe['pymupdf']}")
+    _imprimir(res, base)
+    print(f"\nresultados: {salida}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,12 @@
+-- file_id de Telegram y entradas del render original por folio.
+-- Ejecutar una vez en el SQL editor de Supabase.
+--
+-- /reenviar reenvía por telegram_file_id sin subir nada; si Telegram lo
+-- rechaza, render_entradas (folio DVM, folios de página 2, hora de emisión
+-- y fechas completas) permite re-renderizar el MISMO documento sin consumir
+-- contadores. Los folios emitidos antes de esta migración quedan en null y
+-- se reconstruyen desde la fila.
+
+alter table folios_registrados
+    add column if not exists telegram_file_id text,
+    add column if not exists render_entradas  jsonb;
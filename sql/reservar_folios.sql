@@ -0,0 +1,42 @@
+-- Reserva atómica de bloques de folio (FOLIO_RESERVA_RPC=1).
+-- Ejecutar una vez en el SQL editor de Supabase.
+--
+-- La fila del watermark se bloquea con FOR UPDATE, así dos workers o dos
+-- instancias que reservan a la vez reciben bloques disjuntos. Si el
+-- watermark aún no existe se crea con p_desde. Al llegar a p_limite el
+-- rango da la vuelta a p_base, igual que el cursor en app.py.
+
+create or replace function reservar_folios(
+    p_prefijo  text,
+    p_cantidad integer,
+    p_desde    bigint,
+    p_base     bigint,
+    p_limite   bigint
+) returns json
+language plpgsql
+as $$
+declare
+    v_inicio bigint;
+    v_fin    bigint;
+begin
+    insert into folio_watermark (prefijo, ultimo_asignado)
+    values (p_prefijo, p_desde)
+    on conflict (prefijo) do nothing;
+
+    select ultimo_asignado + 1 into v_inicio
+      from folio_watermark
+     where prefijo = p_prefijo
+       for update;
+
+    if v_inicio >= p_limite then
+        v_inicio := p_base;
+    end if;
+    v_fin := least(v_inicio + greatest(p_cantidad, 1) - 1, p_limite - 1);
+
+    update folio_watermark
+       set ultimo_asignado = v_fin
+     where prefijo = p_prefijo;
+
+    return json_build_object('inicio', v_inicio, 'fin', v_fin);
+end;
+$$;
@@ -0,0 +1,68 @@
+-- Transiciones de folios en un solo round trip (SB_RPC_FOLIOS=1).
+-- Ejecutar una vez en el SQL editor de Supabase.
+
+create or replace function transicionar_folios(
+    p_folios text[],
+    p_estado text,
+    p_fecha  timestamptz default now()
+) returns json
+language plpgsql
+as $$
+declare
+    r_folios     json;
+    r_borradores json;
+begin
+    with u as (
+        update folios_registrados
+           set estado = p_estado, fecha_comprobante = p_fecha
+         where folio = any(p_folios)
+     returning *
+    )
+    select coalesce(json_agg(u), '[]'::json) into r_folios from u;
+
+    with u as (
+        update borradores_registros
+           set estado = p_estado, fecha_comprobante = p_fecha
+         where folio = any(p_folios)
+     returning *
+    )
+    select coalesce(json_agg(u), '[]'::json) into r_borradores from u;
+
+    return json_build_object('folios', r_folios, 'borradores', r_borradores);
+end;
+$$;
+
+-- Con p_estado solo se borran los folios que siguen en ese estado (y sus
+-- borradores); el barrido de expirados lo usa con 'PENDIENTE'.
+drop function if exists eliminar_folios(text[]);
+
+create or replace function eliminar_folios(
+    p_folios text[],
+    p_estado text default null
+) returns json
+language plpgsql
+as $$
+declare
+    r_folios     json;
+    r_borradores json;
+begin
+    with d as (
+        delete from folios_registrados
+         where folio = any(p_folios)
+           and (p_estado is null or estado = p_estado)
+     returning folio, user_id
+    )
+    select coalesce(json_agg(d), '[]'::json) into r_folios from d;
+
+    with d as (
+        delete from borradores_registros
+         where folio = any(p_folios)
+           and (p_estado is null
+                or folio in (select x->>'folio' from json_array_elements(r_folios) x))
+     returning folio
+    )
+    select coalesce(json_agg(d), '[]'::json) into r_borradores from d;
+
+    return json_build_object('folios', r_folios, 'borradores', r_borradores);
+end;
+$$;